@@ -50,6 +50,11 @@ class guiclient(QThread):
         self.wavelength = 0
         self.prop_distance = 0
         self.performance_val = 1
+        # Region of interest (x, y, width, height) requested from the server, None for the whole image
+        self.roi = None
+        # Codec of the images requested from the server: None, 'zlib', 'lz4', 'png' or 'jpeg'
+        self.codec = None
+        self.requested_view = None
         self.quit = False
         self.outdata = None
         self.init = False
@@ -110,7 +115,7 @@ class guiclient(QThread):
           # Check to make sure the mouse is within bounds.  Some images may not be exactly 2048x2048
           if((np.size(self.outdata,0) >= x and np.size(self.outdata,1) >= y)):
              if(self.reconst and self.win_mode != 'fourier'):
-                return int(self.outdata[x-1,y-1,self.prop_distance,self.wavelength])
+                return int(self.outdata[(x-1,y-1)+self.plane_index()])
              else:
                 return int(self.outdata[x-1,y-1])
        else:
@@ -121,6 +126,24 @@ class guiclient(QThread):
 
 
 
+    # Index of the selected propagation distance and wavelength in the received image.
+    # The server sends only the selected plane, but older frames may hold all of them.
+    def plane_index(self):
+       z = self.prop_distance if np.size(self.outdata,2) > 1 else 0
+       l = self.wavelength if np.size(self.outdata,3) > 1 else 0
+       return (z, l)
+
+    # Ask the server for the decimated pixels of the selected plane and region only
+    def request_view(self):
+       view = 'view decimation=%d plane=%d,%d'%(self.performance_val, self.prop_distance, self.wavelength)
+       if self.roi is not None:
+          view += ' roi=%d,%d,%d,%d'%tuple(self.roi)
+       if self.codec is not None:
+          view += ' codec=%s'%(self.codec)
+       if view != self.requested_view:
+          self.sock.sendall((view + '\n').encode())
+          self.requested_view = view
+
     # This will launch and run the Display Thread as a Qt thread
     def unpack_message(self,msg):
             self.msg = msg
@@ -161,7 +184,10 @@ class guiclient(QThread):
               (self.srcid == interface.SRCID_IMAGE_INTENSITY and self.win_mode == "intensity"):
 
                  # Grab data from the DHM server...
-                 self.outdata = np.frombuffer(self.msg[self.offset:self.offset+(functools.reduce(lambda x,y: x*y, self.dimensions)*np.dtype(self.dtype).itemsize)], dtype=self.dtype).reshape(self.dimensions)
+                 if self.msgid == interface.IMAGE_COMPRESSED_TYPE:
+                    self.outdata = interface.unpack_compressed_image(self.msg, self.offset, self.dimensions)
+                 else:
+                    self.outdata = np.frombuffer(self.msg[self.offset:self.offset+(functools.reduce(lambda x,y: x*y, self.dimensions)*np.dtype(self.dtype).itemsize)], dtype=self.dtype).reshape(self.dimensions)
 
                  # make the array writable
                  try:
@@ -169,8 +195,7 @@ class guiclient(QThread):
                  except:
                      pass
 
-                 #rescaled for performance increase of upwards of 40+%
-                 self.outdata = self.outdata[::self.performance_val, ::self.performance_val]
+                 # The server decimates the image to performance_val (see request_view)
 
                  # Rescale image
                  if(self.outdata.max() != 0): 
@@ -182,7 +207,7 @@ class guiclient(QThread):
                     # calculate the histogram on the grayscale 'outdata' object from 0-255
                     # Emit the position of the histogram back to Qt/QML to update the histogram
                     if(self.reconst and self.win_mode != 'fourier'):
-                       self.histogram,self.bins = np.histogram(self.outdata[:,:,self.prop_distance,self.wavelength],bins=np.arange(0,256,1))
+                       self.histogram,self.bins = np.histogram(self.outdata[(slice(None),slice(None))+self.plane_index()],bins=np.arange(0,256,1))
                     else:
                        self.histogram,self.bins = np.histogram(self.outdata,bins=np.arange(0,256,1))
                     for i in range(255):
@@ -190,9 +215,10 @@ class guiclient(QThread):
 
                  # Create an RGB version of the received image to display absolute minimums and maximums
                  if(self.reconst and self.win_mode != 'fourier'):
-                    self.outdata_RGB = np.stack((self.outdata[:,:,self.prop_distance,self.wavelength],)*3, axis=-1)
-                    self.outdata_RGB[self.outdata[:,:,self.prop_distance,self.wavelength] == 255] = [255,0,0]
-                    self.outdata_RGB[self.outdata[:,:,self.prop_distance,self.wavelength] == 0] = [0,0,255] 
+                    plane = self.outdata[(slice(None),slice(None))+self.plane_index()]
+                    self.outdata_RGB = np.stack((plane,)*3, axis=-1)
+                    self.outdata_RGB[plane == 255] = [255,0,0]
+                    self.outdata_RGB[plane == 0] = [0,0,255] 
                  else:
                     self.outdata_RGB = np.stack((self.outdata,)*3, axis=-1)
                     self.outdata_RGB[self.outdata == 255] = [255,0,0]
@@ -252,6 +278,7 @@ class guiclient(QThread):
         totalbytes = 0
         
         while not self.quit:
+            self.request_view()
             infds, outfds, errfds = select.select(self.readfds, [], [])
 
             if not (infds or outfds or errfds):
@@ -1,10 +1,29 @@
 import numpy as np
+import io
+import zlib
 import struct
 import functools
 
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
 CMD_TYPE = 1 #1 << 12
 TELEMETRY_TYPE = 2 #2 << 12
 IMAGE_TYPE = 3 #3 << 12
+IMAGE_COMPRESSED_TYPE = 4 # Codec id follows the dimensions
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+CODEC_PNG = 3
+CODEC_JPEG = 4
 
 SRCID_IMAGE_RAW = 0
 SRCID_IMAGE_FOURIER = 1
@@ -23,6 +42,26 @@ SRCID_TELEMETRY_GUISERVER = SRCID_TELEMETRY_BASENUM + 6
 SRCID_TELEMETRY_SESSION = SRCID_TELEMETRY_BASENUM + 7
 SRCID_TELEMETRY_ALL = SRCID_TELEMETRY_BASENUM + 8
 
+# Decode the image of an IMAGE_COMPRESSED_TYPE message.  'offset' is the offset of the codec id, after the dimensions.
+def unpack_compressed_image(data, offset, dimensions):
+    codec = struct.unpack_from('H', data, offset)[0]
+    encoded = bytes(data[offset + struct.calcsize('H'):])
+
+    if codec == CODEC_ZLIB:
+        decoded = zlib.decompress(encoded)
+    elif codec == CODEC_LZ4:
+        if lz4frame is None:
+            raise ValueError('lz4 codec is not installed')
+        decoded = lz4frame.decompress(encoded)
+    elif codec in (CODEC_PNG, CODEC_JPEG):
+        if PILImage is None:
+            raise ValueError('PIL is needed to decode PNG and JPEG images')
+        return np.asarray(PILImage.open(io.BytesIO(encoded))).reshape(dimensions)
+    else:
+        raise ValueError('Unknown image codec [%d]'%(codec))
+
+    return np.frombuffer(decoded, dtype=np.uint8).reshape(dimensions)
+
 class MessagePkt(object):
     def __init__(self, msg_id, src_id):
         self.databin = b''
@@ -0,0 +1,508 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	async_server.py
+#  author:	S. Felipe Fregoso
+#  description:	Serves all the GUI server channels from one asyncio event loop.
+#               Each channel keeps its own port, and clients of the multiplex
+#               port subscribe to several channels over one connection.
+###############################################################################
+"""
+import sys
+import asyncio
+import threading
+from collections import deque
+
+### Transport buffer size above which a client stops being written to, and
+### below which it is written to again
+HIGH_WATER = 8 * 1024**2
+LOW_WATER = 1024**2
+
+def as_buffers(data):
+    """
+    Return the message as a tuple of buffers, e.g. (header, payload)
+    """
+    if isinstance(data, (list, tuple)):
+        return tuple(data)
+    return (data,)
+
+class ChannelClient(asyncio.Protocol):
+    """
+    Connection of a client to one or more channels
+
+    While the transport buffer is above the high water mark the client is
+    paused and its messages wait in a queue bounded per channel, the oldest
+    message of the channel being dropped for the newest.
+    """
+    def __init__(self, core, channels=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        core : AsyncServerCore
+            Server the client is connected to
+        channels : set or None
+            Channels of the port the client connected to.  None for the
+            multiplex port, where the client subscribes with
+            'subscribe <channel> [<channel> ...]' lines.
+
+        Clients of any port request views of the images with the lines
+        parsed by the 'parse_request' function of the core.
+        """
+        self._core = core
+        self._multiplex = channels is None
+        self.channels = set(channels or [])
+        self.transport = None
+        self.address = ''
+        self._paused = False
+        self._waiting = deque()
+        self._waiting_count = {}
+        self._request = b''
+        ### Views of the images by channel, and of the other channels
+        self._views = {}
+        self._default_view = None
+
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+
+    def connection_made(self, transport):
+        """
+        Register the client with its channels
+        """
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self._core.high_water, low=self._core.low_water)
+        peer = transport.get_extra_info('peername')
+        self.address = '%s:%s'%peer[:2] if peer else ''
+        for channel in self.channels:
+            self._core.subscribe(self, channel)
+
+    def connection_lost(self, exc):
+        """
+        Unregister the client from its channels
+        """
+        for channel in list(self.channels):
+            self._core.unsubscribe(self, channel)
+        self._waiting.clear()
+
+    def data_received(self, data):
+        """
+        Process the subscription requests of multiplex clients and the view requests
+        """
+        self._request += data
+        while b'\n' in self._request:
+            line, self._request = self._request.split(b'\n', 1)
+            line = line.decode(errors='replace')
+            words = line.split()
+            if not words:
+                continue
+            action, channels = words[0].lower(), words[1:]
+            if action in ('subscribe', 'unsubscribe') and self._multiplex:
+                for channel in channels:
+                    if action == 'subscribe':
+                        self._core.subscribe(self, channel)
+                    else:
+                        self._core.unsubscribe(self, channel)
+            else:
+                self._process_view_request(line)
+
+    def _process_view_request(self, line):
+        """
+        Set the view of the images of the channels of the request
+        """
+        if self._core.parse_request is None:
+            return
+
+        try:
+            request = self._core.parse_request(line)
+        except ValueError as err:
+            print('Async server: Bad request from [%s]: %s'%(self.address, repr(err)))
+            return
+        if request is None:
+            print('Async server: Unknown request from [%s]: %s'%(self.address, line))
+            return
+
+        channels, view = request
+        if view.is_full():
+            view = None
+        if channels:
+            for channel in channels:
+                self._views[channel] = view
+        else:
+            self._views = {}
+            self._default_view = view
+
+    def view(self, channel):
+        """
+        Return the view of the images of the channel, None for the whole images
+        """
+        return self._views.get(channel, self._default_view)
+
+    def pause_writing(self):
+        """
+        Transport buffer is above the high water mark
+        """
+        self._paused = True
+
+    def resume_writing(self):
+        """
+        Transport buffer is below the low water mark, send the waiting messages
+        """
+        self._paused = False
+        while self._waiting and not self._paused:
+            channel, buffers = self._waiting.popleft()
+            self._waiting_count[channel] -= 1
+            self._write(buffers)
+
+    def send(self, channel, buffers, depth):
+        """
+        Send the message, or queue it while the client is paused
+
+        Returns
+        -------
+        bool
+            TRUE if a waiting message of the channel was dropped
+        """
+        if not self._paused:
+            self._write(buffers)
+            return False
+
+        dropped = False
+        if self._waiting_count.get(channel, 0) >= max(1, depth):
+            for i, (waiting_channel, _) in enumerate(self._waiting):
+                if waiting_channel == channel:
+                    del self._waiting[i]
+                    break
+            self._waiting_count[channel] -= 1
+            self.dropped_frames += 1
+            dropped = True
+
+        self._waiting.append((channel, buffers))
+        self._waiting_count[channel] = self._waiting_count.get(channel, 0) + 1
+        return dropped
+
+    def _write(self, buffers):
+        """
+        Write the buffers of a message to the transport
+        """
+        if self.transport.is_closing():
+            return
+
+        ### Since python 3.12 writelines sends the buffers with one sendmsg.
+        ### Before, it joins them, while a write sends without copy when
+        ### the transport buffer is empty.
+        if sys.version_info >= (3, 12):
+            self.transport.writelines(buffers)
+        else:
+            for buf in buffers:
+                self.transport.write(buf)
+
+        self.sent_frames += 1
+        self.sent_bytes += sum(len(memoryview(buf).cast('B')) for buf in buffers)
+
+    def stats(self):
+        """
+        Return the counters of the client
+        """
+        return {'address':self.address,
+                'channels':sorted(self.channels),
+                'sent_frames':self.sent_frames,
+                'sent_bytes':self.sent_bytes,
+                'dropped_frames':self.dropped_frames,
+                'queued_frames':len(self._waiting),
+               }
+
+class AsyncServerCore():
+    """
+    Serves the channels of the GUI server from one event loop thread
+    """
+    def __init__(self,
+                 ports,
+                 host='127.0.0.1',
+                 queue_depths=None,
+                 multiplex_port=0,
+                 high_water=HIGH_WATER,
+                 low_water=LOW_WATER,
+                 parse_request=None,
+                 pack_pool=None,
+                 verbose=False,
+                ):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        ports : dict
+            Port of each channel by channel name
+        host : str
+            Address the ports are bound to
+        queue_depths : dict or None
+            Messages of each channel waiting for a paused client before the
+            oldest is dropped.  1 for channels which aren't listed.
+        multiplex_port : int or None
+            Port of the clients subscribing to several channels.  None disables it.
+        high_water, low_water : int
+            Transport buffer limits of the clients, in bytes
+        parse_request : function or None
+            Parses the request lines of the clients into (channels, view),
+            e.g. image_views.parse_view_request.  None ignores them.
+        pack_pool : concurrent.futures.Executor or None
+            Packs and encodes the image messages of different views in parallel
+        verbose : bool
+        """
+        # pylint: disable=too-many-arguments
+        self.ports = dict(ports)
+        self.multiplex_port = multiplex_port
+        self._host = host
+        self._queue_depths = dict(queue_depths or {})
+        self.high_water = high_water
+        self.low_water = low_water
+        self.parse_request = parse_request
+        self._pack_pool = pack_pool
+        self._verbose = verbose
+
+        self._subscribers = {channel:set() for channel in self.ports}
+        self._enabled = {channel:True for channel in self.ports}
+        self.sent_frames = {channel:0 for channel in self.ports}
+        self.dropped_frames = {channel:0 for channel in self.ports}
+
+        self._loop = None
+        self._servers = []
+        self._thread = None
+        self._started = threading.Event()
+
+    def channel(self, name):
+        """
+        Return the object serving channel 'name' with the interface of server_client.Server
+        """
+        return AsyncChannel(self, name)
+
+    def start(self):
+        """
+        Start the event loop thread and wait for the ports to be listening
+        """
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        """
+        Event loop thread
+        """
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._listen())
+        finally:
+            self._started.set()
+
+        self._loop.run_forever()
+
+        for server in self._servers:
+            server.close()
+        for clients in self._subscribers.values():
+            for client in list(clients):
+                client.transport.close()
+        self._loop.run_until_complete(asyncio.sleep(0))
+        self._loop.close()
+        print('Async server Exit.')
+
+    async def _listen(self):
+        """
+        Listen on the port of each channel, and the multiplex port
+        """
+        for channel, port in self.ports.items():
+            server = await self._loop.create_server(lambda channel=channel: ChannelClient(self, {channel}),
+                                                    self._host, port, reuse_address=True)
+            self.ports[channel] = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+
+        if self.multiplex_port is not None:
+            server = await self._loop.create_server(lambda: ChannelClient(self),
+                                                    self._host, self.multiplex_port,
+                                                    reuse_address=True)
+            self.multiplex_port = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+
+        if self._verbose:
+            print('Async server listening: host=%s, ports=%s, multiplex port=%s'\
+                  %(self._host, self.ports, self.multiplex_port))
+
+    def subscribe(self, client, channel):
+        """
+        Add client to the channel.  Called from the event loop.
+        """
+        if channel not in self._subscribers:
+            print('Async server: Unknown channel [%s]'%(channel))
+            return
+        client.channels.add(channel)
+        self._subscribers[channel].add(client)
+
+    def unsubscribe(self, client, channel):
+        """
+        Remove client from the channel.  Called from the event loop.
+        """
+        client.channels.discard(channel)
+        if channel in self._subscribers:
+            self._subscribers[channel].discard(client)
+
+    def has_clients(self, channel):
+        """
+        Returns TRUE if channel has clients
+        """
+        return len(self._subscribers[channel]) > 0
+
+    def enable_send(self, channel, ena):
+        """
+        Enable/disable sending to the clients of the channel
+        """
+        self._enabled[channel] = ena
+
+    def send(self, channel, data):
+        """
+        Send data to all the clients of the channel.  Never waits on the clients.
+
+        Parameters
+        ----------
+        channel : str
+        data : bytes-like, sequence of bytes-like or interface.ImageMessage
+            Message, possibly as separate header and payload buffers.
+            Image messages are packed here once for each view of the clients,
+            so the image may be released once this returns.
+        """
+        if not self._enabled[channel]:
+            print('** NOTE Gui server channel is disabled., channel=%s'%(channel))
+            return
+        clients = list(self._subscribers[channel])
+        if not clients or self._loop is None:
+            return
+
+        if hasattr(data, 'to_buffers'):
+            views = {}
+            for client in clients:
+                view = client.view(channel)
+                views.setdefault(view.key() if view is not None else None, view)
+            ### Views are packed and encoded in parallel on the pack pool
+            if self._pack_pool is not None and len(views) > 1:
+                futures = {key:self._pack_pool.submit(data.to_buffers, view) for key, view in views.items()}
+                packed = {key:future.result() for key, future in futures.items()}
+            else:
+                packed = {key:data.to_buffers(view) for key, view in views.items()}
+            self._loop.call_soon_threadsafe(self._dispatch, channel, None, packed)
+        else:
+            self._loop.call_soon_threadsafe(self._dispatch, channel, as_buffers(data), None)
+
+    def _dispatch(self, channel, buffers, packed):
+        """
+        Write the message to the clients of the channel.  Called from the event loop.
+
+        Parameters
+        ----------
+        buffers : tuple or None
+            Buffers of the message for all clients
+        packed : dict or None
+            Buffers of the message by view key
+        """
+        depth = self._queue_depths.get(channel, 1)
+        for client in self._subscribers[channel]:
+            if packed is not None:
+                view = client.view(channel)
+                ### Clients which changed their view since the packing get the next message
+                buffers = packed.get(view.key() if view is not None else None)
+                if buffers is None:
+                    continue
+            if client.send(channel, buffers, depth):
+                self.dropped_frames[channel] += 1
+            else:
+                self.sent_frames[channel] += 1
+
+    def client_stats(self, channel):
+        """
+        Return the counters of each client of the channel
+        """
+        return [client.stats() for client in list(self._subscribers[channel])]
+
+    def exit(self):
+        """
+        Stop the event loop
+        """
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+class AsyncChannel():
+    """
+    Channel of an AsyncServerCore, with the interface of server_client.Server
+    """
+    def __init__(self, core, name):
+        """
+        Constructor
+        """
+        self._core = core
+        self._name = name
+
+    @property
+    def sent_frames(self):
+        """
+        Messages given to the clients of the channel, sent or waiting
+        """
+        return self._core.sent_frames[self._name]
+
+    @property
+    def dropped_frames(self):
+        """
+        Messages dropped for paused clients of the channel
+        """
+        return self._core.dropped_frames[self._name]
+
+    def enable_send(self, ena):
+        """
+        Enable/disable sending to clients
+        """
+        self._core.enable_send(self._name, ena)
+
+    def send_to_all_clients(self, data):
+        """
+        Send data to all clients of the channel
+        """
+        self._core.send(self._name, data)
+
+    def has_clients(self):
+        """
+        Returns TRUE if there are connected clients
+        """
+        return self._core.has_clients(self._name)
+
+    def client_stats(self):
+        """
+        Return the counters of each connected client
+        """
+        return self._core.client_stats(self._name)
+
+    def start(self):
+        """
+        Start the server core, once for all its channels
+        """
+        self._core.start()
+
+    def exit(self):
+        """
+        Stop the server core
+        """
+        self._core.exit()
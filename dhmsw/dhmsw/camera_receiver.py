@@ -0,0 +1,156 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	camera_receiver.py
+#  author:	S. Felipe Fregoso
+#  description:	Receives the frames of the camera server.  The pixels are read
+#               from the socket straight into the array the frame is published
+#               from, without intermediate byte strings.
+###############################################################################
+"""
+import time
+import numpy as np
+
+def recv_exact(sock, view):
+    """
+    Fill the writable buffer 'view' from the socket
+
+    Returns
+    -------
+    bool
+        FALSE if the socket was closed before the buffer was filled
+    """
+    view = memoryview(view).cast('B')
+    received = 0
+    while received < len(view):
+        nbytes = sock.recv_into(view[received:])
+        if nbytes == 0:
+            return False
+        received += nbytes
+
+    return True
+
+class CameraFrameReceiver():
+    """
+    Receive loop of the camera server frames
+
+    Each frame is a CamServerFramePkt header followed by the pixels.  The
+    header is read into a reused buffer, then the pixels are read directly
+    into the array given to 'recv_frame', e.g. a shared memory slot, or a
+    newly allocated one.  The frame and byte rates are measured over
+    windows of at least 'rate_window' seconds.
+    """
+    def __init__(self, sock, pkt, rate_window=1.0):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        sock : socket.socket
+            Socket connected to the camera server frame port
+        pkt : Iface.CamServerFramePkt
+            Packet used to unpack the headers
+        rate_window : float
+            Seconds over which the rates are measured
+        """
+        self._sock = sock
+        self._pkt = pkt
+        self._header = bytearray(pkt.header_packet_size())
+        self._discard = None
+        self._rate_window = rate_window
+        self._window_start = time.time()
+        self._window_frames = 0
+        self._window_bytes = 0
+
+        self.frames = 0
+        self.bytes = 0
+        self.fps = 0.
+        self.mbps = 0.
+
+    def recv_header(self):
+        """
+        Receive the header of the next frame
+
+        Returns
+        -------
+        tuple or None
+            The unpacked header, None if the socket was closed
+        """
+        if not recv_exact(self._sock, self._header):
+            return None
+
+        return self._pkt.unpack_header(self._header)
+
+    @staticmethod
+    def frame_shape(header):
+        """
+        Return the shape of the image of a header, as CamServerFramePkt.get_image
+        """
+        return (header[0], header[1])
+
+    def recv_frame(self, header, image=None):
+        """
+        Receive the pixels of the frame of 'header'
+
+        Parameters
+        ----------
+        header : tuple
+            Header returned by 'recv_header'
+        image : np.array or None
+            Writable uint8 array of 'frame_shape(header)' to receive into.
+            A new array is allocated if None.
+
+        Returns
+        -------
+        np.array or None
+            The image, None if the socket was closed
+        """
+        width, height, imgsize, packetsize = header[0:4]
+        if imgsize != width * height or packetsize < imgsize:
+            raise ValueError('Camera frame header inconsistent: width=%d, height=%d, '
+                             'imgsize=%d, packetsize=%d'%(width, height, imgsize, packetsize))
+
+        if image is None:
+            image = np.empty(self.frame_shape(header), dtype=np.uint8)
+
+        if not recv_exact(self._sock, image):
+            return None
+
+        ### Bytes after the image in the packet
+        extra = packetsize - imgsize
+        if extra > 0:
+            if self._discard is None or len(self._discard) < extra:
+                self._discard = bytearray(extra)
+            if not recv_exact(self._sock, memoryview(self._discard)[:extra]):
+                return None
+
+        self._update_rates(len(self._header) + packetsize)
+        return image
+
+    def _update_rates(self, nbytes):
+        """
+        Count a received frame and update the rates at the end of a window
+        """
+        self.frames += 1
+        self.bytes += nbytes
+        self._window_frames += 1
+        self._window_bytes += nbytes
+
+        now = time.time()
+        elapsed = now - self._window_start
+        if elapsed >= self._rate_window:
+            self.fps = self._window_frames / elapsed
+            self.mbps = self._window_bytes / elapsed / 1024**2
+            self._window_start = now
+            self._window_frames = 0
+            self._window_bytes = 0
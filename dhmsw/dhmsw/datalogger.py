@@ -25,6 +25,8 @@ class Datalogger(ComponentABC):
             ### Create heartbeat thread
             self._hbeat = heartbeat.Heartbeat(self._pub, 'datalogger')
 
+            self.publish_product_demand()
+
             self._pub.publish('init_done', interface.InitDonePkt('Datalogger', 0))
             self._events['controller']['start'].wait()
             ### Start the Heartbeat thread
@@ -63,6 +65,13 @@ class Datalogger(ComponentABC):
             self._meta.status_msg = status_msg
         self._pub.publish('datalogger_status', interface.MetadataPacket(self._meta))
 
+    def publish_product_demand(self):
+        """
+        Advertise the reconstruction products logged
+        """
+        products = self._meta.products if self._meta.enabled else []
+        self._pub.publish('product_demand', interface.ProductDemand('datalogger', products))
+
     def process_command(self, cmd):
         """
         Process commands for this component
@@ -39,6 +39,15 @@ class PubSub():
             self._subscribers[identifier] = {'set':set(), 'datatype':datatype}
             self._subscribers[identifier]['set'].add(sub_q)
 
+    def num_subscribers(self, identifier):
+        """
+        Return number of subscribers of 'identifier'
+        """
+        try:
+            return len(self._subscribers[identifier]['set'])
+        except KeyError:
+            return 0
+
     def publish(self, identifier, data=None):
         """
         Publish data to all subscriber of 'identifier'
@@ -0,0 +1,177 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	display_quantizer.py
+#  author:	S. Felipe Fregoso
+#  description:	Quantizes the reconstructed products to the 8 bit images sent
+#               to the GUI clients.  The display range is a fixed range, the
+#               min/max or percentiles of the image, optionally per plane and
+#               over a running window of frames.  The image is scaled block by
+#               block through a small float32 scratch into a reused uint8 image.
+###############################################################################
+"""
+import collections
+import numpy as np
+
+### Modes of the display range
+SCALINGS = ['minmax', 'percentile']
+
+### Elements of the input scaled per block, small enough to stay in cache
+BLOCK_SIZE = 1 << 16
+
+### Elements sampled to estimate the percentiles
+PERCENTILE_SAMPLES = 1 << 16
+
+class DisplayQuantizer():
+    """
+    Quantize images to uint8 for display
+
+    The returned image is owned by the quantizer and overwritten by the next
+    call to 'quantize' with the same shape.  It must be packed or copied
+    before then.
+    """
+    def __init__(self, scaling='minmax', percentiles=(1., 99.), per_plane=False,
+                 window=1, value_range=None):
+        # pylint: disable=too-many-arguments
+        """
+        Constructor
+
+        Parameters
+        ----------
+        scaling : str
+            'minmax' maps the minimum and maximum of the image to 0 and 255.
+            'percentile' maps the low and high percentiles, estimated on a
+            sample of the image, and saturates outside of them.
+        percentiles : tuple
+            (low, high) percentiles of the 'percentile' scaling
+        per_plane : bool
+            Scale each (distance, wavelength) plane of 4D images separately
+        window : int
+            Frames of the running window auto-contrast.  With 1 each image
+            is scaled by its own range.  Above 1 the range is the union of
+            the ranges of the image and of the previous 'window' - 1 images,
+            so the contrast doesn't flicker from frame to frame.
+        value_range : tuple or None
+            Fixed (low, high) range, e.g. (-pi, pi) for the phase.  Overrides
+            'scaling' and 'window'.
+        """
+        if scaling not in SCALINGS:
+            raise ValueError('Display scaling must be one of %s'%(SCALINGS))
+        if len(percentiles) != 2 or not 0 <= percentiles[0] < percentiles[1] <= 100:
+            raise ValueError('Display percentiles must be low,high within [0, 100]')
+        if int(window) < 1:
+            raise ValueError('Display window must be >= 1')
+
+        self.scaling = scaling
+        self.percentiles = tuple(float(p) for p in percentiles)
+        self.per_plane = per_plane
+        self.window = int(window)
+        self.value_range = tuple(value_range) if value_range is not None else None
+
+        ### Ranges (low, high) of the frames of the window
+        self._history = collections.deque(maxlen=self.window)
+        self._out = None
+        self._scratch = None
+
+    def reset(self):
+        """
+        Forget the ranges of the previous frames, e.g. on a configuration change
+        """
+        self._history.clear()
+
+    def _buffers(self, image):
+        """
+        Return the output image and the scratch block, reallocated if the shape changed
+        """
+        if self._out is None or self._out.shape != image.shape:
+            self._out = np.empty(image.shape, dtype=np.uint8)
+            self._history.clear()
+
+        row_size = max(1, image[0].size) if image.shape[0] else 1
+        rows = max(1, min(image.shape[0], BLOCK_SIZE // row_size))
+        shape = (rows,) + image.shape[1:]
+        if self._scratch is None or self._scratch.shape != shape:
+            self._scratch = np.empty(shape, dtype=np.float32)
+
+        return self._out, self._scratch
+
+    def measure(self, image):
+        """
+        Return the display range (low, high) of the image
+
+        The bounds are floats, or arrays of shape (distance, wavelength) per plane.
+        """
+        axis = (0, 1) if self.per_plane and image.ndim == 4 else None
+        if self.scaling == 'minmax':
+            return np.min(image, axis=axis), np.max(image, axis=axis)
+
+        ### Strided sample of the rows and columns, keeping every plane
+        step = max(1, int(np.sqrt(image.shape[0] * image.shape[1] / PERCENTILE_SAMPLES)))
+        sample = image[::step, ::step]
+        low, high = np.percentile(sample, self.percentiles, axis=axis)
+        return low, high
+
+    def _window_range(self):
+        """
+        Union of the ranges of the window
+        """
+        if len(self._history) == 1:
+            return self._history[0]
+        lows, highs = zip(*self._history)
+        return np.min(lows, axis=0), np.max(highs, axis=0)
+
+    def quantize(self, image):
+        """
+        Return the image scaled to uint8
+
+        Parameters
+        ----------
+        image : np.array
+            2D image or 4D (rows, columns, distance, wavelength) reconstructed image
+
+        Returns
+        -------
+        np.array
+            uint8 image of the same shape, reused by the next call
+        """
+        out, scratch = self._buffers(image)
+        if image.size == 0:
+            return out
+
+        saturate = True
+        if self.value_range is not None:
+            low, high = self.value_range
+        else:
+            self._history.append(self.measure(image))
+            low, high = self._window_range()
+            ### The min/max of the window scale the image within [0.5, 255.5]
+            saturate = self.scaling != 'minmax'
+
+        low = np.asarray(low, dtype=np.float32)
+        span = np.asarray(high, dtype=np.float32) - low
+        scale = np.divide(np.float32(255), span, out=np.zeros_like(span), where=span > 0)
+        ### (image - low) * scale, rounded to nearest on the truncating cast
+        offset = np.float32(0.5) - low * scale
+
+        rows = scratch.shape[0]
+        for start in range(0, image.shape[0], rows):
+            block = image[start:start + rows]
+            tmp = scratch[:block.shape[0]]
+            np.multiply(block, scale, out=tmp)
+            np.add(tmp, offset, out=tmp)
+            if saturate:
+                np.maximum(tmp, 0, out=tmp)
+                np.minimum(tmp, 255, out=tmp)
+            np.copyto(out[start:start + rows], tmp, casting='unsafe')
+
+        return out
@@ -0,0 +1,85 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	fourier_image.py
+#  author:	S. Felipe Fregoso
+#  description:	Display image of the fourier transform of the hologram.
+#               The magnitude is decimated before the log so only the
+#               displayed pixels go through the log.
+###############################################################################
+"""
+import numpy as np
+
+def block_max(arr, factor):
+    """
+    Decimate 2D array by taking the maximum of each 'factor' x 'factor' block.
+    The last row and column of blocks are smaller if the shape is not a
+    multiple of 'factor'.
+    """
+    if factor <= 1:
+        return arr
+
+    ### Strided maximum of the rows of each block, then of the columns.
+    ### Faster than ufunc.reduceat or a reshape and max over small axes.
+    rows = arr[0::factor].copy()
+    for i in range(1, factor):
+        other = arr[i::factor]
+        np.maximum(rows[:len(other)], other, out=rows[:len(other)])
+
+    out = rows[:, 0::factor].copy()
+    for i in range(1, factor):
+        other = rows[:, i::factor]
+        np.maximum(out[:, :other.shape[1]], other, out=out[:, :other.shape[1]])
+
+    return out
+
+def fourier_display_image(ft_hologram, size=0):
+    """
+    Return the log magnitude of the fourier transform scaled to 0-255
+
+    Parameters
+    ----------
+    ft_hologram : 2D np.array
+        Complex fourier transform of the hologram
+    size : int
+        Maximum number of rows and columns of the image.  The spectrum is
+        decimated by the smallest integer factor which fits, keeping the
+        maximum of each block so the spectral peaks remain visible.
+        0 keeps the full size.
+
+    Returns
+    -------
+    2D np.array of np.uint8
+    """
+    magnitude = np.abs(ft_hologram)
+
+    factor = 1
+    if size > 0:
+        factor = int(np.ceil(max(magnitude.shape) / size))
+    magnitude = block_max(magnitude, factor)
+
+    ### Zero magnitude would map to -inf, clip it to the smallest displayed one
+    positive = magnitude[magnitude > 0]
+    floor = positive.min() if positive.size else 1
+    logmag = np.log(np.maximum(magnitude, floor))
+    low = logmag.min()
+    span = logmag.max() - low
+
+    image = np.zeros(logmag.shape, dtype=np.uint8)
+    if span > 0:
+        logmag -= low
+        logmag *= 255 / span
+        np.rint(logmag, out=logmag)
+        image[...] = logmag
+
+    return image
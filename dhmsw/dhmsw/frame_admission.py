@@ -0,0 +1,194 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	frame_admission.py
+#  author:	S. Felipe Fregoso
+#  description:	Admission of frames to the reconstruction.  Decides which
+#               frames wait for the reconstruction and which are dropped so
+#               the reconstruction doesn't fall behind the camera.  Products
+#               of concurrent workers are put back in frame order.
+###############################################################################
+"""
+import threading
+import collections
+
+class FrameAdmission():
+    """
+    Frames waiting for reconstruction
+
+    Modes
+        'latest'    : One pending frame.  A new frame replaces the pending one.
+        'queue'     : Up to 'depth' pending frames.  When full the oldest
+                      pending frame is dropped.
+        'every_nth' : Only every 'decimation'-th received frame is admitted,
+                      then as in 'queue'.
+
+    Counters
+        received  : Frames offered with 'put'
+        dropped   : Frames not reconstructed
+        processed : Frames for which 'task_done' was called
+        in_flight : Frames pending plus frames being reconstructed
+    """
+    MODES = ('latest', 'queue', 'every_nth')
+
+    def __init__(self, mode='latest', depth=1, decimation=1):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        mode : str
+            One of FrameAdmission.MODES
+        depth : int
+            Maximum number of pending frames in 'queue' and 'every_nth' modes
+        decimation : int
+            Admit every 'decimation'-th frame in 'every_nth' mode
+        """
+        if mode not in self.MODES:
+            raise ValueError("Frame admission mode [%s] not one of %s"%(mode, repr(self.MODES)))
+
+        self.mode = mode
+        self._depth = 1 if mode == 'latest' else max(1, int(depth))
+        self._decimation = max(1, int(decimation)) if mode == 'every_nth' else 1
+        self._pending = collections.deque()
+        self._active = 0
+        self._issued = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+
+    @property
+    def in_flight(self):
+        """
+        Number of frames pending or being reconstructed
+        """
+        with self._cond:
+            return len(self._pending) + self._active
+
+    @property
+    def active(self):
+        """
+        Number of frames being reconstructed
+        """
+        with self._cond:
+            return self._active
+
+    def put(self, frame):
+        """
+        Offer a frame for reconstruction
+
+        Returns
+        -------
+        list
+            Frames dropped by this call.  Either 'frame' itself or pending
+            frames it replaced.
+        """
+        with self._cond:
+            self.received += 1
+            if self._closed or (self.received - 1) % self._decimation:
+                self.dropped += 1
+                return [frame]
+
+            dropped = []
+            while len(self._pending) >= self._depth:
+                dropped.append(self._pending.popleft())
+            self.dropped += len(dropped)
+
+            self._pending.append(frame)
+            self._cond.notify()
+            return dropped
+
+    def get(self):
+        """
+        Block until a frame is available
+
+        Returns
+        -------
+        (int, object) or None
+            Sequence number and frame, None once closed.  Sequence numbers
+            count the frames returned by 'get' starting at 0.
+        """
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            seq = self._issued
+            self._issued += 1
+            self._active += 1
+            return (seq, self._pending.popleft())
+
+    def task_done(self):
+        """
+        Signal that the reconstruction of a frame returned by 'get' is done
+        """
+        with self._cond:
+            self._active -= 1
+            self.processed += 1
+
+    def close(self):
+        """
+        Wake up 'get' and return the frames which were still pending
+        """
+        with self._cond:
+            self._closed = True
+            pending = list(self._pending)
+            self._pending.clear()
+            self.dropped += len(pending)
+            self._cond.notify_all()
+            return pending
+
+class Resequencer():
+    """
+    Publish the products of concurrent reconstruction workers in frame order
+
+    Products are pushed with the sequence number returned by
+    FrameAdmission.get and held until all products of lower sequence
+    numbers were pushed.  A frame without product is pushed as None.
+    """
+    def __init__(self, publish):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        publish : function
+            Called with each product, in sequence order
+        """
+        self._publish = publish
+        self._next = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        """
+        Number of products held back by a missing lower sequence number
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def push(self, seq, product):
+        """
+        Add the product of frame 'seq' and publish the products now in order
+        """
+        with self._lock:
+            self._pending[seq] = product
+            while self._next in self._pending:
+                product = self._pending.pop(self._next)
+                self._next += 1
+                if product is not None:
+                    self._publish(product)
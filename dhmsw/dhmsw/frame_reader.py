@@ -0,0 +1,218 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	frame_reader.py
+#  author:	S. Felipe Fregoso
+#  description:	Reads frame files ahead of the file frame source.  Uncompressed
+#               TIFF, BMP and raw frames are memory mapped, anything else is
+#               decoded, on a pool of threads into a bounded prefetch buffer.
+###############################################################################
+"""
+import os
+import mmap
+import struct
+import collections
+import concurrent.futures
+import numpy as np
+from skimage.io import imread
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+### Extensions of the raw frame files, which have no header
+RAW_EXTENSIONS = ('.raw', '.bin')
+
+def _map_file(path, offset, count, dtype):
+    """
+    Return read only 1D array of 'count' elements of 'dtype' at 'offset'
+    of the memory mapped file.  The pages are requested from the disk
+    right away so the mapping is read ahead of its use.
+    """
+    with open(path, 'rb') as fid:
+        mapped = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_WILLNEED)
+
+    return np.frombuffer(mapped, dtype=dtype, count=count, offset=offset)
+
+def _map_tiff(path):
+    """
+    Memory map the first page of an uncompressed TIFF.  None if it can't be.
+    """
+    if tifffile is None:
+        return None
+
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        ### Older tifffile return the (offset, bytecount) of contiguous data
+        contiguous = page.is_contiguous
+        if isinstance(contiguous, tuple):
+            offset, nbytes = contiguous
+        elif contiguous:
+            offset, nbytes = page.dataoffsets[0], sum(page.databytecounts)
+        else:
+            offset, nbytes = None, None
+        if offset is None or page.compression != 1 or len(tif.pages) > 1 \
+           or page.dtype is None or page.samplesperpixel != 1 or page.fillorder != 1:
+            return None
+        dtype = page.dtype.newbyteorder(tif.byteorder)
+        shape = page.shape
+
+    count = int(np.prod(shape))
+    if count * dtype.itemsize != nbytes:
+        return None
+
+    return _map_file(path, offset, count, dtype).reshape(shape)
+
+def _map_bmp(path):
+    """
+    Memory map an uncompressed 8 bit BMP.  None if it can't be.
+    """
+    with open(path, 'rb') as fid:
+        header = fid.read(34)
+
+    if len(header) < 34 or header[:2] != b'BM':
+        return None
+
+    offset = struct.unpack_from('<I', header, 10)[0]
+    width, height, _, bpp, compression = struct.unpack_from('<iiHHI', header, 18)
+    if bpp != 8 or compression != 0:
+        return None
+
+    ### Rows are padded to 4 bytes and stored bottom up for positive heights
+    stride = (width + 3) // 4 * 4
+    rows = abs(height)
+    frame = _map_file(path, offset, stride * rows, np.uint8).reshape((rows, stride))[:, :width]
+
+    return frame[::-1] if height > 0 else frame
+
+def _map_raw(path, shape, dtype):
+    """
+    Memory map a headerless raw frame.  None if the file size doesn't match.
+    """
+    count = int(np.prod(shape))
+    if os.path.getsize(path) != count * np.dtype(dtype).itemsize:
+        return None
+
+    return _map_file(path, 0, count, dtype).reshape(shape)
+
+def read_frame(path, raw_shape=None, raw_dtype='uint8'):
+    """
+    Return the frame of the file 'path' as a 2D array
+
+    Uncompressed TIFF, 8 bit BMP and raw frames are memory mapped and
+    returned read only, other files are decoded with skimage.io.imread.
+
+    Parameters
+    ----------
+    path : str
+        Frame file
+    raw_shape : tuple or None
+        (rows, columns) of raw frames.  Raw frames are decoded if None.
+    raw_dtype : str
+        Pixel type of raw frames
+    """
+    ext = os.path.splitext(path)[1].lower()
+
+    frame = None
+    if ext in ('.tif', '.tiff'):
+        frame = _map_tiff(path)
+    elif ext == '.bmp':
+        frame = _map_bmp(path)
+    elif ext in RAW_EXTENSIONS and raw_shape:
+        frame = _map_raw(path, raw_shape, raw_dtype)
+
+    if frame is None:
+        frame = np.asarray(imread(path))
+
+    ### Multi channel images, keep the first channel
+    if frame.ndim == 3:
+        frame = frame[:, :, 0]
+
+    return frame
+
+class PrefetchingFrameReader():
+    """
+    Iterator over the frames of a list of files, in order.
+
+    Up to 'depth' frames are read ahead by a pool of 'workers' threads, so
+    reading and decoding overlap with the processing of previous frames.
+    """
+    def __init__(self, flist, depth=4, workers=2, raw_shape=None, raw_dtype='uint8'):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        flist : list
+            Frame files
+        depth : int
+            Maximum number of frames read ahead
+        workers : int
+            Number of reading threads
+        raw_shape : tuple or None
+            (rows, columns) of raw frames
+        raw_dtype : str
+            Pixel type of raw frames
+        """
+        # pylint: disable=too-many-arguments
+        self._flist = list(flist)
+        self._depth = max(1, int(depth))
+        self._raw_shape = raw_shape
+        self._raw_dtype = raw_dtype
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers)))
+        self._pending = collections.deque()
+        self._next = 0
+
+    def _fill(self):
+        """
+        Submit reads until 'depth' frames are pending
+        """
+        while len(self._pending) < self._depth and self._next < len(self._flist):
+            fname = self._flist[self._next]
+            self._pending.append((fname, self._executor.submit(read_frame,
+                                                               fname,
+                                                               self._raw_shape,
+                                                               self._raw_dtype)))
+            self._next += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Return (fname, frame) of the next file
+        """
+        self._fill()
+        if not self._pending:
+            raise StopIteration
+
+        fname, future = self._pending.popleft()
+        frame = future.result()
+        self._fill()
+        return fname, frame
+
+    def __len__(self):
+        return len(self._flist)
+
+    def close(self):
+        """
+        Cancel the pending reads and stop the threads
+        """
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
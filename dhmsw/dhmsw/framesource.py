@@ -28,14 +28,16 @@ import glob
 import threading
 import time
 import queue
-from skimage.io import imread
 import numpy as np
 
 from . import sequence
+from .frame_reader import PrefetchingFrameReader
+from .camera_receiver import CameraFrameReceiver
 from . import interface as Iface
 from . import metadata_classes as MetaC
 from .heartbeat import Heartbeat as HBeat
 from .component_abc import ComponentABC
+from .shared_frames import (SharedFrameRing, SlotDescriptor, ack_identifier)
 
 def verboseprint(*args, **kwargs):
     """
@@ -50,7 +52,7 @@ def _get_img_obj(img):
     """
     imgobj = None
 
-    if img.shape == 3:
+    if img.ndim == 3:
         imgobj = Iface.Image((), img[:, :, 0])
     else:
         imgobj = Iface.Image((), img)
@@ -130,6 +132,9 @@ class Framesource(ComponentABC):
         ### Declare camera server frame packet object
         self._ms_pkt = Iface.CamServerFramePkt()
 
+        ### Shared memory ring of the published frames.  Created in 'run'
+        self._frame_ring = None
+
 
     def is_filegenerator_alive(self):
         """
@@ -137,7 +142,7 @@ class Framesource(ComponentABC):
         """
         return self._filegenerator['thread'].is_alive()
 
-    def start_filegenerator(self, filepath):
+    def start_filegenerator(self, filepath, timestamps=None):
         """
         Starts the thread to read from a file and publish images and sets state to RUNNING.
 
@@ -145,7 +150,11 @@ class Framesource(ComponentABC):
 
         Parameters
         --------------
-        filepath : str
+        filepath : str or list
+            File path, wildcards allowed, or list of file paths
+        timestamps : list or None
+            Milliseconds of each file of 'filepath' since the first one.  Needed
+            to replay the files at their original times.
 
         Returns
         --------------
@@ -173,6 +182,10 @@ class Framesource(ComponentABC):
         else:
             flist = glob.glob(filepath)
 
+        if timestamps is not None and len(timestamps) != len(flist):
+            print('Number of timestamps does not match the files found.  Timestamps ignored.')
+            timestamps = None
+
         ### Spawn thread if filepath produced a list of files.
         ret = False
         if flist:
@@ -181,6 +194,7 @@ class Framesource(ComponentABC):
                 args=(flist,
                       self._filegenerator['queue'],
                       self._events['reconst']['done'],
+                      timestamps,
                       )
                 )
             self._filegenerator['thread'].daemon = True
@@ -228,17 +242,21 @@ class Framesource(ComponentABC):
         self._meta.state = MetaC.FramesourceMetadata.FRAMESOURCE_STATE_IDLE
 
 
-    def _file_thread(self, flist, inq, reconst_done_event):
+    def _file_thread(self, flist, inq, reconst_done_event, timestamps=None):
         """
         Thread that reads images from a file and publishes it.
 
-        This thread is spawned by function 'start_filegenerator'.  If the
-        reconstruction mode is RECONST_NONE then this thread will publish
-        images at a rate of 6Hz in the order they are in 'flist'.  If the
-        reconstruction mode is anything other than RECONST_NONE, then it will
-        publish the image and wait for signal to be raised by the Reconstructor
-        module to indicate that it is done reconstructing.  Once the signal is
-        received the next image is published.
+        This thread is spawned by function 'start_filegenerator'.  The files
+        are read ahead of the publishing by a PrefetchingFrameReader.  Their
+        replay depends on the 'file_replay' setting.
+
+            'paced'      : If the reconstruction mode is RECONST_NONE then images
+                           are published at a rate of 6Hz.  Otherwise the next image
+                           is published once the Reconstructor signals that it is
+                           done reconstructing.
+            'max'        : Images are published as fast as they are read.
+            'timestamps' : Images are published at their original times.  'paced'
+                           if there are no timestamps.
 
         This thread will terminate if all files in 'flist' have been published
         or if a 'None' messages is sent in 'inq'
@@ -251,88 +269,80 @@ class Framesource(ComponentABC):
             Input message queue.  Primarily used to get a 'None' message to
             terminate the thread.
         reconst_done_event :
-            TBD
+            Event set by the Reconstructor when done reconstructing an image
+        timestamps : list or None
+            Milliseconds of each file since the first one
 
         Returns
         ---------------
         None
         """
-
+        # pylint: disable=too-many-arguments
         verbose = True
         numfiles = len(flist)
-        count = 0
-        ### Send first file
-        img = np.asarray(imread(flist[0]))
-
-        imgobj = _get_img_obj(img)
-
-        self._meta.file['currentfile'] = flist[0]
-
-        self.publish_image(imgobj)
-        verboseprint('%f: Sent count=%d, total=%d, fname=%s'%(time.time(),
-                                                              count,
-                                                              numfiles,
-                                                              flist[count])
-                    )
-        while True:
-            try:
-                ret = inq.get_nowait() #Mainly used to get a 'None' to end the execution
-                if ret is None:
-                    break
-            except queue.Empty:
-                pass
+        reader = PrefetchingFrameReader(flist,
+                                        depth=self._meta.file_prefetch_depth,
+                                        workers=self._meta.file_prefetch_workers,
+                                        raw_shape=self._meta.raw_frame_shape,
+                                        raw_dtype=self._meta.raw_frame_dtype)
+        start_time = time.time()
+        try:
+            for count, (fname, img) in enumerate(reader):
 
-            if self._reconst_meta.processing_mode == MetaC.ReconstructionMetadata.RECONST_NONE:
-                count += 1
-                if count >= numfiles:
+                if count > 0 and self._wait_for_next_file(count,
+                                                          inq,
+                                                          reconst_done_event,
+                                                          timestamps,
+                                                          start_time):
                     break
-                self._meta.file['currentfile'] = flist[count]
-                img = np.asarray(imread(flist[count]))
 
-                imgobj = _get_img_obj(img)
-
-                #reconst_done_event.clear()
-                self.publish_image(imgobj)
-                time.sleep(.166) #6Hz
+                self._meta.file['currentfile'] = fname
+                reconst_done_event.clear()
+                self.publish_image(_get_img_obj(img))
                 if verbose:
                     print('%f: Sent count=%d, total=%d, fname=%s'%(time.time(),
                                                                    count,
                                                                    numfiles,
-                                                                   flist[count])
+                                                                   fname)
                          )
-                print('Done event timed out')
-            else:
-                reconst_done_event.wait(3)
-                if verbose:
-                    print('%f: Done event received, count=%d, total=%d, '
-                          'fname=%s'%(time.time(),
-                                      count,
-                                      numfiles,
-                                      flist[count]))
-                count += 1
-                if count >= numfiles:
-                    break
-                self._meta.file['currentfile'] = flist[count]
-                img = np.asarray(imread(flist[count]))
-                if img.shape == 3:
-                    imgobj = Iface.Image((), img[:, :, 0])
-                else:
-                    imgobj = Iface.Image((), img)
-
-                reconst_done_event.clear()
-                self.publish_image(imgobj)
-                if verbose:
-                    print('%f: Sent count=%d, total=%d, '
-                          'fname=%s'%(time.time(),
-                                      count,
-                                      numfiles,
-                                      flist[count]))
+        finally:
+            reader.close()
 
         print('File Generation thread ended')
         inq.queue.clear()
         self._meta.state = MetaC.FramesourceMetadata.FRAMESOURCE_STATE_IDLE
         self.publish_status()
 
+    def _wait_for_next_file(self, count, inq, reconst_done_event, timestamps, start_time):
+        """
+        Wait until file 'count' should be published according to 'file_replay'
+
+        Returns
+        ---------------
+        bool
+            TRUE if a 'None' message was received in 'inq' to end the thread
+        """
+        # pylint: disable=too-many-arguments
+        replay = self._meta.file_replay
+        timeout = 0
+        if replay == 'timestamps' and timestamps is not None:
+            timeout = max(0, start_time + (timestamps[count] - timestamps[0]) / 1000 - time.time())
+        elif replay != 'max':
+            if self._reconst_meta.processing_mode == MetaC.ReconstructionMetadata.RECONST_NONE:
+                timeout = .166 #6Hz
+            else:
+                reconst_done_event.wait(3)
+
+        ### Wait on the message queue so a 'None' ends the wait right away
+        try:
+            if timeout > 0:
+                ret = inq.get(timeout=timeout)
+            else:
+                ret = inq.get_nowait()
+            return ret is None
+        except queue.Empty:
+            return False
+
     def start_camera_client(self):
         """
         Start the client to the camera server.
@@ -411,9 +421,32 @@ class Framesource(ComponentABC):
         None
 
         """
+        ### Write the frame once to shared memory and only publish its descriptor
+        readers = self._pub.num_subscribers('rawframe')
+        if self._frame_ring is not None and readers \
+           and self._pub.num_subscribers(ack_identifier('rawframe')):
+            meta, image = img.get_img()
+            shared = self._frame_ring.put({'image':np.asarray(image)}, readers)
+            if shared is not None:
+                img = Iface.Image(meta, shared=shared)
 
         self._pub.publish('rawframe', img)
 
+    def _create_frame_ring(self):
+        """
+        Create the shared memory ring of the published frames
+        """
+        if self._meta.shared_memory_slots > 0:
+            self._frame_ring = SharedFrameRing('rawframe', self._meta.shared_memory_slots)
+
+    def _close_frame_ring(self):
+        """
+        Close the shared memory ring of the published frames
+        """
+        if self._frame_ring is not None:
+            self._frame_ring.close()
+            self._frame_ring = None
+
     def process_metadata(self, data):
         """
         Process metadata
@@ -445,8 +478,10 @@ class Framesource(ComponentABC):
 
     def _start_sequence(self):
         try:
-            flist = sequence.Sequence().get_sequence_filepaths(self._meta.file['datadir'])
-            self.start_filegenerator(flist)
+            seq = sequence.Sequence()
+            flist = seq.get_sequence_filepaths(self._meta.file['datadir'])
+            timestamps = seq.get_sequence_timestamps(self._meta.file['datadir'])
+            self.start_filegenerator(flist, timestamps=timestamps)
         except (ValueError, IOError) as err:
             self._meta.status_msg = 'ERROR with sequence: %s'%(repr(err))
             print(self._meta.status_msg)
@@ -524,6 +559,11 @@ class Framesource(ComponentABC):
         elif isinstance(data, Iface.Image):
             self.publish_image(data)
             print("Framesource: %f: Got Image Frame!"%(time.time()))
+
+        ### Subscriber is done with a shared memory frame
+        elif isinstance(data, SlotDescriptor):
+            if self._frame_ring is not None:
+                self._frame_ring.ack(data)
         else:
             print('Unkown type', type(data))
 
@@ -562,6 +602,8 @@ class Framesource(ComponentABC):
 
         try:
 
+            self._create_frame_ring()
+
             self._initialize_framereceivethreads()
 
             self.create_heartbeat()
@@ -613,141 +655,81 @@ class Framesource(ComponentABC):
         if self._hbeat.isAlive():
             self._hbeat.join(timeout=5)
         self.stop_imagegenerator()
+        self._close_frame_ring()
         print('[%s]: End'%(self._id))
 
     def _camcli_thread(self, clientsock, inq, outq):
         """
         Camera client thread.  Gets frames from the camera server
+
+        The pixels of each frame are received straight into the shared memory
+        slot the frame is published from, or into a new array when the frame
+        is not shared, and published from this thread.  'outq' is not used
+        by the zero copy receive and is kept for compatibility.
         """
+        # pylint: disable=unused-argument
         readfds = [clientsock]
-        exitthread = False
-        verbose = False
-
-        count = 0
-
-        data = b''
-        msg = b''
-        lasttime = time.time()
-        meta = None
-        totalbytes = 0
-
-        ms_pkt = Iface.CamServerFramePkt()
+        receiver = CameraFrameReceiver(clientsock, Iface.CamServerFramePkt())
+        ### Don't wait forever on a camera server that stops in a frame
+        clientsock.settimeout(5)
 
         print('Started client thread')
         while True:
-            if exitthread:
-                print("Framesource: Exiting _camcli thread")
-                break
-
-            infds, outfds, errfds = select.select(readfds, [], [], 1)
-
-            if not (infds or outfds or errfds):
-                ### TIMEOUT
-                ### Check if any input data from queue
-                try:
-                    qdata = inq.get_nowait()
-                    if qdata is None: ### Exit the thread
-                        print('^^^^^^^^^^^ Closed Camera Thread ^^^^^^^^^')
-                        clientsock.close()
-                        exitthread = True
-                        continue
-                except queue.Empty:
-                    pass
-
-                continue
+            infds, _, _ = select.select(readfds, [], [], 1)
 
+            ### Graceful exit of thread
             try:
-                # Graceful exit of thread
                 qdata = inq.get_nowait()
-                if qdata is None: ### Exit the thread
-                    clientsock.close()
-                    return
+                if qdata is None:
+                    print('^^^^^^^^^^^ Closed Camera Thread ^^^^^^^^^')
+                    break
             except queue.Empty:
                 pass
 
-            for in_sock in infds:
-                if in_sock is clientsock:
-                    ### Get as much data as we can
-                    packet = clientsock.recv(65535)
+            if not infds:
+                continue
 
-                    if not packet:
-                        print("Framesource: Camera server disconnected. Closing socket.")
-                        clientsock.close()
-                        exitthread = True
-                        break
+            shared = None
+            try:
+                header = receiver.recv_header()
+                if header is None:
+                    print("Framesource: Camera server disconnected. Closing socket.")
+                    break
+
+                ### Receive into a shared memory slot if the frame will be shared
+                arrays = None
+                readers = self._pub.num_subscribers('rawframe')
+                if self._frame_ring is not None and readers \
+                   and self._pub.num_subscribers(ack_identifier('rawframe')):
+                    reserved = self._frame_ring.reserve(
+                        {'image':(receiver.frame_shape(header), np.uint8)}, readers)
+                    if reserved is not None:
+                        shared, arrays = reserved
+
+                image = receiver.recv_frame(header, arrays['image'] if arrays else None)
+                if image is None:
+                    if shared is not None:
+                        self._frame_ring.release(shared)
+                    print("Framesource: Camera server disconnected. Closing socket.")
+                    break
+            except (socket.error, ValueError) as err:
+                if shared is not None:
+                    self._frame_ring.release(shared)
+                print('Framesource: Camera client error [%s]. Closing socket.'%(repr(err)))
+                break
+
+            if shared is not None:
+                self._pub.publish('rawframe', Iface.Image(header, shared=shared))
+                self._meta.stats.camera_frames_shared += 1
+            else:
+                self._pub.publish('rawframe', Iface.Image(header, image))
+
+            self._meta.stats.camera_frames = receiver.frames
+            self._meta.stats.camera_bytes = receiver.bytes
+            self._meta.stats.camera_fps = receiver.fps
+            self._meta.stats.camera_mbps = receiver.mbps
 
-                    data += packet
-                    datalen = len(data)
-
-                    ### If he haven't processed the header/meta, then lets.
-                    if meta is None and datalen > ms_pkt.header_packet_size():
-                        width, \
-                        height, \
-                        size, \
-                        packetsize, \
-                        tstamp, \
-                        frameid, \
-                        logging, \
-                        gain, \
-                        gain_min, \
-                        gain_max, \
-                        exposure, \
-                        exposure_min, \
-                        exposure_max, \
-                        rate, \
-                        rate_measured = ms_pkt.unpack_header(data)
-                        meta = ( \
-                                width,\
-                                height, \
-                                size, \
-                                packetsize, \
-                                tstamp, \
-                                frameid, \
-                                logging, \
-                                gain, \
-                                gain_min, \
-                                gain_max, \
-                                exposure, \
-                                exposure_min, \
-                                exposure_max, \
-                                rate, \
-                                rate_measured, \
-                               )
-                        totalbytes = packetsize + ms_pkt.header_packet_size()
-
-                        if datalen >= totalbytes:  ### We have a complete packet stored.
-                            msg = data[:totalbytes]
-                            data = data[totalbytes:]
-                            meta = None
-                            totalbytes = 0
-                            if verbose:
-                                print('%.2f Hz'%(1/(time.time()-lasttime)))
-                            lasttime = time.time()
-                            count += 1
-                            outq.put_nowait(msg)
-                            if verbose:
-                                print('%f: Full message received after getting'
-                                      'meta: datalen=%d, datalen after=%d'%(time.time(), datalen, len(data)))
-                    else:
-                        if datalen < totalbytes:
-                            continue
-
-                        ### We have a complete message
-                        msg = data[:totalbytes]
-                        data = data[totalbytes:]
-                        if verbose:
-                            print('%f: Full message received: datalen=%d, '
-                                  'datalen after=%d'%(time.time(),
-                                                      datalen,
-                                                      len(data)))
-                        meta = None
-                        totalbytes = 0
-                        ### Send frame here
-                        outq.put_nowait(msg)
-                        if verbose:
-                            print('%.2f Hz'%(1/(time.time()-lasttime)))
-                        lasttime = time.time()
-                        count += 1
+        clientsock.close()
         print('Framesource:  End of Camera Client Thread')
         inq.queue.clear()
         self._meta.state = MetaC.FramesourceMetadata.FRAMESOURCE_STATE_IDLE
@@ -23,74 +23,90 @@ import sys
 import time
 import queue
 import copy
+import concurrent.futures
 import numpy as np
 
 from . import interface as Iface
 from . import telemetry_iface_ag
 from . import metadata_classes as MetaC
 from .server_client import Server as Svr
+from .async_server import AsyncServerCore
+from .image_views import parse_view_request
+from .display_quantizer import DisplayQuantizer
 from .heartbeat import Heartbeat as HBeat
 
 from .component_abc import ComponentABC
 
+### Reconstruction product served by each image server
+PRODUCT_SERVERS = {'fourier':'fourier',
+                   'amplitude':'reconst_amp',
+                   'intensity':'reconst_intensity',
+                   'phase':'reconst_phase',
+                  }
+
+### Port name of the server of each image and the telemetry
+SERVER_PORTS = {'reconst_amp':'reconst_amp',
+                'reconst_intensity':'reconst_intensity',
+                'reconst_phase':'reconst_phase',
+                'fourier':'fourier',
+                'rawframes':'raw_frames',
+                'telemetry':'telemetry',
+               }
+
 def prepare_raw_img_packet(data):
     """
     Get the raw image from data, serialize it and return as GUI packet
     """
-    rawimgpkt = Iface.MessagePkt(Iface.IMAGE_TYPE, Iface.SRCID_IMAGE_RAW)
     rawimage = data.image
-    rawimgpkt.append(rawimage)
-    rawimgpkt.complete_packet()
-    rawb = Iface.GuiPacket('rawframes', rawimgpkt.to_bytes())
+    rawb = Iface.GuiPacket('rawframes', Iface.ImageMessage(Iface.IMAGE_TYPE,
+                                                           Iface.SRCID_IMAGE_RAW,
+                                                           rawimage))
     return rawb
 
 def prepare_fourier_img_packet(data):
     """
     Get the fourier image from data, serialize it and return as GUI packet
     """
-    fourierpkt = Iface.MessagePkt(Iface.IMAGE_TYPE, Iface.SRCID_IMAGE_FOURIER)
     #fourierimage = data.ft_hologram
     fourierimage = data.get_ft_hologram()
-    fourierpkt.append(fourierimage)
-    fourierpkt.complete_packet()
-    fourier = Iface.GuiPacket('fourier', fourierpkt.to_bytes())
+    ### Only computed while fourier clients are connected
+    if fourierimage is None:
+        return None
+    fourier = Iface.GuiPacket('fourier', Iface.ImageMessage(Iface.IMAGE_TYPE,
+                                                            Iface.SRCID_IMAGE_FOURIER,
+                                                            fourierimage))
     return fourier
 
-def create_amp_img_pkt(data, img_type, srcid):
+def create_amp_img_pkt(data, img_type, srcid, quantizer=None):
     """
     Returns a GUI packet containing the reconstructed amplitude image
     """
-    mpkt_a = Iface.MessagePkt(img_type,
-                              srcid)
     print("GUISERVER: create_amp_img_pkt(): ", time.time())
-    normData = data.reconstwave.amplitude/np.max(data.reconstwave.amplitude) * 255
-    mpkt_a.append(normData.astype(dtype=np.uint8))
-    mpkt_a.complete_packet()
-    amp_image = Iface.GuiPacket('reconst_amp', mpkt_a.to_bytes())
+    quantizer = quantizer if quantizer is not None else DisplayQuantizer()
+    amp_image = Iface.GuiPacket('reconst_amp',
+                                Iface.ImageMessage(img_type, srcid,
+                                                   quantizer.quantize(data.reconstwave.amplitude)))
     return amp_image
 
-def create_int_img_pkt(data, img_type, srcid):
+def create_int_img_pkt(data, img_type, srcid, quantizer=None):
     """
     Returns a GUI packet containing the reconstructed intensity image
     """
-    mpkt_a = Iface.MessagePkt(img_type,
-                              srcid)
-    normData = data.reconstwave.intensity/np.max(data.reconstwave.intensity) * 255
-    mpkt_a.append(normData.astype(dtype=np.uint8))
-    mpkt_a.complete_packet()
-    intensity_image = Iface.GuiPacket('reconst_intensity', mpkt_a.to_bytes())
+    quantizer = quantizer if quantizer is not None else DisplayQuantizer()
+    intensity_image = Iface.GuiPacket('reconst_intensity',
+                                      Iface.ImageMessage(img_type, srcid,
+                                                         quantizer.quantize(data.reconstwave.intensity)))
     return intensity_image
 
-def create_phase_img_pkt(data, img_type, srcid):
+def create_phase_img_pkt(data, img_type, srcid, quantizer=None):
     """
     Returns a GUI packet containing the reconstructed phase image
     """
-    mpkt_a = Iface.MessagePkt(img_type,
-                              srcid)
-    normData = data.reconstwave.phase/np.max(data.reconstwave.phase) * 255
-    mpkt_a.append(normData.astype(dtype=np.uint8))
-    mpkt_a.complete_packet()
-    phase_image = Iface.GuiPacket('reconst_phase', mpkt_a.to_bytes())
+    ### Phase is in [-pi, pi]
+    quantizer = quantizer if quantizer is not None else DisplayQuantizer(value_range=(-np.pi, np.pi))
+    phase_image = Iface.GuiPacket('reconst_phase',
+                                  Iface.ImageMessage(img_type, srcid,
+                                                     quantizer.quantize(data.reconstwave.phase)))
     return phase_image
 
 class Guiserver(ComponentABC):
@@ -119,6 +135,17 @@ class Guiserver(ComponentABC):
         self._servers['rawframes'] = None
         self._servers['telemetry'] = None
 
+        ### Products last advertised to the reconstructor
+        self._product_demand = None
+
+        ### Time the client statistics were last published
+        self._stats_time = 0
+        self._pack_pool = None
+
+        ### Display quantizers of the reconstructed products.  Their images are
+        ### reused from frame to frame, and are packed before the next frame.
+        self._quantizers = self.create_quantizers()
+
     def publish_status(self, status_msg=None):
         """
         Publish component status
@@ -129,6 +156,50 @@ class Guiserver(ComponentABC):
 
 
 
+    def create_quantizers(self):
+        """
+        Create the display quantizers of the amplitude, intensity and phase
+        """
+        quantizers = {}
+        for product in ['amplitude', 'intensity', 'phase']:
+            value_range = None
+            if product == 'phase' and self._meta.phase_display_range == 'fixed':
+                value_range = (-np.pi, np.pi)
+            quantizers[product] = DisplayQuantizer(scaling=self._meta.display_scaling,
+                                                   percentiles=self._meta.display_percentiles,
+                                                   per_plane=self._meta.display_per_plane,
+                                                   window=self._meta.display_window,
+                                                   value_range=value_range)
+        return quantizers
+
+    def publish_client_stats(self, interval=1.0):
+        """
+        Publish the status with the client send statistics, at most every 'interval' seconds
+        """
+        now = time.time()
+        if now - self._stats_time < interval:
+            return
+        self._stats_time = now
+
+        stats = self._meta.stats
+        for servername, server in self._servers.items():
+            stats.clients[servername] = server.client_stats()
+            stats.sent_frames[servername] = server.sent_frames
+            stats.dropped_frames[servername] = server.dropped_frames
+
+        self.publish_status()
+
+    def publish_product_demand(self):
+        """
+        Advertise the products needed by the connected clients when they change
+        """
+        products = set([product for product, servername in PRODUCT_SERVERS.items()
+                        if self._servers[servername].has_clients()])
+
+        if products != self._product_demand:
+            self._product_demand = products
+            self._pub.publish('product_demand', Iface.ProductDemand('guiserver', products))
+
     def process_reconst_product(self, data):
         """
         Process reconstruction component products and send to clients
@@ -141,68 +212,32 @@ class Guiserver(ComponentABC):
         rawb = None
         fourier = None
 
-        processing_mode = data.reconst_meta.processing_mode
-
-        rawb = prepare_raw_img_packet(data)
-
-        fourier = prepare_fourier_img_packet(data)
-
-        if processing_mode == MetaC.ReconstructionMetadata.RECONST_NONE:
-            #print('Recons processing mode = NONE')
-            pass
-        elif processing_mode == MetaC.ReconstructionMetadata.RECONST_AMP:
-            #print('Recons processing mode = AMP')
-            amp_image = create_amp_img_pkt(data,
-                                           Iface.IMAGE_TYPE,
-                                           Iface.SRCID_IMAGE_AMPLITUDE)
-
-        elif processing_mode == MetaC.ReconstructionMetadata.RECONST_INTENSITY:
-
-            #print('Recons processing mode = INTENSITY')
-            intensity_image = create_int_img_pkt(data,
-                                                 Iface.IMAGE_TYPE,
-                                                 Iface.SRCID_IMAGE_INTENSITY)
-
-        elif processing_mode == MetaC.ReconstructionMetadata.RECONST_PHASE:
+        products = MetaC.ReconstructionMetadata.MODE_PRODUCTS[data.reconst_meta.processing_mode]
 
-            #print('Recons processing mode = PHASE')
-            phase_image = create_phase_img_pkt(data,
-                                               Iface.IMAGE_TYPE,
-                                               Iface.SRCID_IMAGE_PHASE)
+        ### Only serialize the images connected clients look at
+        if self._servers['rawframes'].has_clients():
+            rawb = prepare_raw_img_packet(data)
 
-        elif processing_mode == MetaC.ReconstructionMetadata.RECONST_AMP_AND_PHASE:
+        if self._servers['fourier'].has_clients():
+            fourier = prepare_fourier_img_packet(data)
 
-            #print('Recons processing mode = RECONST_AMP_AND_PHASE')
+        if 'amplitude' in products and self._servers['reconst_amp'].has_clients():
             amp_image = create_amp_img_pkt(data,
                                            Iface.IMAGE_TYPE,
-                                           Iface.SRCID_IMAGE_AMPLITUDE)
-            phase_image = create_phase_img_pkt(data,
-                                               Iface.IMAGE_TYPE,
-                                               Iface.SRCID_IMAGE_PHASE)
-
-        elif processing_mode == MetaC.ReconstructionMetadata.RECONST_INT_AND_PHASE:
+                                           Iface.SRCID_IMAGE_AMPLITUDE,
+                                           self._quantizers['amplitude'])
 
-            #print('Recons processing mode = RECONST_INT_AND_PHASE')
+        if 'intensity' in products and self._servers['reconst_intensity'].has_clients():
             intensity_image = create_int_img_pkt(data,
                                                  Iface.IMAGE_TYPE,
-                                                 Iface.SRCID_IMAGE_INTENSITY)
-            phase_image = create_phase_img_pkt(data,
-                                               Iface.IMAGE_TYPE,
-                                               Iface.SRCID_IMAGE_PHASE)
-
-        elif processing_mode == MetaC.ReconstructionMetadata.RECONST_ALL:
+                                                 Iface.SRCID_IMAGE_INTENSITY,
+                                                 self._quantizers['intensity'])
 
-            #print('Recons processing mode = ALL')
-            amp_image = create_amp_img_pkt(data,
-                                           Iface.IMAGE_TYPE,
-                                           Iface.SRCID_IMAGE_AMPLITUDE)
-            intensity_image = create_int_img_pkt(data,
-                                                 Iface.IMAGE_TYPE,
-                                                 Iface.SRCID_IMAGE_INTENSITY)
+        if 'phase' in products and self._servers['reconst_phase'].has_clients():
             phase_image = create_phase_img_pkt(data,
                                                Iface.IMAGE_TYPE,
-                                               Iface.SRCID_IMAGE_PHASE)
-
+                                               Iface.SRCID_IMAGE_PHASE,
+                                               self._quantizers['phase'])
 
         self.send_images_to_clients(rawb, fourier, amp_image, intensity_image, phase_image)
 
@@ -282,11 +317,10 @@ class Guiserver(ComponentABC):
         """
         Get raw image from data, serialize it and send to all clients
         """
-        msg_pkt = Iface.MessagePkt(Iface.IMAGE_TYPE, Iface.SRCID_IMAGE_RAW)
         _, image = data.get_img()
-        msg_pkt.append(image)
-        msg_pkt.complete_packet()
-        raw_b = Iface.GuiPacket('rawframes', msg_pkt.to_bytes())
+        raw_b = Iface.GuiPacket('rawframes', Iface.ImageMessage(Iface.IMAGE_TYPE,
+                                                                Iface.SRCID_IMAGE_RAW,
+                                                                image))
         self._servers[raw_b.servername].send_to_all_clients(raw_b.data)
 
     def process_metadata(self, data):
@@ -309,37 +343,80 @@ class Guiserver(ComponentABC):
         Create image servers that will serve the associated images to the connected clients.
         Each image has a server:  Amplitude, Intensity, Phase, Fourier, Raw images, and Telemetry
         """
+        ### Encodes the images of the different client views in parallel
+        self._pack_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._meta.encode_workers)
+
+        if self._meta.server_core == 'asyncio':
+            self.create_async_image_servers()
+            return
+
         self._servers['reconst_amp'] = Svr(self._meta.ports['reconst_amp'],
                                            host=self._meta.hostname,
                                            verbose=True,
                                            timeout=0.1,
+                                           queue_depth=self._meta.client_queue_depth,
+                                           parse_request=parse_view_request,
+                                           pack_pool=self._pack_pool,
                                           )
         self._servers['reconst_intensity'] = Svr(self._meta.ports['reconst_intensity'],
                                                  host=self._meta.hostname,
                                                  verbose=True,
                                                  timeout=0.1,
+                                                 queue_depth=self._meta.client_queue_depth,
+                                                 parse_request=parse_view_request,
+                                                 pack_pool=self._pack_pool,
                                                 )
         self._servers['reconst_phase'] = Svr(self._meta.ports['reconst_phase'],
                                              host=self._meta.hostname,
                                              verbose=True,
                                              timeout=0.1,
+                                             queue_depth=self._meta.client_queue_depth,
+                                             parse_request=parse_view_request,
+                                             pack_pool=self._pack_pool,
                                             )
         self._servers['fourier'] = Svr(self._meta.ports['fourier'],
                                        host=self._meta.hostname,
                                        verbose=True,
                                        timeout=0.1,
+                                       queue_depth=self._meta.client_queue_depth,
+                                       parse_request=parse_view_request,
+                                       pack_pool=self._pack_pool,
                                       )
         self._servers['rawframes'] = Svr(self._meta.ports['raw_frames'],
                                          host=self._meta.hostname,
                                          verbose=True,
                                          timeout=0.1,
+                                         queue_depth=self._meta.client_queue_depth,
+                                         parse_request=parse_view_request,
+                                         pack_pool=self._pack_pool,
                                         )
         self._servers['telemetry'] = Svr(self._meta.ports['telemetry'],
                                          host=self._meta.hostname,
                                          verbose=True,
                                          timeout=0.1,
+                                         queue_depth=self._meta.telemetry_queue_depth,
                                         )
 
+    def create_async_image_servers(self):
+        """
+        Serve all the images and the telemetry from one event loop.  Each keeps
+        its port, and the multiplex port serves several over one connection.
+        """
+        ports = {servername:self._meta.ports[portname] for servername, portname in SERVER_PORTS.items()}
+        queue_depths = {servername:self._meta.client_queue_depth for servername in SERVER_PORTS}
+        queue_depths['telemetry'] = self._meta.telemetry_queue_depth
+
+        core = AsyncServerCore(ports,
+                               host=self._meta.hostname,
+                               queue_depths=queue_depths,
+                               multiplex_port=self._meta.multiplex_port or None,
+                               parse_request=parse_view_request,
+                               pack_pool=self._pack_pool,
+                               verbose=True,
+                              )
+        for servername in SERVER_PORTS:
+            self._servers[servername] = core.channel(servername)
+
     def start_image_servers(self):
         """
         Start running the image servers
@@ -354,6 +431,10 @@ class Guiserver(ComponentABC):
         """
 
 
+        ### Clients connect and disconnect between messages
+        self.publish_product_demand()
+        self.publish_client_stats()
+
         ### Process command
         if isinstance(data, Iface.Command):
             self.process_command(data)
@@ -362,13 +443,21 @@ class Guiserver(ComponentABC):
 #
         ### Process Reconstruction procduct
         elif isinstance(data, Iface.ReconstructorProduct):
-            self.process_reconst_product(data)
+            data.attach()
+            try:
+                self.process_reconst_product(data)
+            finally:
+                data.release(self._pub)
 #
 #                ### Process image (from camera streamer)
         elif isinstance(data, Iface.Image):
-            if self._reconst_meta.processing_mode == MetaC.ReconstructionMetadata.RECONST_NONE:
-                self.process_image(data)
-            #else ## image data should be coming in from the Reconstruction Product type
+            try:
+                if self._reconst_meta.processing_mode == MetaC.ReconstructionMetadata.RECONST_NONE\
+                   and self._servers['rawframes'].has_clients():
+                    self.process_image(data)
+                #else ## image data should be coming in from the Reconstruction Product type
+            finally:
+                data.release(self._pub)
 
         elif isinstance(data, Iface.MetadataPacket):
             self.process_metadata(data)
@@ -423,6 +512,8 @@ class Guiserver(ComponentABC):
 
             self.start_image_servers()
 
+            self.publish_product_demand()
+
             self.notify_controller_and_wait()
 
             self.start_heartbeat()
@@ -0,0 +1,151 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	image_views.py
+#  author:	S. Felipe Fregoso
+#  description:	Views of the images requested by the GUI clients.  A view is a
+#               region of interest, a decimation factor, the propagation
+#               distance and wavelength plane of the reconstructed images,
+#               and the codec the images are encoded with.
+#
+#               Clients request a view with a text line on their connection:
+#
+#                   view [channel ...] [decimation=4] [roi=x,y,width,height] [plane=z,l]
+#                        [codec=none|zlib|lz4|png|jpeg] [level=n]
+#
+#               Without channels the view applies to all channels of the
+#               connection.  'view' alone restores the full images.
+###############################################################################
+"""
+
+### Codecs of the interface.IMAGE_COMPRESSED_TYPE messages
+CODECS = ['none', 'zlib', 'lz4', 'png', 'jpeg']
+
+class ImageView():
+    """
+    View of the images sent to a client
+    """
+    def __init__(self, decimation=1, roi=None, plane=None, codec='none', level=None):
+        # pylint: disable=too-many-arguments
+        """
+        Constructor
+
+        Parameters
+        ----------
+        decimation : int
+            Keep every 'decimation' rows and columns
+        roi : tuple or None
+            (x, y, width, height) of the region of interest in image pixels,
+            x being the column and y the row.  None for the whole image.
+        plane : tuple or None
+            (propagation distance, wavelength) indices of the plane of the
+            4D reconstructed images.  None for all planes.  2D images
+            have a single plane and ignore it.
+        codec : str
+            Codec of the images, one of CODECS.  zlib and lz4 are lossless,
+            png and jpeg encode single plane images, and jpeg is lossy.
+        level : int or None
+            Compression level, or JPEG quality.  Codec default if None.
+        """
+        if int(decimation) < 1:
+            raise ValueError('View decimation must be >= 1')
+        if roi is not None and (len(roi) != 4 or min(roi) < 0 or min(roi[2:]) < 1):
+            raise ValueError('View roi must be x,y,width,height')
+        if plane is not None and (len(plane) != 2 or min(plane) < 0):
+            raise ValueError('View plane must be z,l')
+        if codec not in CODECS:
+            raise ValueError('View codec must be one of %s'%(CODECS))
+
+        self.decimation = int(decimation)
+        self.roi = tuple(int(val) for val in roi) if roi is not None else None
+        self.plane = tuple(int(val) for val in plane) if plane is not None else None
+        self.codec = codec
+        self.level = int(level) if level is not None else None
+
+    def key(self):
+        """
+        Clients with the same key are sent the same packet
+        """
+        return (self.decimation, self.roi, self.plane, self.codec, self.level)
+
+    def is_full(self):
+        """
+        Returns TRUE if the view is the whole image, not encoded
+        """
+        return self.key() == (1, None, None, 'none', None)
+
+    def apply(self, image):
+        """
+        Return the view of the image, without copy
+
+        Parameters
+        ----------
+        image : np.array
+            2D image or 4D (rows, columns, distance, wavelength) reconstructed image
+        """
+        rows, cols = slice(None), slice(None)
+        if self.roi is not None:
+            col, row, width, height = self.roi
+            rows, cols = slice(row, row + height), slice(col, col + width)
+
+        view = image[rows, cols]
+        if self.decimation > 1:
+            view = view[::self.decimation, ::self.decimation]
+
+        ### Plane indices out of range keep the last plane
+        if self.plane is not None and image.ndim == 4:
+            dist = min(self.plane[0], image.shape[2] - 1)
+            wavelength = min(self.plane[1], image.shape[3] - 1)
+            view = view[:, :, dist:dist + 1, wavelength:wavelength + 1]
+
+        return view
+
+    def __repr__(self):
+        return 'ImageView(decimation=%d, roi=%s, plane=%s, codec=%s, level=%s)'%self.key()
+
+def parse_view_request(line):
+    """
+    Parse a view request line
+
+    Returns
+    -------
+    (list, ImageView) or None
+        Channels and view of the request, None if the line isn't a view request.
+
+    Raises
+    ------
+    ValueError
+        Badly formed view request
+    """
+    words = line.split()
+    if not words or words[0].lower() != 'view':
+        return None
+
+    channels = []
+    params = {}
+    for word in words[1:]:
+        if '=' not in word:
+            channels.append(word)
+            continue
+        name, value = word.split('=', 1)
+        name = name.lower()
+        if name in ('decimation', 'level'):
+            params[name] = int(value)
+        elif name == 'codec':
+            params[name] = value.lower()
+        elif name in ('roi', 'plane'):
+            params[name] = [int(val) for val in value.split(',')]
+        else:
+            raise ValueError('Unknown view parameter [%s]'%(name))
+
+    return channels, ImageView(**params)
@@ -16,13 +16,41 @@
 #  description:	Contains classes of objects used as messages between components
 ###############################################################################
 """
+import io
+import copy
+import zlib
 import struct
 import functools
 import numpy as np
 
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
 CMD_TYPE = 1 #1 << 12
 TELEMETRY_TYPE = 2 #2 << 12
 IMAGE_TYPE = 3 #3 << 12
+### Image whose data is encoded.  The codec id follows the dimensions.
+IMAGE_COMPRESSED_TYPE = 4
+
+### Image codecs.  PNG and JPEG encode single plane images.
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+CODEC_PNG = 3
+CODEC_JPEG = 4
+CODEC_IDS = {'none':CODEC_NONE,
+             'zlib':CODEC_ZLIB,
+             'lz4':CODEC_LZ4,
+             'png':CODEC_PNG,
+             'jpeg':CODEC_JPEG,
+            }
 
 SRCID_IMAGE_RAW = 0
 SRCID_IMAGE_FOURIER = 1
@@ -188,6 +216,135 @@ class MessagePkt():
         """
         return bytearray(self.pkt)
 
+    def to_buffers(self):
+        """
+        Return the header and the data of the packet as separate buffers,
+        so the data is sent without being copied behind the header.
+        Replaces complete_packet and to_bytes.
+        """
+        return (self.msg_hdr_struct.pack(*self.msg_hdr, len(self.databin)), self.databin)
+
+def encode_image(codec, image, level=None):
+    """
+    Encode uint8 image with the codec
+
+    Parameters
+    ----------
+    codec : int
+        CODEC_ZLIB, CODEC_LZ4, CODEC_PNG or CODEC_JPEG
+    image : np.array
+        uint8 image.  PNG and JPEG need a single plane.
+    level : int or None
+        Compression level, or JPEG quality.  Codec default if None.
+
+    Returns
+    -------
+    bytes or None
+        None if the codec can't encode the image or isn't installed
+    """
+    if image.dtype != np.uint8:
+        return None
+
+    if codec == CODEC_ZLIB:
+        return zlib.compress(np.ascontiguousarray(image), 1 if level is None else level)
+
+    if codec == CODEC_LZ4:
+        if lz4frame is None:
+            return None
+        return lz4frame.compress(np.ascontiguousarray(image),
+                                 compression_level=0 if level is None else level)
+
+    if codec in (CODEC_PNG, CODEC_JPEG):
+        plane = image.reshape(image.shape[:2]) if image.size == np.prod(image.shape[:2]) else None
+        if PILImage is None or plane is None:
+            return None
+        fid = io.BytesIO()
+        if codec == CODEC_PNG:
+            PILImage.fromarray(plane).save(fid, format='PNG', compress_level=1 if level is None else level)
+        else:
+            PILImage.fromarray(plane).save(fid, format='JPEG', quality=90 if level is None else level)
+        return fid.getvalue()
+
+    return None
+
+def unpack_compressed_image(data, offset, dimensions):
+    """
+    Decode the image of an IMAGE_COMPRESSED_TYPE message
+
+    Parameters
+    ----------
+    data : bytes-like
+        Message
+    offset : int
+        Offset of the codec id, right after the dimensions
+    dimensions : tuple
+        Dimensions of the image
+
+    Returns
+    -------
+    np.array of uint8
+    """
+    codec = struct.unpack_from('H', data, offset)[0]
+    encoded = bytes(data[offset + struct.calcsize('H'):])
+
+    if codec == CODEC_ZLIB:
+        decoded = zlib.decompress(encoded)
+    elif codec == CODEC_LZ4:
+        if lz4frame is None:
+            raise ValueError('lz4 codec is not installed')
+        decoded = lz4frame.decompress(encoded)
+    elif codec in (CODEC_PNG, CODEC_JPEG):
+        if PILImage is None:
+            raise ValueError('PIL is needed to decode PNG and JPEG images')
+        return np.asarray(PILImage.open(io.BytesIO(encoded))).reshape(dimensions)
+    else:
+        raise ValueError('Unknown image codec [%d]'%(codec))
+
+    return np.frombuffer(decoded, dtype=np.uint8).reshape(dimensions)
+
+class ImageMessage():
+    """
+    Image sent to the GUI clients.  It is packed as a MessagePkt once
+    for each distinct view the clients requested.
+    """
+    def __init__(self, msg_id, src_id, image):
+        """
+        Constructor
+        """
+        self.msg_id = msg_id
+        self.src_id = src_id
+        self.image = image
+
+    def to_buffers(self, view=None):
+        """
+        Return the header and data buffers of the packet of the view
+
+        The image is encoded with the codec of the view into an
+        IMAGE_COMPRESSED_TYPE packet.  It is sent as is if the codec
+        can't encode it.
+
+        Parameters
+        ----------
+        view : image_views.ImageView or None
+            View of the image, None for the whole image
+        """
+        image = self.image if view is None else view.apply(self.image)
+
+        encoded = None
+        if view is not None and CODEC_IDS.get(view.codec, CODEC_NONE) != CODEC_NONE:
+            codec = CODEC_IDS[view.codec]
+            encoded = encode_image(codec, image, view.level)
+
+        if encoded is None:
+            pkt = MessagePkt(self.msg_id, self.src_id)
+            pkt.append(image)
+            return pkt.to_buffers()
+
+        pkt = MessagePkt(IMAGE_COMPRESSED_TYPE, self.src_id)
+        pkt.append(pkt.ndim_struct.pack(image.ndim) + struct.pack('H' * image.ndim, *image.shape)
+                   + struct.pack('H', codec) + encoded)
+        return pkt.to_buffers()
+
 ### Used for packets that from the DHM_Streaming software
 class CamServerFramePkt():
     """
@@ -288,12 +445,16 @@ class Image():
     """
     Class to contain an image as its sent to components
     """
-    def __init__(self, meta=None, img=None):
+    def __init__(self, meta=None, img=None, shared=None):
         """
         Constructor
+
+        If 'shared' (shared_frames.SlotDescriptor) is set the image is in
+        shared memory and 'img' is None until 'get_img' is called.
         """
         self._meta = meta
         self._img = img
+        self.shared = shared
 
     def set_img(self, meta, img):
         """
@@ -306,12 +467,27 @@ class Image():
         """
         Return the image with its metadata
         """
+        if self._img is None and self.shared is not None:
+            self._img = self.shared.views()['image']
         return (self._meta, self._img)
 
+    def release(self, pub):
+        """
+        Acknowledge the shared memory slot of the image, if any.
+        The image must not be used afterwards.
+        """
+        if self.shared is not None:
+            self._img = None
+            pub.publish(self.shared.ack_id, self.shared)
+            self.shared = None
+
 class ReconstructorProduct():
     """
     Class used to contain the reconstruction products as sent to the components
     """
+    ### Arrays of the reconstructed wave passed through shared memory
+    WAVE_ARRAYS = ('reconstructed_wave', '_amplitude_image', '_intensity_image', '_phase_image')
+
     #def __init__(self, image, hologram, ft_hologram, reconstwave, reconst_meta, holo_meta):
     def __init__(self, image, ft_hologram, reconstwave, reconst_meta, holo_meta):
         """
@@ -324,6 +500,56 @@ class ReconstructorProduct():
         self.reconstwave = reconstwave
         self.reconst_meta = reconst_meta
         self.holo_meta = holo_meta
+        self.shared = None
+
+    def arrays(self):
+        """
+        Return dictionary of the arrays of the product which are not None
+        """
+        arrays = {'image':self.image, 'ft_hologram':self.ft_hologram}
+        for name in self.WAVE_ARRAYS:
+            arrays[name] = getattr(self.reconstwave, name, None)
+
+        return {name:arr for name, arr in arrays.items() if arr is not None}
+
+    def shared_copy(self, shared):
+        """
+        Return copy of the product without its arrays, which are in the
+        shared memory slot described by 'shared'
+        """
+        reconstwave = copy.copy(self.reconstwave)
+        for name in self.WAVE_ARRAYS:
+            setattr(reconstwave, name, None)
+
+        product = ReconstructorProduct(None, None, reconstwave, self.reconst_meta, self.holo_meta)
+        product.shared = shared
+        return product
+
+    def attach(self):
+        """
+        Point the arrays of the product to its shared memory slot, if any
+        """
+        if self.shared is None:
+            return
+
+        for name, arr in self.shared.views().items():
+            if name in self.WAVE_ARRAYS:
+                setattr(self.reconstwave, name, arr)
+            else:
+                setattr(self, name, arr)
+
+    def release(self, pub):
+        """
+        Acknowledge the shared memory slot of the product, if any.
+        The arrays must not be used afterwards.
+        """
+        if self.shared is not None:
+            self.image = None
+            self.ft_hologram = None
+            for name in self.WAVE_ARRAYS:
+                setattr(self.reconstwave, name, None)
+            pub.publish(self.shared.ack_id, self.shared)
+            self.shared = None
 
     def get_reconst_product(self):
         """
@@ -382,6 +608,33 @@ class GuiPacket():
         return self.data
 
 
+class ProductDemand():
+    """
+    Class of the "product_demand" message.
+
+    Sent by a component when the set of reconstruction products it
+    needs changes, so the reconstructor only computes what is used
+    """
+    def __init__(self, name, products):
+        """
+        Constructor
+        """
+        self._name = name
+        self._products = frozenset(products)
+
+    def get_name(self):
+        """
+        Return name of the component
+        """
+        return self._name
+
+    def get_products(self):
+        """
+        Return set of the product names needed
+        """
+        return self._products
+
+
 class MetadataPacket():
     """
     Class to contain metadata as used to pass to components
@@ -0,0 +1,260 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	kernel_cache.py
+#  author:	S. Felipe Fregoso
+#  description:	Byte budgeted LRU cache of propagation kernels (G factors)
+#               with an optional backing store so kernels computed in
+#               earlier sessions are not recomputed.
+#               The backing store has its own byte budget.
+###############################################################################
+"""
+import os
+import time
+import json
+import hashlib
+import tempfile
+import collections
+import numpy as np
+from shampoo_lite.sparse_kernel import SparseKernel
+
+### Temporary files older than this many seconds are left over from failed writes
+STALE_TMP_SECONDS = 3600
+
+class KernelCache():
+    """
+    Propagation kernel cache
+
+    Kernels are kept in memory in least recently used order.  When the
+    total size of the cached kernels exceeds 'max_bytes' the least recently
+    used kernels are evicted.  If 'cache_dir' is set, kernels written with
+    'store' are saved to '<cache_dir>/<key>.npy', or '<key>.npz' for sparse
+    kernels, and kernels missing from memory are loaded from there, dense
+    kernels memory mapped.  When the files of the backing store exceed
+    'max_disk_bytes' the least recently used files are deleted.  The
+    backing store is optional, a failed write only leaves the kernel in memory.
+    """
+    def __init__(self, max_bytes=2*1024**3, cache_dir=None, max_disk_bytes=8*1024**3,
+                 verbose=False):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum number of bytes of kernels kept in memory
+        cache_dir : str or None
+            Directory of the backing store.  None disables it.
+        max_disk_bytes : int
+            Maximum number of bytes of kernel files kept in 'cache_dir'
+        verbose : boolean
+            If TRUE print detail information to terminal, FALSE otherwise.
+        """
+        self._max_bytes = max_bytes
+        self._cache_dir = cache_dir
+        self._max_disk_bytes = max_disk_bytes
+        self._verbose = verbose
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_loads = 0
+        self.disk_evictions = 0
+        self.disk_write_errors = 0
+
+        if self._cache_dir:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            self._prune_disk()
+
+    @staticmethod
+    def make_key(**params):
+        """
+        Return a stable hash key of the kernel parameters
+
+        Values are converted to lists of floats so the key does not depend on
+        the container type (list, tuple, np.array) or on the session.
+        """
+        normalized = {}
+        for name, value in params.items():
+            normalized[name] = [float(v) for v in np.atleast_1d(value).reshape(-1)]
+
+        keystr = json.dumps(normalized, sort_keys=True)
+        return hashlib.sha1(keystr.encode('utf-8')).hexdigest()
+
+    def _filepath(self, key, sparse=False):
+        """
+        Return the path of the backing store file of 'key'
+        """
+        return os.path.join(self._cache_dir, key + ('.npz' if sparse else '.npy'))
+
+    def _load(self, key):
+        """
+        Return the kernel of the backing store file of 'key' or None if there's none
+        """
+        for sparse in [False, True]:
+            path = self._filepath(key, sparse=sparse)
+            if not os.path.exists(path):
+                continue
+            kernel = SparseKernel.load(path) if sparse else np.load(path, mmap_mode='r')
+            ### The modification time orders the files of the backing store by use
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return kernel
+
+        return None
+
+    def _insert(self, key, kernel):
+        """
+        Add kernel to the in-memory cache and evict the least recently used
+        kernels until the cache fits in the byte budget.  The newest kernel
+        is always kept.
+        """
+        self._entries[key] = kernel
+        self._nbytes += kernel.nbytes
+
+        while self._nbytes > self._max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Return the kernel stored under 'key' or None if it is not cached
+        """
+        kernel = self._entries.get(key)
+        if kernel is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return kernel
+
+        kernel = self._load(key) if self._cache_dir else None
+        if kernel is not None:
+            self._insert(key, kernel)
+            self.hits += 1
+            self.disk_loads += 1
+            if self._verbose:
+                print('Kernel cache: Loaded [%s] from disk'%(key))
+            return kernel
+
+        self.misses += 1
+        return None
+
+    def put(self, key, kernel):
+        """
+        Add kernel to the in-memory cache
+        """
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key).nbytes
+
+        self._insert(key, kernel)
+
+    def store(self, key, kernel):
+        """
+        Write kernel to the backing store if enabled, then delete the least
+        recently used files over the disk budget
+
+        Doesn't touch the in-memory cache, so callers sharing the cache behind
+        a lock can write the file after releasing it.
+        """
+        if not self._cache_dir:
+            return
+
+        sparse = isinstance(kernel, SparseKernel)
+
+        ### Write to a temporary file first so readers never see partial files
+        tmppath = None
+        try:
+            fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=self._cache_dir)
+            with os.fdopen(fd, 'wb') as fid:
+                if sparse:
+                    kernel.save(fid)
+                else:
+                    np.save(fid, kernel)
+            os.replace(tmppath, self._filepath(key, sparse=sparse))
+        except OSError as err:
+            if tmppath is not None:
+                try:
+                    os.remove(tmppath)
+                except OSError:
+                    pass
+            if self.disk_write_errors == 0:
+                print('Kernel cache: Failed to write [%s] to [%s] due to error [%s]. '
+                      'Kernels are kept in memory only.'%(key, self._cache_dir, repr(err)))
+            self.disk_write_errors += 1
+            return
+
+        self._prune_disk(keep=self._filepath(key, sparse=sparse))
+
+    def _prune_disk(self, keep=None):
+        """
+        Delete the oldest kernel files until the backing store fits in the
+        disk budget, and the temporary files of failed writes.  The file
+        'keep' is never deleted.
+        """
+        files = []
+        total = 0
+        now = time.time()
+        try:
+            entries = list(os.scandir(self._cache_dir))
+        except OSError:
+            return
+
+        for entry in entries:
+            try:
+                stat = entry.stat()
+                ### Temporary files being written are recent
+                if entry.name.endswith('.tmp') and now - stat.st_mtime > STALE_TMP_SECONDS:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+            if entry.name.endswith(('.npy', '.npz')):
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        for _, size, path in sorted(files):
+            if total <= self._max_disk_bytes:
+                break
+            if path == keep:
+                continue
+            ### Another process may have deleted it already
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.disk_evictions += 1
+            if self._verbose:
+                print('Kernel cache: Deleted [%s] from disk'%(path))
+
+    def clear(self):
+        """
+        Remove all kernels from memory.  The backing store is left intact.
+        """
+        self._entries.clear()
+        self._nbytes = 0
+
+    def nbytes(self):
+        """
+        Return number of bytes of kernels held in the cache
+        """
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
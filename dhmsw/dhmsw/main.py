@@ -71,6 +71,13 @@ def make_pubsub_connections(_qs):
     # Subscribe to RECONSTRUCTION PRODUCTS
     pub.subscribe('reconst_product', _qs['guiserver_inq'])
 
+    ### Acknowledgements of the shared memory slots of frames and products
+    pub.subscribe('rawframe_ack', _qs['framesource_inq'])
+    pub.subscribe('reconst_product_ack', _qs['reconstructor_inq'])
+
+    ### Products needed by the components
+    pub.subscribe('product_demand', _qs['reconstructor_inq'])
+
     pub.subscribe('reconst_done', _qs['framesource_inq'])
     pub.subscribe('reconst_done', _qs['controller_inq'])
 
@@ -179,6 +179,25 @@ class GuiserverMetadata(MetadataABC):
 
         self.hostname = '127.0.0.1'
         self.maxclients = 5
+        ### Messages waiting for each client before the oldest is dropped
+        self.client_queue_depth = 1
+        self.telemetry_queue_depth = 64
+        ### Server core, 'asyncio' or 'select', and port of the clients of several channels
+        self.server_core = 'asyncio'
+        self.multiplex_port = 9999
+        ### Threads encoding the images of the different client views
+        self.encode_workers = 2
+        ### Display quantization of the reconstructed products:  'minmax' or
+        ### 'percentile' range, per (distance, wavelength) plane, and frames
+        ### of the running auto-contrast window.  The phase uses the fixed
+        ### [-pi, pi] range or the same scaling as the other products.
+        self.display_scaling = 'minmax'
+        self.display_percentiles = (1., 99.)
+        self.display_per_plane = False
+        self.display_window = 1
+        self.phase_display_range = 'fixed'
+        ### Client send statistics
+        self.stats = self.StatisticsMetadata()
         self.status_msg = ''
 
         self.load_config(configfile)
@@ -219,6 +238,30 @@ class GuiserverMetadata(MetadataABC):
             reconst_phase_port = config.getint(key, 'reconst_phase_port', fallback=9998)
             host = config.get(key, 'host', fallback='127.0.0.1')
             maxclients = config.getint(key, 'maxclients', fallback=5)
+            client_queue_depth = config.getint(key, 'client_queue_depth', fallback=1)
+            telemetry_queue_depth = config.getint(key, 'telemetry_queue_depth', fallback=64)
+            server_core = config.get(key, 'server_core', fallback='asyncio')
+            multiplex_port = config.getint(key, 'multiplex_port', fallback=9999)
+            encode_workers = config.getint(key, 'encode_workers', fallback=2)
+            display_scaling = config.get(key, 'display_scaling', fallback='minmax')
+            display_percentiles_str = config.get(key, 'display_percentiles', fallback='1,99')
+            display_percentiles = tuple([float(p) for p in display_percentiles_str.split(',')])
+            display_per_plane = config.getboolean(key, 'display_per_plane', fallback=False)
+            display_window = config.getint(key, 'display_window', fallback=1)
+            phase_display_range = config.get(key, 'phase_display_range', fallback='fixed')
+            if server_core not in ['asyncio', 'select']:
+                print('Unknown server_core [%s].  Using "asyncio".'%(server_core))
+                server_core = 'asyncio'
+            if display_scaling not in ['minmax', 'percentile']:
+                print('Unknown display_scaling [%s].  Using "minmax".'%(display_scaling))
+                display_scaling = 'minmax'
+            if len(display_percentiles) != 2 or \
+               not 0 <= display_percentiles[0] < display_percentiles[1] <= 100:
+                print('Invalid display_percentiles [%s].  Using "1,99".'%(display_percentiles_str))
+                display_percentiles = (1., 99.)
+            if phase_display_range not in ['fixed', 'scaled']:
+                print('Unknown phase_display_range [%s].  Using "fixed".'%(phase_display_range))
+                phase_display_range = 'fixed'
 
             self.ports['fourier'] = fourier_port
             self.ports['reconst_amp'] = reconst_amp_port
@@ -228,17 +271,48 @@ class GuiserverMetadata(MetadataABC):
             self.ports['reconst_phase'] = reconst_phase_port
             self.hostname = host
             self.maxclients = maxclients
+            self.client_queue_depth = client_queue_depth
+            self.telemetry_queue_depth = telemetry_queue_depth
+            self.server_core = server_core
+            self.multiplex_port = multiplex_port
+            self.encode_workers = max(1, encode_workers)
+            self.display_scaling = display_scaling
+            self.display_percentiles = display_percentiles
+            self.display_per_plane = display_per_plane
+            self.display_window = max(1, display_window)
+            self.phase_display_range = phase_display_range
 
         except configparser.Error as err:
             print('File read error:  [%s] due to error [%s]. Key=[%s].'\
                   %(filepath, repr(err), key))
 
+    class StatisticsMetadata(MetadataABC):
+        """
+        Guiserver Statistics Metadata Class
+        """
+        def __init__(self):
+            """
+            Constructor
+            """
+            ### Counters of each connected client by server name
+            self.clients = {}
+            ### Messages sent and dropped by each server, including disconnected clients
+            self.sent_frames = {}
+            self.dropped_frames = {}
+
+        def load_config(self, filepath):
+            """
+            Read the config file and load data pertaining to this metadata
+            """
+
 class DataloggerMetadata(MetadataABC):
     """
     Data logger metadata class
     """
     def __init__(self, configfile=None):
         self.enabled = True
+        ### Reconstruction products logged, e.g. ['amplitude', 'phase']
+        self.products = []
         self.status_msg = ''
 
         self.load_config(configfile)
@@ -266,7 +340,10 @@ class DataloggerMetadata(MetadataABC):
                 raise ValueError("File [%s] doesn't exist."%(filepath))
 
             enabled = config.getboolean(key, 'enabled', fallback=False)
+            products_str = config.get(key, 'products', fallback='')
+            products = [p.strip() for p in products_str.split(',') if p.strip()]
             self.enabled = enabled
+            self.products = products
 
         except configparser.Error as err:
             print('File read error:  [%s] due to error [%s]. Key=[%s].'\
@@ -402,6 +479,18 @@ class FramesourceMetadata(MetadataABC):
         self.file = {}
         self.file['datadir'] = '/proj/dhm/sfregoso/git_repos/dhmsw/simulated_frames/*.bmp'
         self.file['currentfile'] = '/proj/dhm/sfregoso/git_repos/dhmsw/simulated_frames/*.bmp'
+        ### Frames in flight through shared memory. 0 sends frames through the queues
+        self.shared_memory_slots = 4
+        ### Replay of file frames ['paced', 'max', 'timestamps']
+        self.file_replay = 'paced'
+        ### Frames read ahead and the threads reading them
+        self.file_prefetch_depth = 4
+        self.file_prefetch_workers = 2
+        ### Shape and pixel type of headerless raw frame files
+        self.raw_frame_shape = (2048, 2048)
+        self.raw_frame_dtype = 'uint8'
+        ### Camera receive statistics
+        self.stats = self.StatisticsMetadata()
         self.status_msg = ''
 
         self.load_config(configfile)
@@ -428,12 +517,52 @@ class FramesourceMetadata(MetadataABC):
                 raise ValueError("File [%s] doesn't exist."%(filepath))
 
             datadir = config.get(key, 'datadir', fallback='')
+            shared_memory_slots = config.getint(key, 'shared_memory_slots', fallback=4)
+            file_replay = config.get(key, 'file_replay', fallback='paced')
+            file_prefetch_depth = config.getint(key, 'file_prefetch_depth', fallback=4)
+            file_prefetch_workers = config.getint(key, 'file_prefetch_workers', fallback=2)
+            raw_frame_shape_str = config.get(key, 'raw_frame_shape', fallback='2048, 2048')
+            raw_frame_shape = tuple([int(n) for n in raw_frame_shape_str.split(',')])
+            raw_frame_dtype = config.get(key, 'raw_frame_dtype', fallback='uint8')
+
+            if file_replay not in ['paced', 'max', 'timestamps']:
+                print('Unknown file_replay [%s].  Using "paced".'%(file_replay))
+                file_replay = 'paced'
+
             self.datadir = datadir
+            self.shared_memory_slots = shared_memory_slots
+            self.file_replay = file_replay
+            self.file_prefetch_depth = file_prefetch_depth
+            self.file_prefetch_workers = file_prefetch_workers
+            self.raw_frame_shape = raw_frame_shape
+            self.raw_frame_dtype = raw_frame_dtype
 
         except configparser.Error as err:
             print('File read error:  [%s] due to error [%s]. Key=[%s].'\
                   %(filepath, repr(err), key))
 
+    class StatisticsMetadata(MetadataABC):
+        """
+        Framesource Statistics Metadata Class
+        """
+        def __init__(self):
+            """
+            Constructor
+            """
+            ### Frames and bytes received from the camera server
+            self.camera_frames = 0
+            self.camera_bytes = 0
+            ### Frames received straight into shared memory
+            self.camera_frames_shared = 0
+            ### Receive rates over the last second
+            self.camera_fps = 0.
+            self.camera_mbps = 0.
+
+        def load_config(self, filepath):
+            """
+            Read the config file and load data pertaining to this metadata
+            """
+
 class WatchdogMetadata(MetadataABC):
     """
     Watchdog Metadata Class
@@ -524,6 +653,16 @@ class ReconstructionMetadata(MetadataABC):
     RECONST_INT_AND_PHASE = 5  # Compute intensity and phase only
     RECONST_ALL = 6  # Compute both everything
 
+    ### Products of each processing mode
+    MODE_PRODUCTS = {RECONST_NONE:(),
+                     RECONST_AMP:('amplitude',),
+                     RECONST_PHASE:('phase',),
+                     RECONST_INTENSITY:('intensity',),
+                     RECONST_AMP_AND_PHASE:('amplitude', 'phase'),
+                     RECONST_INT_AND_PHASE:('intensity', 'phase'),
+                     RECONST_ALL:('intensity', 'amplitude', 'phase'),
+                    }
+
     def __init__(self, configfile=None):
         """
         Constructor
@@ -559,6 +698,38 @@ class ReconstructionMetadata(MetadataABC):
         #True => store reconstruction data to disk; False => Don't store
         #reconstruction data to disk
         self.store_files = False
+        ### Propagation kernel (G factor) cache. Empty dir disables backing store
+        self.kernel_cache_size_mb = 2048
+        self.kernel_cache_dir = ''
+        self.kernel_cache_disk_mb = 8192
+        ### Only store propagation kernel coefficients inside the fourier mask
+        self.sparse_kernel = True
+        ### Only inverse transform the box around the fourier mask (lower resolution output)
+        self.crop_spectrum = False
+        ### FFTW planning.  fft_threads = 0 uses half of the CPUs
+        self.fft_planner_effort = 'FFTW_MEASURE'
+        self.fft_threads = 0
+        self.fft_wisdom_file = ''
+        ### FFTW plans kept by each reconstruction thread
+        self.fft_max_plans = 4
+        ### Threads reconstructing wavelengths concurrently. 0 => one per wavelength
+        self.wavelength_workers = 0
+        ### Reconstruct every propagation distance (focus sweep) instead of the first one
+        self.focus_sweep = False
+        ### Products in flight through shared memory. 0 sends products through the queues
+        self.shared_memory_slots = 4
+        ### Frames waiting for reconstruction [latest|queue|every_nth]
+        self.frame_admission = 'latest'
+        self.frame_queue_depth = 2
+        self.frame_decimation = 1
+        ### Reconstruction worker threads.  Products are published in frame order
+        self.reconstruction_workers = 1
+        ### Find the spectral peak every frame, searching around the previous peak
+        self.spectral_peak_tracking = False
+        ### Maximum rows and columns of the fourier display image, 0 for full size
+        self.fourier_display_size = 512
+        ### Reconstruction statistics
+        self.stats = self.StatisticsMetadata()
         self.status_msg = ''
 
         self.load_config(configfile)
@@ -625,6 +796,27 @@ class ReconstructionMetadata(MetadataABC):
 
             mode_str = config.get(key, 'processing_mode', fallback='none')
             processing_mode = self._processing_mode(mode_str)
+            kernel_cache_size_mb = config.getint(key, 'kernel_cache_size_mb', fallback=2048)
+            kernel_cache_dir = config.get(key, 'kernel_cache_dir', fallback='')
+            kernel_cache_disk_mb = config.getint(key, 'kernel_cache_disk_mb', fallback=8192)
+            sparse_kernel = config.getboolean(key, 'sparse_kernel', fallback=True)
+            crop_spectrum = config.getboolean(key, 'crop_spectrum', fallback=False)
+            fft_planner_effort = config.get(key, 'fft_planner_effort', fallback='FFTW_MEASURE').upper()
+            fft_threads = config.getint(key, 'fft_threads', fallback=0)
+            fft_wisdom_file = config.get(key, 'fft_wisdom_file', fallback='')
+            fft_max_plans = config.getint(key, 'fft_max_plans', fallback=4)
+            wavelength_workers = config.getint(key, 'wavelength_workers', fallback=0)
+            focus_sweep = config.getboolean(key, 'focus_sweep', fallback=False)
+            shared_memory_slots = config.getint(key, 'shared_memory_slots', fallback=4)
+            frame_admission = config.get(key, 'frame_admission', fallback='latest').lower()
+            if frame_admission not in ['latest', 'queue', 'every_nth']:
+                print("Frame admission [%s] not valid. Using 'latest'"%(frame_admission))
+                frame_admission = 'latest'
+            frame_queue_depth = config.getint(key, 'frame_queue_depth', fallback=2)
+            frame_decimation = config.getint(key, 'frame_decimation', fallback=1)
+            reconstruction_workers = config.getint(key, 'reconstruction_workers', fallback=1)
+            spectral_peak_tracking = config.getboolean(key, 'spectral_peak_tracking', fallback=False)
+            fourier_display_size = config.getint(key, 'fourier_display_size', fallback=512)
 
             self.propagation_distance = propagation_distance
             self.chromatic_shift = chromatic_shift
@@ -638,6 +830,24 @@ class ReconstructionMetadata(MetadataABC):
             self.roi_x.size = roi_x_size
             self.roi_y.size = roi_y_size
             self.processing_mode = processing_mode
+            self.kernel_cache_size_mb = kernel_cache_size_mb
+            self.kernel_cache_dir = kernel_cache_dir
+            self.kernel_cache_disk_mb = kernel_cache_disk_mb
+            self.sparse_kernel = sparse_kernel
+            self.crop_spectrum = crop_spectrum
+            self.fft_planner_effort = fft_planner_effort
+            self.fft_threads = fft_threads
+            self.fft_wisdom_file = fft_wisdom_file
+            self.fft_max_plans = max(1, fft_max_plans)
+            self.wavelength_workers = wavelength_workers
+            self.focus_sweep = focus_sweep
+            self.shared_memory_slots = shared_memory_slots
+            self.frame_admission = frame_admission
+            self.frame_queue_depth = frame_queue_depth
+            self.frame_decimation = frame_decimation
+            self.reconstruction_workers = reconstruction_workers
+            self.spectral_peak_tracking = spectral_peak_tracking
+            self.fourier_display_size = fourier_display_size
 
             self.ref_holo.load_config(filepath)
             self.phase_unwrapping.load_config(filepath)
@@ -889,6 +1099,35 @@ class ReconstructionMetadata(MetadataABC):
             Read the config file and load data pertaining to this metadata
             """
 
+    class StatisticsMetadata(MetadataABC):
+        """
+        Reconstruction Statistics Metadata Class
+        """
+        def __init__(self):
+            """
+            Constructor
+            """
+            ### Propagation kernel cache
+            self.kernel_cache_hits = 0
+            self.kernel_cache_misses = 0
+            self.kernel_cache_evictions = 0
+            self.kernel_cache_bytes = 0
+            ### Reconstruction time of each wavelength channel of the last frame
+            self.channel_time_ms = []
+            ### Frame admission counters
+            self.frames_received = 0
+            self.frames_dropped = 0
+            self.frames_processed = 0
+            self.frames_in_flight = 0
+            ### Spectral peak tracking, full frame searches and tracked frames
+            self.spectral_peak_full_searches = 0
+            self.spectral_peak_tracked = 0
+
+        def load_config(self, filepath):
+            """
+            Read the config file and load data pertaining to this metadata
+            """
+
 class ReconstructionDoneMetadata(MetadataABC):
     """
     Reconstruction Done Metadata Class
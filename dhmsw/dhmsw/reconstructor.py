@@ -23,19 +23,38 @@ import copy
 import multiprocessing
 import threading
 import time
-import queue
 import numpy as np
 
 from shampoo_lite.reconstruction import (Hologram)
 from shampoo_lite.mask import (Circle, Mask)
+from shampoo_lite.peak_tracking import SpectralPeakTracker
+from shampoo_lite import fftutils
 
 from . import telemetry_iface_ag
 from . import interface as Iface
 from . import metadata_classes as MetaC
 from .heartbeat import Heartbeat as HBeat
+from .kernel_cache import KernelCache
+from .frame_admission import (FrameAdmission, Resequencer)
+from .fourier_image import fourier_display_image
+from .shared_frames import (SharedFrameRing, SlotDescriptor, ack_identifier)
 
 
 MP = multiprocessing.get_context('spawn')
+
+class _WorkerState(threading.local):
+    """
+    Hologram and fourier mask owned by each reconstruction worker thread
+    """
+    def __init__(self):
+        """
+        Constructor.  Called once per thread
+        """
+        super().__init__()
+        self.holo = None
+        self.mask = None
+        self.mask_version = 0
+
 class Reconstructor(MP.Process):
     """
     Reconstructor class.  Child of multiprocessing.Process
@@ -91,14 +110,82 @@ class Reconstructor(MP.Process):
         self._camera_meta = meta.metadata['CAMERA']
         self._session_meta = meta.metadata['SESSION']
 
-        self._mask = None
-        self.holo = None
+        ### Per worker hologram and mask, plus the hologram of the last frame
+        self._create_worker_state()
+        self._last_holo = None
+        ### Fourier mask shared by the workers, (version, mask).  A mask of
+        ### None means each worker rebuilds it from the fourier mask circles
+        self._shared_mask = (0, None)
 
         self._reconstprocessor = {}
-        self._reconstprocessor['queue'] = None
-        self._reconstprocessor['thread'] = None
-        self._update_fourier_mask = False
-        self._g_db = {}
+        self._reconstprocessor['admission'] = None
+        self._reconstprocessor['resequencer'] = None
+        self._reconstprocessor['threads'] = []
+        ### Shared memory ring of the published products.  Created in 'run'
+        self._product_ring = None
+        ### Products needed by each component, {name: frozenset of products}
+        self._product_demand = {}
+        self._g_db = KernelCache(max_bytes=self._reconst_meta.kernel_cache_size_mb * 1024**2,
+                                 cache_dir=self._reconst_meta.kernel_cache_dir or None,
+                                 max_disk_bytes=self._reconst_meta.kernel_cache_disk_mb * 1024**2,
+                                 verbose=verbose,
+                                )
+
+    def _create_worker_state(self):
+        """
+        Create the per thread state and the locks of the reconstruction workers
+        """
+        self._worker = _WorkerState()
+        self._mask_lock = threading.Lock()
+        self._g_db_lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Thread state and locks can't be pickled when the process is spawned
+        """
+        state = self.__dict__.copy()
+        for name in ['_worker', '_mask_lock', '_g_db_lock']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        """
+        Recreate the thread state and locks in the spawned process
+        """
+        self.__dict__.update(state)
+        self._create_worker_state()
+
+    @property
+    def holo(self):
+        """
+        Hologram of the calling reconstruction worker
+        """
+        return self._worker.holo
+
+    @holo.setter
+    def holo(self, holo):
+        self._worker.holo = holo
+        self._last_holo = holo
+
+    @property
+    def _mask(self):
+        """
+        Fourier mask of the calling reconstruction worker
+        """
+        return self._worker.mask
+
+    @_mask.setter
+    def _mask(self, mask):
+        self._worker.mask = mask
+
+    def _publish_fourier_mask(self, mask):
+        """
+        Make 'mask' the fourier mask of all workers.  None makes each
+        worker rebuild the mask from the fourier mask circles.
+        """
+        with self._mask_lock:
+            self._shared_mask = (self._shared_mask[0] + 1, mask)
+            return self._shared_mask[0]
 
     def publish_reconst_status(self, status_msg=None):
         """
@@ -409,14 +496,14 @@ class Reconstructor(MP.Process):
                                                radius,
                                               )
 
-            dk = 1 if self.holo is None else self.holo.dk
+            dk = 1 if self._last_holo is None else self._last_holo.dk
 
             print("COMPUTING_CIRCLE_1")
             fmask_meta.mask = Mask(self._camera_meta.N,
                                    fmask_meta.center_list[0:len(self._session_meta.holo.wavelength)],
                                    dk)
             print("DONE COMPUTING_CIRCLE_1")
-            self._update_fourier_mask = True
+            self._publish_fourier_mask(None)
 
         return validcmd
 
@@ -442,11 +529,11 @@ class Reconstructor(MP.Process):
                                                center_y,
                                                radius
                                               )
-            dk = 1 if self.holo is None else self.holo.dk
+            dk = 1 if self._last_holo is None else self._last_holo.dk
             fmask_meta.mask = Mask(self._camera_meta.N,
                                    fmask_meta.center_list[0:len(self._session_meta.holo.wavelength)],
                                    dk)
-            self._update_fourier_mask = True
+            self._publish_fourier_mask(None)
 
         return validcmd
 
@@ -470,11 +557,11 @@ class Reconstructor(MP.Process):
             fmask_meta.center_list[2] = Circle(center_x,
                                                center_y,
                                                radius)
-            dk = 1 if self.holo is None else self.holo.dk
+            dk = 1 if self._last_holo is None else self._last_holo.dk
             fmask_meta.mask = Mask(self._camera_meta.N,
                                    fmask_meta.center_list[0:len(self._session_meta.holo.wavelength)],
                                    dk)
-            self._update_fourier_mask = True
+            self._publish_fourier_mask(None)
 
         return validcmd
 
@@ -586,18 +673,21 @@ class Reconstructor(MP.Process):
                              )
         return holo_telem
 
-    def reconst_thread(self, inq):
+    def reconst_thread(self, admission, resequencer):
         """
-        Reconstruction thread which performs the reconstruction
+        Reconstruction worker thread which performs the reconstruction
 
-        This thread is spawned in the "run" method. Upon receipt of data which
-        is an image it will run the "perform_reconstruction" method.  See this
-        method for details
+        Workers are spawned in the "run" method. Each worker takes the next
+        admitted image, runs the "perform_reconstruction" method (see this
+        method for details) with its own hologram and mask and hands the
+        product to the resequencer which publishes the products in frame order.
 
         Parameters
         ----------
-        inq  :  queue.Queue
-            Queue used to recieve image data of type Iface.image
+        admission  :  FrameAdmission
+            Frames admitted for reconstruction, of type Iface.image
+        resequencer : Resequencer
+            Publishes the products in the order the frames were admitted
         Return
         ---------
         None
@@ -605,24 +695,29 @@ class Reconstructor(MP.Process):
         """
 
         while True:
-            try:
-                data = inq.get()
-                if data is None:
-                    break
-            except queue.Empty:
-                pass
+            item = admission.get()
+            if item is None:
+                break
 
+            seq, data = item
             self._reconst_meta.running = True
-            self.perform_reconstruction(data)
-            self._reconst_meta.running = False
+            product = None
+            try:
+                product = self.perform_reconstruction(data)
+            finally:
+                ### Product doesn't reference the frame any longer
+                data.release(self._pub)
+                admission.task_done()
+                self._reconst_meta.running = admission.active > 0
+                resequencer.push(seq, product)
 
     def _create_hologram_obj(self, img):
         """
         Create hologram object or update it if it already exists
         """
         ### Create Hologram object or update it.  Updating saves CPU cycles.
-        #if self.holo is None:
-        if True:
+        ### update_hologram discards the cached grids whose parameters changed
+        if self.holo is None:
             self.holo = Hologram(img,
                                  wavelength=self._session_meta.holo.wavelength,
                                  #crop_fraction=self._holo_meta.crop_fraction,
@@ -644,33 +739,117 @@ class Reconstructor(MP.Process):
                                      )
             self._mask = self.holo.fourier_mask
 
+        ### Spectral peak tracking searches around the peaks of the previous frames
+        if not self._reconst_meta.spectral_peak_tracking:
+            self.holo.peak_tracker = None
+        elif self.holo.peak_tracker is None:
+            self.holo.peak_tracker = SpectralPeakTracker()
+
     def _update_g_factor_db(self):
         """
         Update the G Factor database or add to database if entry doesn't exist
         """
         start_time = time.time()
 
-        g_key = repr(self._reconst_meta.propagation_distance) + \
-                "_" + repr(self.holo.hololen) + \
-                "_" + repr(self._session_meta.holo.dx) + \
-                "_" + repr(self._session_meta.holo.dy) + \
-                "_" + repr(self._session_meta.holo.wavelength)
+        ### The kernel only depends on the centered mask, i.e. the mask radii
+        radius = [circle.radius for circle in self.holo.fourier_mask.circle_list]
+        g_key = KernelCache.make_key(propagation_distance=self._propagation_distances(),
+                                     hololen=self.holo.hololen,
+                                     dx=self._session_meta.holo.dx,
+                                     dy=self._session_meta.holo.dy,
+                                     wavelength=self._session_meta.holo.wavelength,
+                                     system_magnification=self._session_meta.lens.system_magnification,
+                                     radius=radius,
+                                     sparse=self._reconst_meta.sparse_kernel,
+                                     focus_sweep=self._reconst_meta.focus_sweep,
+                                    )
+
+        ### Workers share the cache.  The lock also keeps two workers
+        ### from computing the same kernel.
+        new_kernel = None
+        with self._g_db_lock:
+            prop_kernel = self._g_db.get(g_key)
+            if prop_kernel is not None:
+
+                self.holo.set_G_factor(prop_kernel)
 
-        try:
+            else:
 
-            prop_kernel = self._g_db[g_key]
-            self.holo.set_G_factor(prop_kernel)
+                if self._verbose:
+                    print('Updating G factor for g_key=%s'%(g_key))
+                new_kernel = self.holo.update_G_factor(self._propagation_distances(),
+                                                       sparse=self._reconst_meta.sparse_kernel,
+                                                       depth_stack=self._reconst_meta.focus_sweep)
+                self._g_db.put(g_key, new_kernel)
 
-        except KeyError:
+            self._update_kernel_cache_stats()
 
-            if self._verbose:
-                print('Updating G factor for g_key=%s'%(g_key))
-            self._g_db[g_key] = self.holo.update_G_factor(self._reconst_meta.propagation_distance[0])
+        ### Other workers don't wait on the disk write
+        if new_kernel is not None:
+            self._g_db.store(g_key, new_kernel)
 
         if self._verbose:
             print('%f: Reconstruction G Database. Elapsed Time: %f'\
                   %(time.time(), time.time()-start_time))
 
+    def _propagation_distances(self):
+        """
+        Return the propagation distances reconstructed.  All of them for a
+        focus sweep, else only the first one.
+        """
+        if self._reconst_meta.focus_sweep:
+            return list(self._reconst_meta.propagation_distance)
+
+        return self._reconst_meta.propagation_distance[0]
+
+    def _configure_fft_plans(self):
+        """
+        Apply the FFTW planner settings to the FFT plan pool of this process.
+        Plans are created on first use and planning is skipped for shapes
+        found in the wisdom file.
+        """
+        fftutils.plan_pool.configure(planner_effort=self._reconst_meta.fft_planner_effort,
+                                     threads=self._reconst_meta.fft_threads or None,
+                                     wisdom_file=self._reconst_meta.fft_wisdom_file,
+                                     max_plans=self._reconst_meta.fft_max_plans,
+                                    )
+
+        if self._verbose:
+            print('FFT plan pool: planner_effort=%s, threads=%d, wisdom_file=%s'\
+                  %(fftutils.plan_pool.planner_effort, fftutils.plan_pool.threads,
+                    fftutils.plan_pool.wisdom_file))
+
+    def _update_peak_tracking_stats(self, full_searches, tracked):
+        """
+        Add the spectral peak searches of a worker to the reconstruction statistics.
+        Each worker has its own tracker, so the call must hold '_mask_lock'.
+        """
+        stats = self._reconst_meta.stats
+        stats.spectral_peak_full_searches += full_searches
+        stats.spectral_peak_tracked += tracked
+
+    def _update_kernel_cache_stats(self):
+        """
+        Copy the propagation kernel cache counters into the reconstruction statistics
+        """
+        stats = self._reconst_meta.stats
+        stats.kernel_cache_hits = self._g_db.hits
+        stats.kernel_cache_misses = self._g_db.misses
+        stats.kernel_cache_evictions = self._g_db.evictions
+        stats.kernel_cache_bytes = self._g_db.nbytes()
+
+
+    def _mask_fits(self, mask):
+        """
+        Return True if 'mask' can be used with the hologram of the calling worker
+        """
+        if mask is None:
+            return False
+
+        mask_shape = mask.mask.shape
+        return mask_shape[0] == self.holo.ft_hologram.shape[0] and\
+               mask_shape[1] == self.holo.ft_hologram.shape[1] and \
+               mask_shape[2] == len(self._session_meta.holo.wavelength)
 
     def _should_we_recompute_mask(self):
         """
@@ -678,10 +857,7 @@ class Reconstructor(MP.Process):
         """
         recompute_mask = True
         if self._mask is not None:
-            mask_shape = self._mask.mask.shape
-            recompute_mask = mask_shape[0] != self.holo.ft_hologram.shape[0] or\
-                             mask_shape[1] != self.holo.ft_hologram.shape[1] or \
-                             mask_shape[2] != len(self._session_meta.holo.wavelength)
+            recompute_mask = not self._mask_fits(self._mask)
             print("%%%%%% RECOMPUTE_MASK: ", self._mask.mask_uncentered.shape,
                   self.holo.ft_hologram.shape,
                   recompute_mask)
@@ -692,23 +868,48 @@ class Reconstructor(MP.Process):
         """
         Find the spectral peak mathematically of the fourier image and create a mask around the peak
         The computed mask and peak locations are stored into self.holo.mask, self.holo.x_peak, and self.holo.y_peak
+
+        Only one worker computes the spectral peak, the other workers use its mask.
+        With spectral peak tracking each worker finds the peak of its own frame.
         """
-        ### Compute the spectral peak and the mask
-        if self._reconst_meta.compute_spectral_peak or recompute_mask:
+        if self._reconst_meta.spectral_peak_tracking:
+            self._track_spectral_peak()
+            return
 
-            self.holo.generate_spectral_mask(compute_spectral_peak=True, radius=150)
+        with self._mask_lock:
+            version, mask = self._shared_mask
 
-            self._reconst_meta.compute_spectral_peak = False
+            ### Compute the spectral peak and the mask
+            if self._reconst_meta.compute_spectral_peak or \
+               (recompute_mask and not self._mask_fits(mask)):
 
-            self._mask = self.holo.fourier_mask
-            self._fouriermask_meta.mask = self.holo.fourier_mask
+                self.holo.generate_spectral_mask(compute_spectral_peak=True, radius=150)
+
+                self._reconst_meta.compute_spectral_peak = False
+
+                self._mask = self.holo.fourier_mask
+                self._fouriermask_meta.mask = self.holo.fourier_mask
 
-            print("((((((((((((((( Computing spectral peak:",
-                  self._mask.mask_uncentered.shape
-                 )
-        elif self._update_fourier_mask:
+                self._shared_mask = (version + 1, self._mask)
+                self._worker.mask_version = version + 1
+
+                print("((((((((((((((( Computing spectral peak:",
+                      self._mask.mask_uncentered.shape
+                     )
+                return
+
+        if self._worker.mask_version == version and not recompute_mask:
+            return
+
+        self._worker.mask_version = version
+
+        if mask is not None:
+            ### Spectral peak computed by another worker
+            self._mask = mask
+            self.holo.fourier_mask = mask
+
+        else:
             print('Updating Fourier Mask...')
-            self._update_fourier_mask = False
 
             if len(self._fouriermask_meta.center_list) > 0:
 
@@ -723,6 +924,30 @@ class Reconstructor(MP.Process):
                 self._mask = self._fouriermask_meta.mask
                 self.holo.fourier_mask = self._mask
 
+    def _track_spectral_peak(self):
+        """
+        Find the spectral peak of the hologram of the calling worker and create
+        the mask around it.  The search runs outside '_mask_lock' so the
+        workers track their frames in parallel, the lock only publishes the mask.
+        """
+        def counters():
+            tracker = self.holo.peak_tracker
+            return (tracker.full_searches, tracker.tracked) if tracker is not None else (0, 0)
+
+        full_searches, tracked = counters()
+        self.holo.generate_spectral_mask(compute_spectral_peak=True, radius=150)
+        self._mask = self.holo.fourier_mask
+        full_searches_after, tracked_after = counters()
+
+        with self._mask_lock:
+            version = self._shared_mask[0] + 1
+            self._shared_mask = (version, self._mask)
+            self._worker.mask_version = version
+            self._fouriermask_meta.mask = self._mask
+            self._reconst_meta.compute_spectral_peak = False
+            self._update_peak_tracking_stats(full_searches_after - full_searches,
+                                             tracked_after - tracked)
+
     def _validate_wavelength_chromatic_shift(self):
         """
         Validate and ensure that aboth wavelength and chormatic shift
@@ -747,7 +972,7 @@ class Reconstructor(MP.Process):
         """
         Performs reconstruction
         """
-        prop_dist = self._reconst_meta.propagation_distance[0]
+        prop_dist = self._propagation_distances()
         chromatic_shift = self._reconst_meta.chromatic_shift
         comp_dig_phase = self._reconst_meta.compute_digital_phase_mask
         #www = self.holo.my_reconstruct(prop_dist,
@@ -762,8 +987,13 @@ class Reconstructor(MP.Process):
                                   compute_spectral_peak=False, #spectral peak gets computed before this function is called.
                                   chromatic_shift=chromatic_shift,
                                   G_factor = self.holo.propagation_kernel, # Gets computed before this function is called
+                                  crop_spectrum=self._reconst_meta.crop_spectrum,
+                                  num_workers=self._reconst_meta.wavelength_workers,
+                                  depth_stack=self._reconst_meta.focus_sweep,
                                  )
-                                  
+
+        self._reconst_meta.stats.channel_time_ms = [elapsed * 1e3 for elapsed in www.channel_times]
+
         return www
 
     def perform_reconstruction(self, data):
@@ -787,8 +1017,7 @@ class Reconstructor(MP.Process):
             6.  Ensure that the wavelenght and the chromatic shift are of the
                 same length
             7.  Compute the reconstruction
-            8.  Publish the reconstruction results
-            9.  Publish reconstruction done message
+            8.  Prepare the reconstruction product for publishing
 
         Parameters
         ---------
@@ -797,8 +1026,9 @@ class Reconstructor(MP.Process):
 
         Return
         ------
-        None
-            Nothing is returned
+        Iface.ReconstructorProduct or None
+            Product to pass to "publish_reconst_product".  None if nothing
+            was reconstructed
 
         """
         try:
@@ -806,7 +1036,7 @@ class Reconstructor(MP.Process):
 
             if processing_mode == MetaC.ReconstructionMetadata.RECONST_NONE:
                 print('RECONSTRUCTION:  Reconst mode is NONE. Return without computing ')
-                return
+                return None
 
             start_time = time.time()
             if self._verbose:
@@ -838,23 +1068,8 @@ class Reconstructor(MP.Process):
             ### Perform the reconstruction
             www = self._reconstruct()
 
-            ### Compute product based on processing_mode
-            if self._reconst_meta.processing_mode == MetaC.ReconstructionMetadata.RECONST_AMP:
-                www.amplitude
-            elif self._reconst_meta.processing_mode == MetaC.ReconstructionMetadata.RECONST_INTENSITY:
-                www.intensity
-            elif self._reconst_meta.processing_mode == MetaC.ReconstructionMetadata.RECONST_PHASE:
-                www.phase
-            elif self._reconst_meta.processing_mode == MetaC.ReconstructionMetadata.RECONST_AMP_AND_PHASE:
-                www.amplitude
-                www.phase
-            elif self._reconst_meta.processing_mode == MetaC.ReconstructionMetadata.RECONST_INT_AND_PHASE:
-                www.intensity
-                www.phase
-            else:
-                www.intensity
-                www.amplitude
-                www.phase
+            ### Compute the products of the processing_mode which are needed
+            www.compute(self._needed_products())
 
             #www.save_to_file('/Users/sfregoso/Documents/old_mac/MacPro_2012thru2015/Santos/Work/FelipeStuff/DHM/git_repos/dhm_suite/shampoo_lite/Reconstructions')
 
@@ -863,8 +1078,11 @@ class Reconstructor(MP.Process):
             print('%f: Reconstruction Computed . Elapsed Time: %f'\
                   %(time.time(), time.time()-start_time))
 
-            # Prepare the fourier image for display
-            fourier_image = np.log(np.abs(self.holo.ft_hologram)).astype(np.uint8)
+            # Prepare the fourier image for display, only if someone looks at it
+            fourier_image = None
+            if self._product_needed('fourier'):
+                fourier_image = fourier_display_image(self.holo.ft_hologram,
+                                                      self._reconst_meta.fourier_display_size)
             reconstproduct = Iface.ReconstructorProduct(img,
                                                         #self.holo,
                                                         fourier_image,
@@ -872,8 +1090,8 @@ class Reconstructor(MP.Process):
                                                         self._reconst_meta,
                                                         self._holo_meta,
                                                        )
-            self._pub.publish('reconst_product', reconstproduct)
-            self._pub.publish('reconst_done', Iface.MetadataPacket(MetaC.ReconstructionDoneMetadata(done=True)))
+            self._update_admission_stats()
+            return self._share_reconst_product(reconstproduct)
 
         except Exception as err:
             status_msg = "ERROR.  "
@@ -881,16 +1099,71 @@ class Reconstructor(MP.Process):
             self.publish_reconst_status(status_msg=status_msg)
             raise err
 
+    def _share_reconst_product(self, product):
+        """
+        Return the reconstruction product as it is published
+
+        The arrays are written once to the shared memory ring and only
+        the descriptor of the slot is published.  If the ring is disabled
+        or full the arrays are sent through the message queues.
+        """
+        readers = self._pub.num_subscribers('reconst_product')
+        shared = None
+        if self._product_ring is not None and readers \
+           and self._pub.num_subscribers(ack_identifier('reconst_product')):
+            shared = self._product_ring.put(product.arrays(), readers)
+
+        if shared is not None:
+            product = product.shared_copy(shared)
+        elif product.image is not None and not product.image.flags.owndata:
+            ### The raw frame may be in shared memory, which is acknowledged
+            ### before the product is published
+            product.image = np.array(product.image)
+
+        return product
+
+    def publish_reconst_product(self, product):
+        """
+        Publish the reconstruction product and the reconstruction done message
+        """
+        self._pub.publish('reconst_product', product)
+        self._pub.publish('reconst_done', Iface.MetadataPacket(MetaC.ReconstructionDoneMetadata(done=True)))
+
+    def _create_product_ring(self):
+        """
+        Create the shared memory ring of the published products
+        """
+        if self._reconst_meta.shared_memory_slots > 0:
+            self._product_ring = SharedFrameRing('reconst_product',
+                                                 self._reconst_meta.shared_memory_slots)
+
+    def _close_product_ring(self):
+        """
+        Close the shared memory ring of the published products
+        """
+        if self._product_ring is not None:
+            self._product_ring.close()
+            self._product_ring = None
+
     def _init_recon_process_threads(self):
         """
-        Initialize and start thread that will do the reconstruction
+        Initialize and start the worker threads that will do the reconstruction
         """
-        self._reconstprocessor['queue'] = queue.Queue()
-        self._reconstprocessor['thread'] = threading.Thread(target=self.reconst_thread,
-                                                            args=(self._reconstprocessor['queue'],),
-                                                           )
-        self._reconstprocessor['thread'].daemon = True
-        self._reconstprocessor['thread'].start()
+        self._reconstprocessor['admission'] = FrameAdmission(mode=self._reconst_meta.frame_admission,
+                                                             depth=self._reconst_meta.frame_queue_depth,
+                                                             decimation=self._reconst_meta.frame_decimation,
+                                                            )
+        self._reconstprocessor['resequencer'] = Resequencer(self.publish_reconst_product)
+
+        for _ in range(max(1, self._reconst_meta.reconstruction_workers)):
+            thread = threading.Thread(target=self.reconst_thread,
+                                      args=(self._reconstprocessor['admission'],
+                                            self._reconstprocessor['resequencer'],
+                                           ),
+                                     )
+            thread.daemon = True
+            thread.start()
+            self._reconstprocessor['threads'].append(thread)
 
     def create_heartbeat(self):
         """
@@ -922,22 +1195,57 @@ class Reconstructor(MP.Process):
     def _process_images(self, data):
         """
         Process images received from the camera server
-        Place image in reconstructor processor queue for processing
+        Offer the image to the frame admission of the reconstruction thread.
+        Frames which are not reconstructed are released right away.
         """
         print("Reconstructor received image")
         processing_mode = self._reconst_meta.processing_mode
         if processing_mode == MetaC.ReconstructionMetadata.RECONST_NONE:
-            #continue
-            pass
-        elif not self._reconst_meta.running:
-            print("%f: Reconstructor:  Got Image!"%(time.time()))
-            self._reconst_meta.running = True
-            self._reconstprocessor['queue'].put(data)
-            #self._reconst_meta.running = True
-            #self.perform_reconstruction(data)
-            self._reconst_meta.running = False
+            dropped = [data]
         else:
-            pass
+            print("%f: Reconstructor:  Got Image!"%(time.time()))
+            dropped = self._reconstprocessor['admission'].put(data)
+
+        for frame in dropped:
+            frame.release(self._pub)
+
+        self._update_admission_stats()
+
+    def _update_admission_stats(self):
+        """
+        Copy the frame admission counters to the reconstruction statistics
+        """
+        admission = self._reconstprocessor['admission']
+        if admission is None:
+            return
+
+        stats = self._reconst_meta.stats
+        stats.frames_received = admission.received
+        stats.frames_dropped = admission.dropped
+        stats.frames_processed = admission.processed
+        stats.frames_in_flight = admission.in_flight
+
+    def _process_product_demand(self, data):
+        """
+        Record the products needed by a component.  The dictionary is
+        replaced, not modified, as the workers read it concurrently.
+        """
+        demand = dict(self._product_demand)
+        demand[data.get_name()] = data.get_products()
+        self._product_demand = demand
+
+    def _product_needed(self, product):
+        """
+        Return TRUE if any component needs 'product'
+        """
+        return any([product in products for products in self._product_demand.values()])
+
+    def _needed_products(self):
+        """
+        Return the products of the processing mode needed by any component
+        """
+        products = MetaC.ReconstructionMetadata.MODE_PRODUCTS[self._reconst_meta.processing_mode]
+        return [product for product in products if self._product_needed(product)]
 
     def _process_component_messages(self, data):
         """
@@ -963,6 +1271,16 @@ class Reconstructor(MP.Process):
             self._session_meta = data
             self.publish_session_status()
 
+        elif isinstance(data, Iface.ProductDemand):
+
+            self._process_product_demand(data)
+
+        ### Subscriber is done with a shared memory product
+        elif isinstance(data, SlotDescriptor):
+
+            if self._product_ring is not None:
+                self._product_ring.ack(data)
+
         else:
             pass
 
@@ -970,8 +1288,8 @@ class Reconstructor(MP.Process):
         """
         Reconstruction process loop.
 
-        This function starts off by spawning the thread where the reconstruction will be done
-        and creates a queue to feed that thread images.
+        This function starts off by spawning the worker threads where the reconstruction will be done
+        and the frame admission which feeds those threads images.
         The heartbeat for the Reconstructor is created here.  All commands sent to the Reconstructor
         is received in the "self._inq" and processed.
         """
@@ -979,6 +1297,10 @@ class Reconstructor(MP.Process):
         try:
             #msPkt = Iface.CamServerFramePkt()
 
+            self._configure_fft_plans()
+
+            self._create_product_ring()
+
             self._init_recon_process_threads()
 
             self.create_heartbeat()
@@ -1013,6 +1335,12 @@ class Reconstructor(MP.Process):
         self.terminate_heartbeat()
         if self._hbeat.isAlive():
             self._hbeat.join(timeout=5)
+        if self._reconstprocessor['admission'] is not None:
+            for frame in self._reconstprocessor['admission'].close():
+                frame.release(self._pub)
+        self._close_product_ring()
+        ### Keep the wisdom of the plans created this session
+        fftutils.plan_pool.save_wisdom()
         print('[%s]: End'%(self._id))
 
     def handle_component_exception(self, err):
@@ -101,6 +101,20 @@ class Sequence():
 
         return filepaths
 
+    def get_sequence_timestamps(self, fpath):
+        """
+        Get the time of each hologram of the sequence in milliseconds since
+        the first one, in the order of 'get_sequence_filepaths'
+        """
+        tsfile = fpath + '/' + self.tsfname
+        if not os.path.exists(tsfile):
+            raise IOError('The file [%s] does not exist in this directory and'\
+                          ' is required to exist.'%(tsfile))
+
+        rec = self.read_timestamp_file(tsfile)
+
+        return [float(name[-1]) for name in rec['records']]
+
 if __name__ == "__main__":
     ## Koala version
     PATH = '/proj/dhm/sfregoso/data/legacy/2018.08.01 15-25/'
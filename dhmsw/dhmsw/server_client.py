@@ -20,8 +20,8 @@ import sys
 import select
 import socket
 import multiprocessing
-from threading import Thread
-from queue import Queue, Empty
+from collections import deque
+from threading import Thread, Lock
 
 class Client():
     """
@@ -78,9 +78,112 @@ class Client():
         self._client.close()
 
 
+class ClientConnection():
+    """
+    Connection of a client to the server
+
+    Messages wait in a bounded queue.  When the queue is full the oldest
+    waiting message is dropped, so a slow client gets the newest frames
+    instead of falling further behind.  The message being sent is kept
+    apart with the number of its bytes already sent.
+    """
+    def __init__(self, sock, address, queue_depth):
+        """
+        Constructor
+        """
+        self.sock = sock
+        self.address = address
+        ### The queue is appended to by other threads than the sending one
+        self._lock = Lock()
+        self.queue = deque()
+        self.queue_depth = max(1, int(queue_depth))
+        ### Message being sent and bytes of it already sent
+        self.pending = None
+        self.offset = 0
+        ### View of the images requested by the client, None for the whole images
+        self.view = None
+        self.request = b''
+
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+
+    def enqueue(self, data):
+        """
+        Queue a message, dropping the oldest waiting one if the queue is full
+
+        Returns
+        -------
+        bool
+            TRUE if a message was dropped
+        """
+        dropped = False
+        with self._lock:
+            if len(self.queue) >= self.queue_depth:
+                self.queue.popleft()
+                self.dropped_frames += 1
+                dropped = True
+            self.queue.append(data)
+        return dropped
+
+    def wants_write(self):
+        """
+        Returns TRUE if there is data to send
+        """
+        return self.pending is not None or len(self.queue) > 0
+
+    def send(self):
+        """
+        Send as much queued data as the socket accepts without blocking
+
+        Returns
+        -------
+        int
+            Number of messages completely sent
+        """
+        completed = 0
+        while True:
+            if self.pending is None:
+                with self._lock:
+                    if not self.queue:
+                        break
+                    self.pending = memoryview(self.queue.popleft()).cast('B')
+                self.offset = 0
+
+            try:
+                nbytes = self.sock.send(self.pending[self.offset:])
+            except (BlockingIOError, InterruptedError):
+                break
+
+            self.offset += nbytes
+            self.sent_bytes += nbytes
+            if self.offset < len(self.pending):
+                break
+
+            self.pending = None
+            self.sent_frames += 1
+            completed += 1
+
+        return completed
+
+    def stats(self):
+        """
+        Return the counters of the client
+        """
+        return {'address':'%s:%s'%self.address[:2] if self.address else '',
+                'sent_frames':self.sent_frames,
+                'sent_bytes':self.sent_bytes,
+                'dropped_frames':self.dropped_frames,
+                'queued_frames':len(self.queue),
+               }
+
 class Server():
     """
     Server Class
+
+    Sends the same messages to all of its clients from one thread with
+    non blocking sockets.  Each client has its own bounded queue so a slow
+    client only drops its own stale frames and never delays the others.
     """
     def __init__(self,
                  port,
@@ -91,19 +194,38 @@ class Server():
                  verbose=False,
                  useprocess=False,
                  enablesend=True,
+                 queue_depth=1,
+                 parse_request=None,
+                 pack_pool=None,
                 ):
         """
         Constructor
-        """
+
+        Parameters
+        ----------
+        queue_depth : int
+            Number of messages waiting for each client, besides the one
+            being sent, before the oldest is dropped
+        parse_request : function or None
+            Parses the request lines of the clients into (channels, view),
+            e.g. image_views.parse_view_request.  None ignores them.
+        pack_pool : concurrent.futures.Executor or None
+            Packs and encodes the image messages of different views in parallel
+        """
+        # pylint: disable=too-many-arguments
         self._host = host
         self._port = port
         self._maxclients = maxclients
         self._verbose = verbose
         self._exit = False
         self._enablesend = enablesend
+        self._queue_depth = queue_depth
+        self._parse_request = parse_request
+        self._pack_pool = pack_pool
 
-        self._clients = []
-        self._clientthreads = {}
+        ### Client connections by socket.  Shared with the sending thread.
+        self._clients = {}
+        self._lock = Lock()
         self._useprocess = useprocess
         if useprocess:
             self._serverthread = multiprocessing.Process(target=self.server_thread)
@@ -111,21 +233,24 @@ class Server():
             self._serverthread = Thread(target=self.server_thread)
             self._serverthread.daemon = True
 
-        #self._serverthread.daemon = True
         self._timeout = timeout
 
         self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        #self._server.setblocking(0)
         self._server.bind((self._host, self._port))
+        ### Listen right away so clients can connect before the thread runs
+        self._server.listen(self._maxclients)
 
-        self._readfds = []
-        self._writefds = []
-        self._validate_func = validate_func
+        ### Wakes the select up when messages are queued
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
 
-        self._message_queues = {}
+        self._validate_func = validate_func
 
-        self._sendinprogress = False
+        ### Counters of all clients, including disconnected ones
+        self.sent_frames = 0
+        self.dropped_frames = 0
 
     def enable_send(self, ena):
         """
@@ -135,36 +260,69 @@ class Server():
 
     def send_to_all_clients(self, data):
         """
-        Send data to all connected clients
+        Queue data to all connected clients.  Never waits on the clients.
+
+        Parameters
+        ----------
+        data : bytes-like, sequence of bytes-like or interface.ImageMessage
+            Message, possibly as separate header and payload buffers.
+            Image messages are packed once for each view of the clients.
         """
-        if self._enablesend:
+        if not self._enablesend:
+            print('** NOTE Gui server channel is disabled., port=%d'%(self._port))
+            return
 
-            for cli in self._clients:
+        with self._lock:
+            clients = list(self._clients.values())
+        if not clients:
+            return
 
-                if self._sendinprogress is False:
+        ### Image messages are packed for each view, in parallel on the pack pool
+        views = {}
+        for conn in clients:
+            views.setdefault(conn.view.key() if conn.view is not None else None, conn.view)
+        if hasattr(data, 'to_buffers'):
+            if self._pack_pool is not None and len(views) > 1:
+                futures = {key:self._pack_pool.submit(data.to_buffers, view) for key, view in views.items()}
+                packed = {key:future.result() for key, future in futures.items()}
+            else:
+                packed = {key:data.to_buffers(view) for key, view in views.items()}
+        else:
+            packed = {key:data for key in views}
 
-                    self._message_queues[cli].put_nowait(data)
-                    if cli not in self._writefds:
-                        self._writefds.append(cli)
-                        #print('Port %d: Add client to writefds'%(self._port))
+        ### Header and payload buffers are joined once for all clients of a view
+        for key, buffers in packed.items():
+            if isinstance(buffers, (list, tuple)):
+                packed[key] = b''.join(buffers)
 
-                else:
-                    print('Port %d: SEND is BUSY'%(self._port))
-                #if c not in self._writefds:
-                #    self._writefds.append(c)
-                #    print('Add client to writefds')
-        else:
-            print('** NOTE Gui server channel is disabled., port=%d'%(self._port))
+        for conn in clients:
+            if conn.enqueue(packed[conn.view.key() if conn.view is not None else None]):
+                self.dropped_frames += 1
+
+        self._wakeup()
+
+    def _wakeup(self):
+        """
+        Wake the server thread up from select
+        """
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            ### Already pending wake up, or the server is closed
+            pass
 
     def has_clients(self):
         """
         Returns TRUE if there are connected clients
         """
-        ret = False
-        if len(self._clients) > 0:
-            ret = True
+        return len(self._clients) > 0
 
-        return ret
+    def client_stats(self):
+        """
+        Return the counters of each connected client
+        """
+        with self._lock:
+            return [conn.stats() for conn in self._clients.values()]
 
     def _exit_requested(self):
         """
@@ -174,70 +332,108 @@ class Server():
             print("Port %d: Exiting server: server=%s, port=%s"\
                   %(self._port, self._host, self._port))
 
-        for cli in self._clients:
-
-            self._readfds.remove(cli)
-
-            if cli in self._writefds:
-                self._writefds.remove(cli)
-                print("Port %d: Removed client from writefs"%(self._port))
+        for cli in list(self._clients):
+            self._close_client(cli)
 
-            print("Port %d: Removed client from list"%(self._port))
-            cli.close()
-            self._message_queues[cli].put(None)
-
-    def _accept_client_connections(self, srvr):
+    def _accept_client_connections(self):
         """
         Accept client connections
         """
-        if srvr is self._server:
-            clientsock, _ = self._server.accept()
-            #clientsock.setblocking(0)
-            self._readfds.append(clientsock) # Add client socket into readfds list
-            self._clients.append(clientsock) # Add client socket into list of clients
-            ### Create a queue for each client
-            self._message_queues[clientsock] = Queue()
-            if self._verbose:
-                print("Port %d: Received new client connection"%(self._port))
+        try:
+            clientsock, address = self._server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        clientsock.setblocking(False)
+        with self._lock:
+            self._clients[clientsock] = ClientConnection(clientsock, address, self._queue_depth)
+        if self._verbose:
+            print("Port %d: Received new client connection"%(self._port))
 
     def _close_client(self, cli):
         """
         Handle close client connection
         """
-        self._readfds.remove(cli)
-        if cli in self._writefds:
-            self._writefds.remove(cli)
-            print("Port %d: Removed client from writefs"%(self._port))
-        self._clients.remove(cli)
+        with self._lock:
+            conn = self._clients.pop(cli, None)
+        if conn is None:
+            return
+
         print("Port %d: Removed client from list"%(self._port))
         cli.close()
-        del self._message_queues[cli]
         print('Port %d: Closed client socket'%(self._port))
 
-    def _handle_client_data(self, sock_r, cli):
+    def _handle_client_data(self, cli):
+        """
+        Read data sent by a client, the view requests
+        """
+        try:
+            data = cli.recv(1024)
+        except (BlockingIOError, InterruptedError):
+            return None
+        except OSError:
+            data = b''
+
+        ### Client socket CLOSED
+        if not data:
+            self._close_client(cli)
+            return data
 
-        client_had_data = False
+        conn = self._clients.get(cli)
+        if conn is None or self._parse_request is None:
+            return data
 
-        data = None
+        conn.request += data
+        while b'\n' in conn.request:
+            line, conn.request = conn.request.split(b'\n', 1)
+            self._process_request(conn, line.decode(errors='replace'))
 
-        if sock_r is cli:  ### Is the socket that has activity one of the clients???
-            client_had_data = True
+        return data
 
-            data = cli.recv(1024)
-            ### Client socket CLOSED
-            if not data:
+    def _process_request(self, conn, line):
+        """
+        Set the view of the images of the client.  The server serves one
+        channel, the channels of the request are not checked.
+        """
+        if not line.strip():
+            return
+
+        try:
+            request = self._parse_request(line)
+        except ValueError as err:
+            print('Port %d: Bad request: %s'%(self._port, repr(err)))
+            return
+        if request is None:
+            print('Port %d: Unknown request: %s'%(self._port, line))
+            return
 
-                self._close_client(cli)
+        _, view = request
+        conn.view = None if view.is_full() else view
 
-            else:
-                #print('Received from client: %s'%(data))
-                #self._message_queues[c].put(data)
-                #if c not in self._writefds:
-                #    self._writefds.append(c)
-                #    print('Add client to writefds')
+    def _drain_wakeup(self):
+        """
+        Discard the wake up bytes
+        """
+        try:
+            while self._wakeup_r.recv(4096):
                 pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _send_to_client(self, cli):
+        """
+        Send the queued data of a writable client
+        """
+        with self._lock:
+            conn = self._clients.get(cli)
+        if conn is None:
+            return
 
-        return client_had_data, data
+        try:
+            self.sent_frames += conn.send()
+        except OSError as err:
+            print('Port %d: Client send error [%s]'%(self._port, repr(err)))
+            self._close_client(cli)
 
     def server_thread(self):
         """
@@ -246,82 +442,39 @@ class Server():
         if self._verbose:
             print('Starting server thread: host=%s, port=%d'%(self._host, self._port))
 
-        self._server.listen(self._maxclients)
-
-        if self._exit:
-            return
-
-        self._readfds.append(self._server)
+        self._server.setblocking(False)
 
-        while True:
+        while not self._exit:
             try:
-                ### Select: Detect activity in the server and client sockets
-                readable,\
-                writable,\
-                errored = select.select(self._readfds, self._writefds, [], self._timeout)
-                if not (readable or writable or errored):
-                    ### Timeout
-                    if self._exit:
-
-                        self._exit_requested()
-
-                        break
+                with self._lock:
+                    clients = list(self._clients.values())
+                readfds = [self._server, self._wakeup_r] + [conn.sock for conn in clients]
+                writefds = [conn.sock for conn in clients if conn.wants_write()]
 
-                    continue
-
-                for srvr in readable:
-
-                    self._accept_client_connections(srvr)
-
-
-                ######################################
-                ### Check if clients sent anything
-                ######################################
-                for cli in self._clients:
-
-                    for sock_r in readable:
-
-                        # At the moment we don't do anything with client data
-                        client_had_data, _ = self._handle_client_data(sock_r, cli)
-                        if client_had_data:
-                            continue
-
-                    for sock_w in writable: ### If sockets available tor writting
-
-                        if sock_w is cli:  ### Is the socket that has activity one of the clients???
-                            try:
-                                next_msg = self._message_queues[cli].get_nowait()
-                                if next_msg is None:
-                                    print('next_msg is None')
-                                    continue
-                            except Empty:
-                                #print('Queue is EMPTY')
-                                self._writefds.remove(cli)
-
-                            else:
-                                self._sendinprogress = True
-                                msglen = len(next_msg)
+                ### Select: Detect activity in the server and client sockets
+                readable, writable, _ = select.select(readfds, writefds, [], self._timeout)
 
-                                totallen = 0
-                                #start_time = time.time()
-                                while totallen < msglen:
-                                    ret = cli.send(next_msg[totallen:])
-                                    totallen += ret
+                for sock_r in readable:
+                    if sock_r is self._server:
+                        self._accept_client_connections()
+                    elif sock_r is self._wakeup_r:
+                        self._drain_wakeup()
+                    else:
+                        self._handle_client_data(sock_r)
 
-                                #print('Port %d Sendall time: %d bytes; %f sec'\
-                                #      %(self._port, totallen, time.time()-start_time),\
-                                #        time.time(), datetime.datetime.now())
-                                #self._writefds.remove(c)
-                                self._sendinprogress = False
+                for sock_w in writable:
+                    self._send_to_client(sock_w)
 
             except Exception as err:
-
+                if self._exit:
+                    break
                 exc_type, _, exc_tb = sys.exc_info()
                 print("Exception received: %s"%(repr(err)), exc_type, exc_tb.tb_lineno)
-                self._sendinprogress = False
 
+        self._exit_requested()
         print('Server Threaded Exit.')
         self._server.close()
+        self._wakeup_r.close()
 
     def start(self):
         """
@@ -335,7 +488,7 @@ class Server():
         """
         print('Closing server')
         self._exit = True
-        self._server.close()
+        self._wakeup()
 
 if __name__ == "__main__":
     SERVER = Server(8888, socket.gethostname(), verbose=True)
@@ -0,0 +1,274 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	shared_frames.py
+#  author:	S. Felipe Fregoso
+#  description:	Ring of shared memory slots used to pass frames and
+#               reconstruction products between components.  The arrays are
+#               written once by the publisher and only a small descriptor
+#               travels through the message queues.
+###############################################################################
+"""
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+
+### Byte alignment of the arrays within a slot
+ALIGNMENT = 64
+
+### Shared memory blocks attached by this process, {ring identifier: SharedMemory}
+_ATTACHED = {}
+
+def ack_identifier(identifier):
+    """
+    Return the publish identifier used to acknowledge slots of ring 'identifier'
+    """
+    return identifier + '_ack'
+
+class SlotDescriptor():
+    """
+    Description of one slot of a SharedFrameRing.
+
+    This is what is published instead of the arrays.  'fields' maps the name
+    of each array to its (offset, shape, dtype) within the shared memory block.
+    Subscribers publish the descriptor to 'ack_id' when done with the slot.
+    """
+    def __init__(self, ring, shm_name, slot, seq, fields):
+        """
+        Constructor
+        """
+        # pylint: disable=too-many-arguments
+        self.ring = ring
+        self.shm_name = shm_name
+        self.slot = slot
+        self.seq = seq
+        self.fields = fields
+        self.ack_id = ack_identifier(ring)
+
+    def views(self):
+        """
+        Return dictionary of read only arrays viewing the slot contents
+        """
+        shm = _attach(self.ring, self.shm_name)
+        arrays = {}
+        for name, (offset, shape, dtype) in self.fields.items():
+            arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            arr.flags.writeable = False
+            arrays[name] = arr
+
+        return arrays
+
+def _attach(ring, shm_name):
+    """
+    Attach to the shared memory block 'shm_name' and keep it open
+
+    A ring replaces its block when it has to grow, the block of the ring
+    previously attached is then closed.
+    """
+    shm = _ATTACHED.get(ring)
+    if shm is not None and shm.name == shm_name:
+        return shm
+
+    if shm is not None:
+        try:
+            shm.close()
+        except BufferError:
+            ### Views still reference it, the mapping is released with them
+            pass
+
+    ### Components are spawned by the same process and share its resource
+    ### tracker, so attaching doesn't take the block away from its creator.
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _ATTACHED[ring] = shm
+    return shm
+
+class SharedFrameRing():
+    """
+    Fixed number of equally sized slots in one shared memory block.
+
+    The publisher copies the arrays of a frame into a free slot with 'put'
+    and publishes the returned SlotDescriptor.  Each subscriber publishes the
+    descriptor back (see ack_identifier) when done with it and the slot is
+    free again once all 'readers' acknowledged it.  The block is (re)allocated
+    on the first 'put' or when a frame doesn't fit and no slot is in use.
+    """
+    def __init__(self, identifier, num_slots):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        identifier : str
+            Publish identifier of the data passed through the ring
+        num_slots : int
+            Number of frames which can be in flight at the same time
+        """
+        self.identifier = identifier
+        self.num_slots = num_slots
+        self._shm = None
+        self._slot_bytes = 0
+        self._refcount = [0] * num_slots
+        self._seq = [0] * num_slots
+        self._next_slot = 0
+        self._next_seq = 0
+        self._lock = threading.Lock()
+
+        self.puts = 0
+        self.full = 0
+
+    @staticmethod
+    def _layout(specs):
+        """
+        Return the (offset, shape, dtype) of each (shape, dtype) of 'specs'
+        in a slot and the slot size
+        """
+        fields = {}
+        nbytes = 0
+        for name, (shape, dtype) in specs.items():
+            dtype = np.dtype(dtype)
+            fields[name] = (nbytes, tuple(shape), dtype.str)
+            nbytes += -(-int(np.prod(shape)) * dtype.itemsize // ALIGNMENT) * ALIGNMENT
+
+        return fields, max(nbytes, ALIGNMENT)
+
+    def _allocate(self, slot_bytes):
+        """
+        Replace the shared memory block by one with slots of 'slot_bytes'
+        """
+        self.close()
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_bytes * self.num_slots)
+        self._slot_bytes = slot_bytes
+
+    def in_use(self):
+        """
+        Return number of slots waiting for acknowledgements
+        """
+        with self._lock:
+            return sum([1 for count in self._refcount if count > 0])
+
+    def reserve(self, specs, readers):
+        """
+        Reserve a free slot for arrays which are written in place
+
+        Parameters
+        ----------
+        specs : dict
+            Name and (shape, dtype) of each array of the slot
+        readers : int
+            Number of acknowledgements needed before the slot is reused
+
+        Returns
+        -------
+        (SlotDescriptor, dict) or None
+            Descriptor to publish once the arrays are written and the
+            writable arrays by name.  None if all slots are in use.
+            A slot which ends up not being published is given back with 'release'.
+        """
+        fields, nbytes = self._layout(specs)
+
+        with self._lock:
+            if nbytes > self._slot_bytes:
+                if any(self._refcount):
+                    self.full += 1
+                    return None
+                self._allocate(nbytes)
+
+            for i in range(self.num_slots):
+                slot = (self._next_slot + i) % self.num_slots
+                if self._refcount[slot] == 0:
+                    break
+            else:
+                self.full += 1
+                return None
+
+            self._next_slot = (slot + 1) % self.num_slots
+            self._next_seq += 1
+            self._seq[slot] = self._next_seq
+            self._refcount[slot] = readers
+            seq = self._next_seq
+            shm = self._shm
+            base = slot * self._slot_bytes
+            self.puts += 1
+
+        ### The slot is ours until acknowledged, the arrays are written outside of the lock
+        arrays = {}
+        for name, (offset, shape, dtype) in fields.items():
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=base + offset)
+            fields[name] = (base + offset, shape, dtype)
+
+        return SlotDescriptor(self.identifier, shm.name, slot, seq, fields), arrays
+
+    def put(self, arrays, readers):
+        """
+        Copy the arrays to a free slot
+
+        Parameters
+        ----------
+        arrays : dict
+            Name and np.array of each array to store
+        readers : int
+            Number of acknowledgements needed before the slot is reused
+
+        Returns
+        -------
+        SlotDescriptor or None
+            None if all slots are in use.  The caller should then publish
+            the arrays through the message queue.
+        """
+        reserved = self.reserve({name:(arr.shape, arr.dtype) for name, arr in arrays.items()}, readers)
+        if reserved is None:
+            return None
+
+        desc, slot_arrays = reserved
+        for name, dst in slot_arrays.items():
+            np.copyto(dst, arrays[name])
+
+        return desc
+
+    def release(self, desc):
+        """
+        Give back a reserved slot which was not published
+        """
+        with self._lock:
+            if self._shm is not None and desc.shm_name == self._shm.name \
+               and self._seq[desc.slot] == desc.seq:
+                self._refcount[desc.slot] = 0
+
+    def ack(self, desc):
+        """
+        Acknowledge a slot.  Stale descriptors (of a replaced block) are ignored.
+        """
+        with self._lock:
+            if self._shm is None or desc.shm_name != self._shm.name:
+                return
+            if self._seq[desc.slot] == desc.seq and self._refcount[desc.slot] > 0:
+                self._refcount[desc.slot] -= 1
+
+    def close(self):
+        """
+        Close and remove the shared memory block
+        """
+        if self._shm is None:
+            return
+
+        self._refcount = [0] * self.num_slots
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+        self._shm = None
+        self._slot_bytes = 0
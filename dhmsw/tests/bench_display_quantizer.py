@@ -0,0 +1,53 @@
+"""
+Benchmark of the display quantization of the reconstructed products.
+
+Compares the previous path
+    (product / np.max(product) * 255).astype(np.uint8)
+against 'DisplayQuantizer.quantize', which scales the product block by block
+into a reused uint8 image, with the min/max range, the running window range
+and the fixed phase range.  Reports time per frame and peak memory allocated
+per frame.
+
+usage: python bench_display_quantizer.py [hololen] [repeat]
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.append('../dhmsw/')
+from display_quantizer import DisplayQuantizer
+
+hololen = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+rng = np.random.RandomState(0)
+product = rng.uniform(-np.pi, np.pi, (hololen, hololen, 1, 1)).astype(np.float32)
+
+minmax = DisplayQuantizer()
+window = DisplayQuantizer(window=8)
+fixed = DisplayQuantizer(value_range=(-np.pi, np.pi))
+
+def previous_path():
+    norm = product / np.max(product) * 255
+    return norm.astype(dtype=np.uint8)
+
+def bench(name, func):
+    func()
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.time() - start) / repeat
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('%-12s %8.2f ms/frame  %8.1f MB allocated/frame'%(name, elapsed * 1e3, peak / 1024**2))
+
+print('hololen = %d, repeat = %d'%(hololen, repeat))
+bench('previous', previous_path)
+bench('minmax', lambda: minmax.quantize(product))
+bench('window', lambda: window.quantize(product))
+bench('fixed', lambda: fixed.quantize(product))
@@ -4,6 +4,21 @@ import configparser
 import sys
 sys.path.append('../dhmsw/')
 import metadata_classes as MetaC
+import kernel_cache
+import shared_frames
+import frame_admission
+import fourier_image
+import frame_reader
+import camera_receiver
+import server_client
+import async_server
+import image_views
+import display_quantizer
+import interface as Iface
+import dhmpubsub
+import pickle
+import queue
+import numpy as np
 
 GOOD_CONFIG_FNAME = './goodconfig.ini'
 BAD_CONFIG_FNAME = './badconfig.ini'
@@ -58,6 +73,502 @@ class TestUnitMetadataTestClass(object):
         
     
 
+class TestUnitKernelCacheTestClass(object):
+
+    def test_stableKey(cls):
+        """ Key does not depend on container type or argument order """
+        key1 = kernel_cache.KernelCache.make_key(propagation_distance=[0.01], wavelength=(405e-3, 532e-3))
+        key2 = kernel_cache.KernelCache.make_key(wavelength=np.array([405e-3, 532e-3]), propagation_distance=0.01)
+        assert key1 == key2
+
+    def test_lruEviction(cls):
+        """ Least recently used kernel is evicted when over byte budget """
+        kernel = np.zeros((16, 16, 1), dtype=np.complex64)
+        cache = kernel_cache.KernelCache(max_bytes=2*kernel.nbytes)
+        cache.put('a', kernel)
+        cache.put('b', kernel.copy())
+        assert cache.get('a') is not None
+        cache.put('c', kernel.copy())
+        assert 'b' not in cache
+        assert 'a' in cache and 'c' in cache
+        assert cache.get('b') is None
+        assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+
+    def test_diskBackingStore(cls, tmp_path):
+        """ Kernels stored by one cache are memory mapped by another """
+        kernel = (np.arange(64).reshape((8, 8, 1)) * 1j).astype(np.complex64)
+        cache = kernel_cache.KernelCache(cache_dir=str(tmp_path))
+        cache.put('k', kernel)
+        cache.store('k', kernel)
+
+        new_cache = kernel_cache.KernelCache(cache_dir=str(tmp_path))
+        loaded = new_cache.get('k')
+        assert isinstance(loaded, np.memmap)
+        np.testing.assert_array_equal(loaded, kernel)
+        assert new_cache.disk_loads == 1
+
+    def test_sparseBackingStore(cls, tmp_path):
+        """ Sparse kernels are stored as indices and values """
+        from shampoo_lite.sparse_kernel import SparseKernel
+        indices = [np.array([1, 5, 9]), np.array([0, 2])]
+        values = [(np.arange(6).reshape((3, 2)) * 1j).astype(np.complex64),
+                  np.ones((2, 2), dtype=np.complex64)]
+        cache = kernel_cache.KernelCache(cache_dir=str(tmp_path))
+        cache.store('s', SparseKernel(4, indices, values))
+
+        loaded = kernel_cache.KernelCache(cache_dir=str(tmp_path)).get('s')
+        assert isinstance(loaded, SparseKernel)
+        np.testing.assert_array_equal(loaded.to_dense(), SparseKernel(4, indices, values).to_dense())
+
+    def test_diskWriteError(cls, tmp_path, monkeypatch):
+        """ Failed writes keep the kernel in memory and leave no temporary files """
+        import os
+        def disk_full(*args, **kwargs):
+            raise OSError(28, 'No space left on device')
+        monkeypatch.setattr(kernel_cache.np, 'save', disk_full)
+
+        kernel = np.zeros((16, 16, 1), dtype=np.complex64)
+        cache = kernel_cache.KernelCache(cache_dir=str(tmp_path))
+        cache.put('k', kernel)
+        cache.store('k', kernel)
+        assert cache.get('k') is kernel
+        assert cache.disk_write_errors == 1
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_staleTemporaryFiles(cls, tmp_path):
+        """ Temporary files left over by failed writes are deleted """
+        import os
+        stale = tmp_path / 'stale.tmp'
+        recent = tmp_path / 'recent.tmp'
+        stale.write_bytes(b'x')
+        recent.write_bytes(b'x')
+        os.utime(str(stale), (0, 0))
+        kernel_cache.KernelCache(cache_dir=str(tmp_path))
+        assert os.listdir(str(tmp_path)) == ['recent.tmp']
+
+    def test_diskBudget(cls, tmp_path):
+        """ Least recently used kernel files are deleted when over the disk budget """
+        import os
+        kernel = np.zeros((16, 16, 1), dtype=np.complex64)
+        cache = kernel_cache.KernelCache(cache_dir=str(tmp_path), max_disk_bytes=2*kernel.nbytes + 256)
+        for age, key in enumerate(['a', 'b']):
+            cache.store(key, kernel)
+            os.utime(str(tmp_path / (key + '.npy')), (age, age))
+        cache.store('c', kernel)
+        assert sorted(os.listdir(str(tmp_path))) == ['b.npy', 'c.npy']
+        assert cache.disk_evictions == 1
+
+class TestUnitSharedFramesTestClass(object):
+
+    def test_putViewAck(cls):
+        """ Slot contents survive pickling of the descriptor and are reused after all acks """
+        ring = shared_frames.SharedFrameRing('rawframe', 2)
+        try:
+            img = np.arange(100, dtype=np.uint16).reshape((10, 10))
+            desc = ring.put({'image':img}, readers=2)
+            desc = pickle.loads(pickle.dumps(desc))
+            np.testing.assert_array_equal(desc.views()['image'], img)
+
+            assert ring.put({'image':img}, readers=1) is not None
+            assert ring.put({'image':img}, readers=1) is None
+            assert ring.full == 1
+
+            ring.ack(desc)
+            assert ring.in_use() == 2
+            ring.ack(desc)
+            assert ring.in_use() == 1
+            assert ring.put({'image':img + 1}, readers=1).slot == desc.slot
+        finally:
+            ring.close()
+
+    def test_reserveRelease(cls):
+        """ Reserved slot arrays are written in place and a released slot is free again """
+        ring = shared_frames.SharedFrameRing('rawframe', 1)
+        try:
+            desc, arrays = ring.reserve({'image':((4, 6), np.uint8)}, readers=1)
+            arrays['image'][...] = 7
+            np.testing.assert_array_equal(desc.views()['image'], np.full((4, 6), 7, dtype=np.uint8))
+            assert ring.reserve({'image':((4, 6), np.uint8)}, readers=1) is None
+
+            ring.release(desc)
+            assert ring.in_use() == 0
+            assert ring.reserve({'image':((4, 6), np.uint8)}, readers=1)[0].slot == desc.slot
+        finally:
+            ring.close()
+
+    def test_productRoundTrip(cls):
+        """ Product arrays travel through the ring and the ack reaches the publisher """
+        from shampoo_lite.reconstruction import ReconstructedWave
+
+        pub = dhmpubsub.PubSub()
+        ackq = queue.Queue()
+        pub.subscribe(shared_frames.ack_identifier('reconst_product'), ackq)
+        ring = shared_frames.SharedFrameRing('reconst_product', 1)
+        try:
+            product = Iface.ReconstructorProduct(np.zeros((4, 4), dtype=np.uint8), np.ones((4, 4), dtype=np.uint8),
+                                                 ReconstructedWave(np.ones((4, 4, 1, 1), dtype=np.complex64)),
+                                                 None, None)
+            product.reconstwave.amplitude
+            desc = ring.put(product.arrays(), readers=1)
+            received = pickle.loads(pickle.dumps(product.shared_copy(desc)))
+            assert received.image is None and received.reconstwave.reconstructed_wave is None
+
+            received.attach()
+            np.testing.assert_array_equal(received.ft_hologram, product.ft_hologram)
+            np.testing.assert_array_equal(received.reconstwave._amplitude_image, product.reconstwave._amplitude_image)
+            assert received.reconstwave._phase_image is None
+
+            received.release(pub)
+            ring.ack(ackq.get_nowait())
+            assert ring.in_use() == 0
+        finally:
+            ring.close()
+
+class TestUnitCameraReceiverTestClass(object):
+
+    def test_recvFrames(cls):
+        """ Frames split over several sends are received in place, extra packet bytes skipped """
+        import socket
+        pkt = Iface.CamServerFramePkt()
+        sender, receiver_sock = socket.socketpair()
+        try:
+            receiver = camera_receiver.CameraFrameReceiver(receiver_sock, pkt)
+            images = [np.arange(12, dtype=np.uint8).reshape((3, 4)) + i for i in range(2)]
+            for frameid, img in enumerate(images):
+                header = pkt.pkt_hdr_struct.pack(3, 4, 12, 16, 0, frameid, 0, *([0.] * 8))
+                data = header + img.tobytes() + bytes(4)
+                sender.sendall(data[:50])
+                sender.sendall(data[50:])
+
+            header = receiver.recv_header()
+            assert header[5] == 0
+            np.testing.assert_array_equal(receiver.recv_frame(header), images[0])
+
+            header = receiver.recv_header()
+            out = np.zeros(receiver.frame_shape(header), dtype=np.uint8)
+            assert receiver.recv_frame(header, out) is out
+            np.testing.assert_array_equal(out, images[1])
+            assert receiver.frames == 2
+            assert receiver.bytes == 2 * (pkt.header_packet_size() + 16)
+
+            sender.close()
+            assert receiver.recv_header() is None
+        finally:
+            receiver_sock.close()
+
+class TestUnitServerTestClass(object):
+
+    def test_queueDropsOldest(cls):
+        """ A full client queue drops its oldest message for the newest """
+        conn = server_client.ClientConnection(None, ('127.0.0.1', 1), queue_depth=2)
+        assert not conn.enqueue(b'1')
+        assert not conn.enqueue(b'2')
+        assert conn.enqueue(b'3')
+        assert list(conn.queue) == [b'2', b'3']
+        assert conn.stats()['dropped_frames'] == 1
+
+    def test_slowClientDoesNotStallOthers(cls):
+        """ A client which doesn't read only drops its own frames """
+        import socket
+        import time
+        server = server_client.Server(0, host='127.0.0.1', timeout=0.1)
+        port = server._server.getsockname()[1]
+        server.start()
+        slow = socket.create_connection(('127.0.0.1', port))
+        fast = socket.create_connection(('127.0.0.1', port))
+        try:
+            deadline = time.time() + 5
+            while len(server.client_stats()) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+
+            msg = bytes(1 << 20)
+            start = time.time()
+            for i in range(20):
+                server.send_to_all_clients(msg[:-1] + bytes([i]))
+                received = 0
+                while received < len(msg):
+                    data = fast.recv(len(msg) - received)
+                    assert data
+                    received += len(data)
+                last = data[-1]
+            assert time.time() - start < 5
+            assert last == 19
+
+            stats = server.client_stats()
+            assert max(stat['dropped_frames'] for stat in stats) > 0
+            assert min(stat['dropped_frames'] for stat in stats) == 0
+            assert server.dropped_frames > 0
+        finally:
+            slow.close()
+            fast.close()
+            server.exit()
+
+class TestUnitAsyncServerTestClass(object):
+
+    def recv_msg(cls, sock):
+        """ Receive one MessagePkt, header 'III' then the data """
+        import struct
+        def recv_exact(size):
+            data = b''
+            while len(data) < size:
+                chunk = sock.recv(size - len(data))
+                assert chunk
+                data += chunk
+            return data
+        header = recv_exact(12)
+        _, srcid, size = struct.unpack('III', header)
+        return srcid, recv_exact(size)
+
+    def test_channelsAndMultiplex(cls):
+        """ Channel ports get their channel, multiplex clients all their subscriptions """
+        import socket
+        import time
+        core = async_server.AsyncServerCore({'fourier':0, 'reconst_amp':0}, multiplex_port=0)
+        core.start()
+        try:
+            fourier = socket.create_connection(('127.0.0.1', core.ports['fourier']))
+            multi = socket.create_connection(('127.0.0.1', core.multiplex_port))
+            multi.sendall(b'subscribe fourier reconst_amp\n')
+            deadline = time.time() + 5
+            while not (core.has_clients('fourier') and core.has_clients('reconst_amp')) \
+                  and time.time() < deadline:
+                time.sleep(0.01)
+            assert len(core.client_stats('fourier')) == 2
+
+            for srcid, name in [(1, 'fourier'), (2, 'reconst_amp')]:
+                pkt = Iface.MessagePkt(Iface.IMAGE_TYPE, srcid)
+                pkt.append(np.full((4, 4), srcid, dtype=np.uint8))
+                core.channel(name).send_to_all_clients(pkt.to_buffers())
+
+            assert cls.recv_msg(fourier)[0] == 1
+            assert [cls.recv_msg(multi)[0] for _ in range(2)] == [1, 2]
+            ### Counted after the write returns in the event loop thread
+            while core.sent_frames != {'fourier':2, 'reconst_amp':1} and time.time() < deadline:
+                time.sleep(0.01)
+            assert core.sent_frames == {'fourier':2, 'reconst_amp':1}
+            fourier.close()
+            multi.close()
+        finally:
+            core.exit()
+
+    def test_viewRequest(cls):
+        """ Clients get the image of their view, packed once per distinct view """
+        import socket
+        import struct
+        import time
+        core = async_server.AsyncServerCore({'reconst_amp':0}, multiplex_port=None,
+                                            parse_request=image_views.parse_view_request)
+        core.start()
+        try:
+            full = socket.create_connection(('127.0.0.1', core.ports['reconst_amp']))
+            small = socket.create_connection(('127.0.0.1', core.ports['reconst_amp']))
+            small.sendall(b'view decimation=4 plane=0,1\n')
+            deadline = time.time() + 5
+            while [client.view('reconst_amp') is not None for client in core._subscribers['reconst_amp']] \
+                  .count(True) != 1 and time.time() < deadline:
+                time.sleep(0.01)
+
+            image = np.arange(16 * 16 * 1 * 2, dtype=np.uint8).reshape((16, 16, 1, 2))
+            core.channel('reconst_amp').send_to_all_clients(Iface.ImageMessage(Iface.IMAGE_TYPE, 2, image))
+
+            for sock, expected in [(full, image), (small, image[::4, ::4, 0:1, 1:2])]:
+                _, data = cls.recv_msg(sock)
+                ndim = struct.unpack_from('H', data)[0]
+                shape = struct.unpack_from('H' * ndim, data, 2)
+                assert shape == expected.shape
+                np.testing.assert_array_equal(np.frombuffer(data[2 + 2 * ndim:], dtype=np.uint8).reshape(shape),
+                                              expected)
+            full.close()
+            small.close()
+        finally:
+            core.exit()
+
+class TestUnitImageViewsTestClass(object):
+
+    def test_parseAndApply(cls):
+        """ Views keep the decimated region of interest of the selected plane """
+        channels, view = image_views.parse_view_request('view reconst_amp decimation=2 roi=2,1,4,3 plane=1,5')
+        assert channels == ['reconst_amp']
+        assert view.key() == (2, (2, 1, 4, 3), (1, 5), 'none', None)
+
+        image = np.arange(8 * 8 * 2 * 3).reshape((8, 8, 2, 3))
+        np.testing.assert_array_equal(view.apply(image), image[1:4:2, 2:6:2, 1:2, 2:3])
+        np.testing.assert_array_equal(view.apply(image[:, :, 0, 0]), image[1:4:2, 2:6:2, 0, 0])
+
+        assert image_views.parse_view_request('view')[1].is_full()
+        assert image_views.parse_view_request('subscribe fourier') is None
+        with pytest.raises(ValueError):
+            image_views.parse_view_request('view decimation=0')
+
+class TestUnitImageCodecsTestClass(object):
+
+    def test_compressedRoundTrip(cls):
+        """ Encoded images decode to the view of the image, or are sent as is """
+        import struct
+        image = (np.arange(64 * 64 * 1 * 2) % 7).astype(np.uint8).reshape((64, 64, 1, 2))
+        message = Iface.ImageMessage(Iface.IMAGE_TYPE, Iface.SRCID_IMAGE_AMPLITUDE, image)
+
+        for request, lossless in [('view codec=zlib', True),
+                                  ('view codec=png plane=0,1', True),
+                                  ('view codec=jpeg plane=0,1 level=95', False)]:
+            view = image_views.parse_view_request(request)[1]
+            data = b''.join(message.to_buffers(view))
+            msgid, srcid, size = struct.unpack_from('III', data)
+            assert (msgid, srcid, size) == (Iface.IMAGE_COMPRESSED_TYPE, Iface.SRCID_IMAGE_AMPLITUDE, len(data) - 12)
+            ndim = struct.unpack_from('H', data, 12)[0]
+            dims = struct.unpack_from('H' * ndim, data, 14)
+            decoded = Iface.unpack_compressed_image(data, 14 + 2 * ndim, dims)
+            expected = view.apply(image)
+            assert decoded.shape == expected.shape
+            if lossless:
+                np.testing.assert_array_equal(decoded, expected)
+            else:
+                assert np.abs(decoded.astype(int) - expected).max() <= 8
+
+        ### PNG can't encode several planes, the image is sent as is
+        view = image_views.parse_view_request('view codec=png')[1]
+        assert struct.unpack_from('I', b''.join(message.to_buffers(view)))[0] == Iface.IMAGE_TYPE
+
+class TestUnitDisplayQuantizerTestClass(object):
+
+    def test_quantize(cls):
+        """ Images are scaled to the full uint8 range into a reused image """
+        rng = np.random.RandomState(0)
+        image = rng.uniform(-3, 5, (300, 257, 2, 1)).astype(np.float32)
+        quantizer = display_quantizer.DisplayQuantizer()
+        out = quantizer.quantize(image)
+        expected = np.rint((image - image.min()) / (image.max() - image.min()) * 255)
+        assert out.dtype == np.uint8 and out.shape == image.shape
+        assert np.abs(out.astype(int) - expected).max() <= 1
+        assert out.min() == 0 and out.max() == 255
+        assert quantizer.quantize(image) is out
+
+        ### Each plane spans the full range
+        quantizer = display_quantizer.DisplayQuantizer(per_plane=True)
+        image[:, :, 1, 0] *= 0.1
+        out = quantizer.quantize(image)
+        assert out[:, :, 1, 0].max() == 255 and out[:, :, 1, 0].min() == 0
+
+        ### Constant images don't divide by zero
+        out = display_quantizer.DisplayQuantizer().quantize(np.ones((8, 8), dtype=np.float32))
+        assert not out.any()
+
+    def test_phaseRange(cls):
+        """ Negative phases map below the middle of the range instead of to 0 """
+        phase = np.array([[-np.pi, -np.pi / 2, 0, np.pi]], dtype=np.float32)
+        out = display_quantizer.DisplayQuantizer(value_range=(-np.pi, np.pi)).quantize(phase)
+        assert list(out[0]) == [0, 64, 128, 255]
+
+    def test_windowAndPercentile(cls):
+        """ The running window keeps the range of the last frames """
+        quantizer = display_quantizer.DisplayQuantizer(window=2)
+        quantizer.quantize(np.array([[0., 10.]], dtype=np.float32))
+        out = quantizer.quantize(np.array([[0., 5.]], dtype=np.float32))
+        assert list(out[0]) == [0, 128]
+        out = quantizer.quantize(np.array([[0., 5.]], dtype=np.float32))
+        assert list(out[0]) == [0, 255]
+
+        ### Outliers saturate with the percentile scaling
+        image = np.tile(np.arange(100, dtype=np.float32), (100, 1))
+        image[0, 0] = 1e6
+        out = display_quantizer.DisplayQuantizer(scaling='percentile').quantize(image)
+        assert out[50, 50] > 100
+
+class TestUnitFrameAdmissionTestClass(object):
+
+    def test_latestWins(cls):
+        """ Only the most recent frame waits, replaced frames are counted as dropped """
+        admission = frame_admission.FrameAdmission('latest')
+        assert admission.put(1) == []
+        assert admission.put(2) == [1]
+        assert admission.put(3) == [2]
+        assert admission.get() == (0, 3)
+        assert admission.in_flight == 1
+        admission.task_done()
+        assert (admission.received, admission.dropped, admission.processed, admission.in_flight) == (3, 2, 1, 0)
+
+    def test_boundedQueue(cls):
+        """ Oldest pending frame is dropped when the queue is full """
+        admission = frame_admission.FrameAdmission('queue', depth=2)
+        for frame in range(3):
+            admission.put(frame)
+        assert [admission.get(), admission.get()] == [(0, 1), (1, 2)]
+        assert admission.dropped == 1
+
+    def test_everyNth(cls):
+        """ Every Nth frame is admitted and close releases the pending frames """
+        admission = frame_admission.FrameAdmission('every_nth', depth=4, decimation=3)
+        dropped = []
+        for frame in range(7):
+            dropped += admission.put(frame)
+        assert dropped == [1, 2, 4, 5]
+        assert admission.close() == [0, 3, 6]
+        assert admission.get() is None
+        assert admission.dropped == 7
+
+    def test_resequencer(cls):
+        """ Products are published in sequence order, skipped frames don't block """
+        published = []
+        resequencer = frame_admission.Resequencer(published.append)
+        resequencer.push(2, 'c')
+        resequencer.push(1, None)
+        assert published == [] and resequencer.waiting == 2
+        resequencer.push(0, 'a')
+        resequencer.push(3, 'd')
+        assert published == ['a', 'c', 'd'] and resequencer.waiting == 0
+
+class TestUnitProductDemandTestClass(object):
+
+    def test_demandMessage(cls):
+        """ Demand survives the message queues and covers every processing mode product """
+        demand = pickle.loads(pickle.dumps(Iface.ProductDemand('guiserver', ['phase', 'fourier'])))
+        assert demand.get_name() == 'guiserver'
+        assert demand.get_products() == frozenset(['phase', 'fourier'])
+        products = set()
+        for mode_products in MetaC.ReconstructionMetadata.MODE_PRODUCTS.values():
+            products.update(mode_products)
+        assert products == set(['amplitude', 'intensity', 'phase'])
+
+class TestUnitFrameReaderTestClass(object):
+
+    def test_mappedFrames(cls, tmp_path):
+        """ Uncompressed TIFF, BMP and raw frames are memory mapped and read in order """
+        from PIL import Image
+        frame = (np.random.RandomState(0).rand(30, 37) * 255).astype(np.uint8)
+        Image.fromarray(frame).save(str(tmp_path / 'a.tif'))
+        Image.fromarray(frame).save(str(tmp_path / 'b.bmp'))
+        frame.tofile(str(tmp_path / 'c.raw'))
+
+        flist = [str(tmp_path / name) for name in ['a.tif', 'b.bmp', 'c.raw']]
+        reader = frame_reader.PrefetchingFrameReader(flist, depth=2, raw_shape=frame.shape)
+        try:
+            frames = list(reader)
+        finally:
+            reader.close()
+
+        assert [fname for fname, _ in frames] == flist
+        for _, img in frames:
+            np.testing.assert_array_equal(img, frame)
+            assert not img.flags.writeable
+
+class TestUnitFourierImageTestClass(object):
+
+    def test_blockMax(cls):
+        """ Each block keeps its maximum, partial blocks at the edges included """
+        arr = np.arange(25, dtype=np.float32).reshape((5, 5))
+        assert np.array_equal(fourier_image.block_max(arr, 2),
+                              [[6, 8, 9], [16, 18, 19], [21, 23, 24]])
+
+    def test_displayImage(cls):
+        """ Decimated log magnitude spans 0 to 255 and keeps the peak """
+        ft_hologram = np.ones((100, 100), dtype=np.complex64)
+        ft_hologram[10, 70] = 1000j
+        ft_hologram[50, 50] = 0
+        image = fourier_image.fourier_display_image(ft_hologram, size=25)
+        assert image.shape == (25, 25) and image.dtype == np.uint8
+        assert image[2, 17] == 255 and image.min() == 0
+        assert fourier_image.fourier_display_image(ft_hologram).shape == (100, 100)
+
 @pytest.fixture
 def goodFileName():
     return './goodconfig.ini'
@@ -97,7 +97,10 @@ class guiclient(object):
                     dtype = np.uint8
                     w, h, z, l = dimensions
     
-                outdata = np.fromstring(msg[offset:offset+(functools.reduce(lambda x,y: x*y, dimensions)*np.dtype(dtype).itemsize)], dtype=dtype).reshape(dimensions)
+                if msgid == interface.IMAGE_COMPRESSED_TYPE:
+                    outdata = interface.unpack_compressed_image(msg, offset, dimensions)
+                else:
+                    outdata = np.fromstring(msg[offset:offset+(functools.reduce(lambda x,y: x*y, dimensions)*np.dtype(dtype).itemsize)], dtype=dtype).reshape(dimensions)
     
                 offset += (functools.reduce(lambda x,y: x*y, dimensions)*np.dtype(dtype).itemsize)
                 if PLOT:
@@ -123,7 +126,7 @@ class guiclient(object):
 
         print('End of DisplayThread')
 
-    def connect_to_server(self, server, port):
+    def connect_to_server(self, server, port, codec=None):
 
         #headerStruct = struct.Struct('HHBIIIHH')
 
@@ -135,6 +138,9 @@ class guiclient(object):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((server, port))
         self.readfds = [self.sock]
+        ### Ask the server to encode the images
+        if codec is not None:
+            self.sock.sendall(('view codec=%s\n'%(codec)).encode())
 
         ### Start Display Thread
         self.displaythread.start()
@@ -211,4 +217,6 @@ if __name__ == "__main__":
     host= socket.gethostname()
     port = 9998
     print("Client host:  %s: port: %d"%(host, port)) 
-    a.connect_to_server(host, port) 
+    ### Optional codec of the images: zlib, lz4, png or jpeg
+    codec = sys.argv[1] if len(sys.argv) > 1 else None
+    a.connect_to_server(host, port, codec)
@@ -0,0 +1,60 @@
+"""
+Benchmark of the per wavelength reconstruction step 'compute_wave'.
+
+Compares the previous path
+    np.roll(angular_spectrum * mask, shift) * kernel  ->  centered ifft
+against the current 'compute_wave', which masks, rolls and multiplies in
+the aligned FFT input buffer.  Reports time per call and peak memory
+allocated per call.
+
+usage: python bench_compute_wave.py [hololen] [repeat]
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from shampoo_lite.reconstruction import (compute_wave)
+from shampoo_lite.fftutils import (ifft2_centered)
+
+hololen = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+dk = 0.01
+center_x, center_y, radius = int(0.7 * hololen), int(0.3 * hololen), hololen // 12
+
+rng = np.random.RandomState(0)
+angular_spectrum = (rng.rand(hololen, hololen) + 1j * rng.rand(hololen, hololen)).astype(np.complex64)
+rows, cols = np.indices((hololen, hololen))
+mask = (rows - center_x)**2 + (cols - center_y)**2 < radius**2
+kernel = np.zeros((hololen, hololen), dtype=np.complex64)
+kernel[(rows - hololen//2)**2 + (cols - hololen//2)**2 < radius**2] = np.exp(1j * 0.3)
+arg = (mask, center_x, center_y)
+
+def previous_path():
+    proppedWave = np.roll(angular_spectrum * mask,
+                          (int(hololen/2 - center_x), int(hololen/2 - center_y)),
+                          axis=(0, 1)) * kernel
+    return ifft2_centered(proppedWave, (hololen * dk * hololen * dk)/(2 * np.pi))
+
+def fused_path():
+    return compute_wave(angular_spectrum, hololen, dk, kernel, arg)
+
+def bench(name, func):
+    func() # Create plan
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.time() - start) / repeat
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('%-10s %8.2f ms/call  %8.1f MB allocated/call'%(name, elapsed * 1e3, peak / 1024**2))
+
+np.testing.assert_allclose(fused_path(), previous_path(), rtol=1e-3, atol=1e-6)
+
+print('hololen = %d, repeat = %d'%(hololen, repeat))
+bench('previous', previous_path)
+bench('fused', fused_path)
@@ -0,0 +1,50 @@
+"""
+Benchmark of the centered inverse FFT used by the reconstruction.
+
+Compares the np.take based path  fftshift(ifft2(fftshift(x))) * scale
+against the checkerboard modulated 'ifft2_centered' writing into a
+preallocated output array.  Reports time per call and peak memory
+allocated per call.
+
+usage: python bench_fftshift.py [hololen] [repeat]
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from shampoo_lite.fftutils import (fftshift, ifft2, ifft2_centered)
+
+hololen = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+scale = 1.0 / (2 * np.pi)
+
+rng = np.random.RandomState(0)
+x = (rng.rand(hololen, hololen) + 1j * rng.rand(hololen, hololen)).astype(np.complex64)
+out = np.empty_like(x)
+
+def take_path():
+    return fftshift(ifft2(fftshift(x))) * scale
+
+def centered_path():
+    return ifft2_centered(x, scale, out=out)
+
+def bench(name, func):
+    func() # Create plan
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.time() - start) / repeat
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('%-10s %8.2f ms/call  %8.1f MB allocated/call'%(name, elapsed * 1e3, peak / 1024**2))
+
+np.testing.assert_allclose(centered_path(), take_path(), rtol=1e-3, atol=1e-6)
+
+print('hololen = %d, repeat = %d'%(hololen, repeat))
+bench('np.take', take_path)
+bench('centered', centered_path)
@@ -0,0 +1,58 @@
+"""
+Benchmark of the reconstruction products amplitude, intensity and phase.
+
+Compares the previous path
+    amplitude = (w * conj(w)).real,  intensity = amplitude**2,  phase = np.angle(w)
+against 'ReconstructedWave.compute', which derives the three products in one
+blocked pass over the wave into preallocated float32 arrays.  Reports time
+per frame and peak memory allocated per frame.
+
+usage: python bench_products.py [hololen] [repeat]
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from shampoo_lite.reconstruction import (ReconstructedWave)
+
+hololen = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+rng = np.random.RandomState(0)
+wave = (rng.randn(hololen, hololen, 1, 1) + 1j * rng.randn(hololen, hololen, 1, 1)).astype(np.complex64)
+out = {name:np.empty(wave.shape, dtype=np.float32) for name in ['amplitude', 'intensity', 'phase']}
+
+def previous_path():
+    amplitude = (wave * np.conj(wave)).real
+    intensity = amplitude ** 2
+    phase = np.angle(wave)
+    return amplitude, intensity, phase
+
+def single_pass():
+    www = ReconstructedWave(wave)
+    www.compute(out=out)
+    return www.amplitude, www.intensity, www.phase
+
+def bench(name, func):
+    func()
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.time() - start) / repeat
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('%-12s %8.2f ms/frame  %8.1f MB allocated/frame'%(name, elapsed * 1e3, peak / 1024**2))
+
+amplitude, intensity, phase = single_pass()
+np.testing.assert_allclose(amplitude, np.abs(wave), rtol=1e-5)
+np.testing.assert_allclose(intensity, previous_path()[0], rtol=1e-5)
+np.testing.assert_allclose(phase, np.angle(wave), rtol=1e-5, atol=1e-6)
+
+print('hololen = %d, repeat = %d'%(hololen, repeat))
+bench('previous', previous_path)
+bench('single pass', single_pass)
@@ -1,22 +1,31 @@
 
-__all__ = ['fft2', 'ifft2', 'fft3', 'ifft3', 'fftshift', 'FFT_3']
+__all__ = ['fft2', 'ifft2', 'fft3', 'ifft3', 'fft2_centered', 'ifft2_centered', 'ifft2_masked_centered', 'ifft2_sparse_centered', 'fftshift', 'FFT_3', 'plan_pool']
 
 try:
     import multiprocessing # NOTE Purposely to trigger exception
-    from .pyfftw_utils import (FFT_3, fftshift)
+    from .pyfftw_utils import (FFT_3, FFTWPlanPool, fftshift)
     from .datatypes import (FLOATDTYPE, COMPLEXDTYPE, FRAMEDIMENSIONS, NUMFFTTHREADS)
 
-    myFFT3 = None
+    plan_pool = None
     fft3   = None
     ifft3  = None
     fft2   = None
     ifft2  = None
-    
-    myFFT3 = FFT_3(FRAMEDIMENSIONS, FLOATDTYPE, COMPLEXDTYPE, threads=NUMFFTTHREADS)
-    fft3   = myFFT3.fft3
-    ifft3  = myFFT3.ifft3
-    fft2   = myFFT3.fft2
-    ifft2  = myFFT3.ifft2
+    fft2_centered = None
+    ifft2_centered = None
+    ifft2_masked_centered = None
+    ifft2_sparse_centered = None
+
+    ### Plans are created on first use of each shape, see 'plan_pool.configure'
+    plan_pool = FFTWPlanPool(FLOATDTYPE, COMPLEXDTYPE, threads=NUMFFTTHREADS)
+    fft3   = plan_pool.fft2
+    ifft3  = plan_pool.ifft2
+    fft2   = plan_pool.fft2
+    ifft2  = plan_pool.ifft2
+    fft2_centered = plan_pool.fft2_centered
+    ifft2_centered = plan_pool.ifft2_centered
+    ifft2_masked_centered = plan_pool.ifft2_masked_centered
+    ifft2_sparse_centered = plan_pool.ifft2_sparse_centered
 
     print('Import FFT utilities from "pyfftw_utils"')
 except Exception as e:
@@ -29,4 +38,5 @@ except Exception as e:
     ifft3 = np.fft.ifftn
     fftshift = np.fft.fftshift
     FFT_3 = None
+    plan_pool = None
     print('Import FFT utilities from "numpy"')
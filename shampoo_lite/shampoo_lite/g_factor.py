@@ -1,5 +1,8 @@
 import numpy as np
-from datatypes import (FLOATDTYPE, COMPLEXDTYPE)
+from .datatypes import (FLOATDTYPE, COMPLEXDTYPE)
+
+### Default cap on the temporaries of 'compute_propagation_kernel_batch'
+DEFAULT_CHUNK_BYTES = 256 * 1024**2
 
 class PropagationKernel(object):
     def __init__(self, N, wavelength, propagation_distance):
@@ -20,26 +23,86 @@ def circ_prop(kx, ky, k):
     return z.astype(np.float)
 
 def compute_propagation_kernel(propagation_distance, N, dx, dy, wavelength, spectralmask):
-
-    propagation_distance = np.atleast_1d(propagation_distance).reshape(1,1,-1).astype(FLOATDTYPE)
-    wavelength = np.atleast_1d(wavelength).reshape(1,1,-1).astype(FLOATDTYPE)
-    G = np.zeros((N, N, propagation_distance.size, wavelength.size), dtype=COMPLEXDTYPE)
-
-    dk = 2*np.pi/(N*dx)
-    kx = np.arange(-N/2,N/2) * dk
-    ky = np.arange(-N/2,N/2) * dk
-    for li in range(wavelength.size):
-        wvl = wavelength[0,0,li]
-        for di in range(propagation_distance.size):
-            d = propagation_distance[0,0,di]
-
-            k0 = 2*np.pi/wvl
-            Kx, Ky = np.meshgrid(kx, ky)
-
-            propArray = np.sqrt(k0**2 - (Kx**2 + Ky**2) * circ_prop(Kx,Ky,k0)) # This term does not depend on the reconstruction distance
-            propKernel = np.zeros((N,N))*1j # The 1j here makes the zero array complex
-            #propKernel[spectralmask] = np.exp( 1j*propagation_distance* propArray[spectralmask] )
-            G[:,:,di,li] = np.exp( 1j*d* propArray)
+    """
+    Return the unmasked N x N x distance x wavelength propagation kernel.
+    See 'compute_propagation_kernel_batch'.
+    """
+    return compute_propagation_kernel_batch(propagation_distance, N, dx, wavelength)
+
+def _row_chunks(row_start, row_stop, bytes_per_row, max_chunk_bytes):
+    """
+    Yield row slices of [row_start, row_stop) whose temporaries fit in max_chunk_bytes
+    """
+    rows = row_stop - row_start
+    if max_chunk_bytes:
+        rows = max(1, int(max_chunk_bytes // bytes_per_row))
+
+    for start in range(row_start, row_stop, rows):
+        yield slice(start, min(start + rows, row_stop))
+
+def compute_propagation_kernel_batch(propagation_distance, N, dx, wavelength,
+                                     spectral_mask_centered=None,
+                                     max_chunk_bytes=DEFAULT_CHUNK_BYTES,
+                                     out=None):
+    """
+    Compute the angular spectrum propagation kernel of every distance and
+    wavelength at once
+
+        G[:, :, d, l] = exp(1j * distance[d] * sqrt(k0[l]**2 - k**2))
+
+    where k**2 is set to 0 outside the propagating disk k < k0.  The squared
+    frequency radius grid is computed once and the whole N x N x D x L
+    kernel is filled by broadcasting, a block of rows at a time so the
+    temporaries stay below 'max_chunk_bytes'.
+
+    Parameters
+    ----------
+    propagation_distance : float or array of floats
+        Propagation distances (D) in the units of 'dx' and 'wavelength'
+    N : int
+        Length of the hologram in pixels
+    dx : float
+        Pixel width in object space
+    wavelength : float or array of floats
+        Wavelengths (L)
+    spectral_mask_centered : N x N x L np.array or None
+        If given, the kernel is zero outside the mask of each wavelength and
+        only the rows holding a mask are computed
+    max_chunk_bytes : int or None
+        Cap on the size of the temporaries, None computes all rows at once
+    out : N x N x D x L np.array or None
+        Array where the kernel is written.  Allocated if None.
+
+    Return : N x N x D x L np.array
+        Propagation kernel
+    """
+    distance = np.atleast_1d(propagation_distance).astype(np.float64).reshape((1, 1, -1, 1))
+    k0 = (2 * np.pi / np.atleast_1d(wavelength).astype(np.float64)).reshape((1, 1, 1, -1))
+
+    dk = 2 * np.pi / (N * dx)
+    k = np.arange(-N/2, N/2) * dk
+    ksq = k[:, np.newaxis]**2 + k[np.newaxis, :]**2
+
+    G = out
+    if G is None:
+        G = np.zeros((N, N, distance.size, k0.size), dtype=COMPLEXDTYPE)
+
+    row_start, row_stop = 0, N
+    if spectral_mask_centered is not None:
+        mask = np.asarray(spectral_mask_centered).reshape((N, N, 1, k0.size))
+        rows = np.flatnonzero(mask.any(axis=(1, 2, 3)))
+        row_start, row_stop = (rows[0], rows[-1] + 1) if rows.size else (0, 0)
+        G[:row_start] = 0
+        G[row_stop:] = 0
+
+    ### complex128 exponent plus float64 radius grid per element
+    bytes_per_row = N * distance.size * k0.size * 24
+    for rows in _row_chunks(row_start, row_stop, bytes_per_row, max_chunk_bytes):
+        chunk_ksq = ksq[rows, :, np.newaxis, np.newaxis]
+        kz = np.sqrt(k0**2 - chunk_ksq * (chunk_ksq < k0**2))
+        np.exp(1j * distance * kz, out=G[rows])
+        if spectral_mask_centered is not None:
+            G[rows] *= mask[rows]
 
     return G
 
@@ -1,7 +1,8 @@
 
+import threading
+import collections
 import numpy as np
 from .datatypes import (BOOLDTYPE)
-from .util import (circ_prop)
 
 class Circle(object):
 
@@ -18,91 +19,129 @@ class Circle(object):
             self._params = (self.centerx, self.centery, self.radius)
         return self._params
 
+### Masks of recently used circles, {(N, centered, circle params): mask}
+_MASK_CACHE = collections.OrderedDict()
+_MASK_CACHE_LOCK = threading.Lock()
+MASK_CACHE_SIZE = 8
+
+def _draw_disk(out, center_row, center_col, radius):
+    """
+    Set the pixels of the 2D array 'out' which are strictly within 'radius'
+    of (center_row, center_col) to True.  Only the bounding box of the disk
+    is evaluated.
+    """
+    half = int(np.ceil(radius))
+    row0 = max(0, int(np.floor(center_row)) - half)
+    row1 = min(out.shape[0], int(np.ceil(center_row)) + half + 1)
+    col0 = max(0, int(np.floor(center_col)) - half)
+    col1 = min(out.shape[1], int(np.ceil(center_col)) + half + 1)
+    if row0 >= row1 or col0 >= col1:
+        return
+
+    drow = np.arange(row0, row1) - center_row
+    dcol = np.arange(col0, col1) - center_col
+    out[row0:row1, col0:col1] = drow[:, None]**2 + dcol[None, :]**2 < radius**2
+
+def build_mask(N, circle_params, centered=False):
+    """
+    Return the N x N x len(circle_params) boolean mask of the circles
+
+    Masks are cached by circle parameters and returned read only.
+
+    Parameters
+    ----------
+    N : int
+        Rows and columns of the mask
+    circle_params : list of (centerx, centery, radius)
+        Circles in pixels.  'centerx' is the column and 'centery' the row.
+    centered : boolean
+        If TRUE the circles are drawn around the zero frequency instead
+        of their center
+    """
+    key = (int(N), bool(centered), tuple([tuple([float(p) for p in params]) for params in circle_params]))
+    with _MASK_CACHE_LOCK:
+        mask = _MASK_CACHE.get(key)
+        if mask is not None:
+            _MASK_CACHE.move_to_end(key)
+            return mask
+
+    print("%s MASK COMPUTED"%("CENTERED" if centered else "UNCENTERED"))
+    mask = np.zeros((N, N, len(circle_params)), dtype=BOOLDTYPE)
+    for i, (centerx, centery, radius) in enumerate(circle_params):
+        if centered:
+            ### Zero frequency of the frequency grid np.arange(-N/2, N/2)
+            center_row, center_col = N/2, N/2
+        else:
+            center_row, center_col = int(centery), int(centerx)
+        _draw_disk(mask[:, :, i], center_row, center_col, radius)
+    mask.flags.writeable = False
+
+    with _MASK_CACHE_LOCK:
+        _MASK_CACHE[key] = mask
+        while len(_MASK_CACHE) > MASK_CACHE_SIZE:
+            _MASK_CACHE.popitem(last=False)
+
+    return mask
+
 class Mask(object):
     def __init__(self, N, circle_list, dk):
 
-        self.kx = np.arange(-N/2, N/2) * dk
-        self.ky = np.arange(-N/2, N/2) * dk
-        self.f_mgrid = np.meshgrid(self.kx, self.ky)
-
         self.N = N
         self.circle_list = circle_list
         self.dk = dk
 
+        self._f_mgrid = None
         self._mask_centered = None
         self._mask_uncentered = None
-        self._mask_coordinates = []
+        self._mask_number = None
+        self._mask_coordinates = [circle.get_params for circle in self.circle_list]
+
+    @property
+    def kx(self):
+        return np.arange(-self.N/2, self.N/2) * self.dk
 
-        for _ in range(len(self.circle_list)):
-    
-            centerx, centery, radius = self.circle_list[_].get_params
-            print("centerx: ", centerx);
-            print("centery: ", centery);
-            print("radius: ", radius);
-            self._mask_coordinates.append(self.circle_list[_].get_params)
+    @property
+    def ky(self):
+        return np.arange(-self.N/2, self.N/2) * self.dk
 
-        #self.mask_uncentered
+    @property
+    def f_mgrid(self):
+        """
+        Frequency grid, only built when used
+        """
+        if self._f_mgrid is None:
+            self._f_mgrid = np.meshgrid(self.kx, self.ky)
+        return self._f_mgrid
 
     @property
     def mask(self):
-        return self.mask_uncentered 
+        return self.mask_uncentered
 
     @property
     def mask_uncentered(self):
         if self._mask_uncentered is None:
-            self._mask_uncentered = np.zeros((self.N, self.N, len(self.circle_list)), dtype=BOOLDTYPE) 
-    
-            for _ in range(len(self.circle_list)):
-    
-                centerx, centery, radius = self._mask_coordinates[_]
-
-                self._mask_uncentered[:, :, _], \
-                __ = self.spectral_mask(centerx, centery, radius, compute_uncentered=True)
-    
-            self._mask_number = np.sum(self._mask_uncentered ** 2)
-
-#            self._mask_centered = np.zeros((self.N, self.N, len(self.circle_list)), dtype=BOOLDTYPE) 
-#            self._mask_uncentered = np.zeros((self.N, self.N, len(self.circle_list)), dtype=BOOLDTYPE) 
-#    
-#            for _ in range(len(self.circle_list)):
-#    
-#                centerx, centery, radius = self.circle_list[_].get_params
-#                print("centerx: ", centerx);
-#                print("centery: ", centery);
-#                print("radius: ", radius);
-#                self._mask_coordinates.append(self.circle_list[_].get_params)
-#                self._mask_uncentered[:, :, _], \
-#                self._mask_centered[:, :, _] = self.spectral_mask(centerx, centery, radius)
-#    
-#            self._mask_number = np.sum(self._mask_uncentered ** 2)
-
-        return self._mask_uncentered 
+            self._mask_uncentered = build_mask(self.N, self._mask_coordinates)
+            self._mask_number = np.count_nonzero(self._mask_uncentered)
+
+        return self._mask_uncentered
 
     @property
     def mask_centered(self):
         if self._mask_centered is None:
-            self._mask_centered = np.zeros((self.N, self.N, len(self.circle_list)), dtype=BOOLDTYPE) 
-    
-            for _ in range(len(self.circle_list)):
-    
-                centerx, centery, radius = self._mask_coordinates[_]
-                self._mask_coordinates.append(self.circle_list[_].get_params)
-                __, \
-                self._mask_centered[:, :, _] = self.spectral_mask(centerx, centery, radius, compute_centered=True)
-    
-            #self._mask_number = np.sum(self._mask_uncentered ** 2)
-        return self._mask_centered 
+            self._mask_centered = build_mask(self.N, self._mask_coordinates, centered=True)
+
+        return self._mask_centered
 
     @property
     def mask_coordinates(self):
-        #if not self._mask_coordinates:
-        #    self.mask_uncentered
         return self._mask_coordinates
 
     @property
     def mask_number(self):
+        if self._mask_number is None:
+            self.mask_uncentered
         return self._mask_number
-        
+
     def spectral_mask(self, center_x_pix, center_y_pix, radius_pix, compute_uncentered=False, compute_centered=False):
         """ 
         Compute spectral mask in frequency coordinates
@@ -125,19 +164,15 @@ class Mask(object):
         Return : tuple of 2 np.array
             (spectral_mask, spectral_mask_centered)
         """
-        centerX = self.kx[int(center_x_pix)] # um^-1 frequency coordinate
-        centerY = self.ky[int(center_y_pix)] # um^-1
-        radius = radius_pix * self.dk # um^-1
+        params = [(center_x_pix, center_y_pix, radius_pix)]
 
         spectral_mask_uncentered = None
         spectral_mask_centered = None
 
         if compute_uncentered:
-            print("UNCENTERED MASK COMPUTED")
-            spectral_mask_uncentered = (circ_prop(self.f_mgrid[0]-centerX, self.f_mgrid[1]-centerY, radius) > 0.5)
+            spectral_mask_uncentered = build_mask(self.N, params)[:, :, 0]
 
         if compute_centered:
-            print("CENTERED MASK COMPUTED")
-            spectral_mask_centered = (circ_prop(self.f_mgrid[0], self.f_mgrid[1], radius) > 0.5)
+            spectral_mask_centered = build_mask(self.N, params, centered=True)[:, :, 0]
 
         return (spectral_mask_uncentered, spectral_mask_centered,)
@@ -0,0 +1,164 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	shampoo_lite/peak_tracking.py
+#  author:	S. Felipe Fregoso
+#  description:	Tracks the spectral peak of each wavelength from frame to
+#               frame by searching a small window around the previous peak
+#
+###############################################################################
+"""
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from .datatypes import (FLOATDTYPE)
+from .reconstruction import _find_peak_centroid
+
+class SpectralPeakTracker(object):
+    """
+    Spectral peak search which only looks around the previous peaks.
+
+    The first search is the full frame search of '_find_peak_centroid'.
+    Afterwards, for each wavelength, a window of +/- 'window' pixels around
+    the previous peak is block averaged by 'decimation' and smoothed to find
+    the peak coarsely.  The peak is then refined on a full resolution patch
+    filtered like the full search.  If the coarse peak lands on the window
+    edge or the peak to window mean ratio drops below 'min_confidence' times
+    the ratio found by the last full search, a full search is done instead.
+    """
+    def __init__(self, window=64, decimation=4, gaussian_width=10, min_confidence=0.5):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        window : int
+            Half width in pixels of the window searched around the previous peak
+        decimation : int
+            Block size used to decimate the window
+        gaussian_width : float
+            Sigma of the gaussian smoothing, as in the full search
+        min_confidence : float
+            Fraction of the reference peak to mean ratio below which
+            the tracked peak is not trusted
+        """
+        self.window = int(window)
+        self.decimation = int(decimation)
+        self.gaussian_width = gaussian_width
+        self.min_confidence = min_confidence
+
+        self.peaks = None
+        self._reference = None
+
+        self.full_searches = 0
+        self.tracked = 0
+
+    def reset(self):
+        """
+        Forget the previous peaks.  The next search is a full search.
+        """
+        self.peaks = None
+        self._reference = None
+
+    def _window(self, shape, center, half):
+        """
+        Return slices of the window of +/- 'half' pixels around 'center', clipped to 'shape'.
+        The window is aligned to 'decimation' blocks.
+        """
+        slices = []
+        for length, pos in zip(shape, center):
+            start = max(0, int(pos) - half)
+            stop = min(length, int(pos) + half)
+            stop = start + (stop - start) // self.decimation * self.decimation
+            slices.append(slice(start, stop))
+
+        return tuple(slices)
+
+    def _coarse_peak(self, spectrum, center):
+        """
+        Return the coarse peak (row, col), its peak to mean ratio and
+        TRUE if it is on the edge of the window around 'center'
+        """
+        win = self._window(spectrum.shape, center, self.window)
+        dec = self.decimation
+        block = np.abs(spectrum[win])
+        rows, cols = block.shape[0] // dec, block.shape[1] // dec
+        block = block.reshape((rows, dec, cols, dec)).mean(axis=(1, 3))
+        smooth = gaussian_filter(block, self.gaussian_width / dec)
+
+        row, col = np.unravel_index(np.argmax(smooth), smooth.shape)
+        on_edge = row in (0, rows - 1) or col in (0, cols - 1)
+        ratio = smooth[row, col] / max(smooth.mean(), np.finfo(FLOATDTYPE).tiny)
+
+        peak = (win[0].start + row * dec + dec // 2, win[1].start + col * dec + dec // 2)
+        return peak, ratio, on_edge
+
+    def _refine_peak(self, spectrum, coarse):
+        """
+        Return the maximum of the gaussian filtered spectrum near 'coarse'.
+        The patch has a 4 sigma margin so the filter output equals
+        the one of the full search.
+        """
+        search = 2 * self.decimation
+        margin = int(np.ceil(4 * self.gaussian_width))
+        win = self._window(spectrum.shape, coarse, search + margin)
+        smooth = gaussian_filter(np.abs(spectrum[win]), self.gaussian_width)
+
+        row0 = max(0, coarse[0] - search - win[0].start)
+        col0 = max(0, coarse[1] - search - win[1].start)
+        center = smooth[row0:coarse[0] + search + 1 - win[0].start,
+                        col0:coarse[1] + search + 1 - win[1].start]
+        row, col = np.unravel_index(np.argmax(center), center.shape)
+
+        return (win[0].start + row0 + row, win[1].start + col0 + col)
+
+    def _full_search(self, spectrum, wavelength):
+        """
+        Full frame search, also sets the reference peak to mean ratios
+        """
+        self.full_searches += 1
+        self.peaks = _find_peak_centroid(np.abs(spectrum), wavelength, self.gaussian_width)
+        self._reference = [self._coarse_peak(spectrum, peak)[1] for peak in self.peaks]
+        return self.peaks
+
+    def find(self, spectrum, wavelength):
+        """
+        Return the spectral peaks as '_find_peak_centroid' does
+
+        Parameters
+        ----------
+        spectrum : 2D np.array
+            Centered fourier transform of the hologram, complex or magnitude
+        wavelength : float or np.array
+            Wavelengths
+
+        Returns
+        -------
+        peaks : np.array
+            (wavelength.size x 2) array of the (row, col) of each peak
+        """
+        num_wavelength = np.atleast_1d(wavelength).size
+        if self.peaks is None or len(self.peaks) != num_wavelength:
+            return self._full_search(spectrum, wavelength)
+
+        peaks = np.zeros_like(self.peaks)
+        for i, prev in enumerate(self.peaks):
+            coarse, ratio, on_edge = self._coarse_peak(spectrum, prev)
+            if on_edge or ratio < self.min_confidence * self._reference[i]:
+                return self._full_search(spectrum, wavelength)
+
+            peaks[i, :] = self._refine_peak(spectrum, coarse)
+
+        self.tracked += 1
+        self.peaks = peaks
+        return self.peaks
@@ -3,13 +3,20 @@ This module is a wrapper around ``pyfftw``'s API for fast Fourier transforms.
 """
 #from __future__ import (absolute_import, division, print_function,
 #                        unicode_literals)
+import os
+import atexit
+import pickle
+import collections
+import tempfile
+import threading
+import weakref
 import pyfftw
 import numpy as np
 from numpy.compat import integer_types
 
 pyfftw.interfaces.cache.enable()
 
-__all__ = ['FFT', 'FFT_3', 'fftshift']
+__all__ = ['FFT', 'FFT_3', 'FFTWPlanPool', 'fftshift']
 
 
 class FFT_3(object):
@@ -169,6 +176,443 @@ class FFT(object):
         return self._ifft2()
 
 
+class FFTWPlanPool(object):
+    """
+    Pool of ``pyfftw`` plans created on demand.
+
+    A plan is built the first time an array of a given (shape, dtype,
+    direction, threads) is transformed and reused afterwards.  Each calling
+    thread gets its own plans, and so its own buffers, so several threads
+    can transform arrays of the same shape concurrently.  The plans of a
+    thread are kept in least recently used order, at most 'max_plans' of
+    them, and are released when the thread exits.  Transforms
+    are taken over the first two axes, so 3D arrays are transformed plane
+    by plane with one batched plan.  If 'wisdom_file' is set, FFTW wisdom is
+    loaded from it and written back by 'save_wisdom', on 'configure' and at
+    exit, so expensive FFTW_MEASURE/FFTW_PATIENT planning is only paid once.
+
+    'fft2' and 'ifft2' return a copy of the output buffer of the plan, so
+    the results can be kept across calls.  The '*_centered' transforms
+    fold the fftshifts into the transform and write the result straight
+    from the plan buffer into a new or caller supplied ('out') array.
+    """
+    FORWARD = 'FFTW_FORWARD'
+    BACKWARD = 'FFTW_BACKWARD'
+
+    def __init__(self, float_precision, complex_precision, planner_effort='FFTW_MEASURE', threads=2, wisdom_file=None,
+                 max_plans=4):
+        """
+        Parameters
+        ----------
+        float_precision : `~numpy.dtype`
+            Input data type of forward transforms
+        complex_precision : `~numpy.dtype`
+            Input data type of inverse transforms
+        planner_effort : str, optional
+            FFTW planner effort ('FFTW_ESTIMATE', 'FFTW_MEASURE', 'FFTW_PATIENT', 'FFTW_EXHAUSTIVE')
+        threads : int, optional
+            Number of threads used by FFTW
+        wisdom_file : str or None, optional
+            File where FFTW wisdom is persisted between runs.  None disables it.
+        max_plans : int, optional
+            Maximum number of plans kept by each thread
+        """
+        self._float_precision = float_precision
+        self._complex_precision = complex_precision
+        ### Plans and sparse input indices of each thread
+        self._local = threading.local()
+        self._checkerboards = {}
+        self._lock = threading.Lock()
+        self._wisdom_dirty = False
+        self.planner_effort = planner_effort
+        self.threads = 1
+        self.max_plans = 4
+        self.wisdom_file = None
+        self.configure(planner_effort=planner_effort, threads=threads, wisdom_file=wisdom_file,
+                       max_plans=max_plans)
+        atexit.register(_save_pool_wisdom, weakref.ref(self))
+
+    def configure(self, planner_effort=None, threads=None, wisdom_file=None, max_plans=None):
+        """
+        Change the planner settings.  Plans already created are dropped.
+        The wisdom of the plans created so far is saved, and if a wisdom
+        file is given, its wisdom is imported.
+        """
+        self.save_wisdom()
+
+        with self._lock:
+            if planner_effort is not None:
+                self.planner_effort = planner_effort
+            if threads is not None:
+                self.threads = max(1, int(threads))
+            if wisdom_file is not None:
+                self.wisdom_file = wisdom_file or None
+            if max_plans is not None:
+                self.max_plans = max(1, int(max_plans))
+            ### Each thread starts over with no plans
+            self._local = threading.local()
+
+        self.load_wisdom()
+
+    def load_wisdom(self):
+        """
+        Import FFTW wisdom from the wisdom file.  Return TRUE if wisdom was imported.
+        """
+        if not self.wisdom_file or not os.path.exists(self.wisdom_file):
+            return False
+
+        try:
+            with open(self.wisdom_file, 'rb') as fid:
+                pyfftw.import_wisdom(pickle.load(fid))
+        except Exception as e: # Corrupt or foreign wisdom is only a missed speedup
+            print('FFTW wisdom not loaded from "%s": %s'%(self.wisdom_file, repr(e)))
+            return False
+
+        return True
+
+    def save_wisdom(self):
+        """
+        Export FFTW wisdom to the wisdom file if plans were created since it was last saved
+        """
+        with self._lock:
+            if not self.wisdom_file or not self._wisdom_dirty:
+                return
+            self._wisdom_dirty = False
+            wisdom_file = self.wisdom_file
+
+        dirname = os.path.dirname(os.path.abspath(wisdom_file))
+        tmppath = None
+        try:
+            os.makedirs(dirname, exist_ok=True)
+
+            ### Write to a temporary file first so readers never see partial files
+            fd, tmppath = tempfile.mkstemp(dir=dirname)
+            with os.fdopen(fd, 'wb') as fid:
+                pickle.dump(pyfftw.export_wisdom(), fid)
+            os.replace(tmppath, wisdom_file)
+        except OSError as e: # Unsaved wisdom is only a missed speedup
+            if tmppath is not None and os.path.exists(tmppath):
+                os.remove(tmppath)
+            print('FFTW wisdom not saved to "%s": %s'%(wisdom_file, repr(e)))
+
+    def _thread_state(self):
+        """
+        Return the plans and sparse input indices of the calling thread
+        """
+        local = self._local
+        if not hasattr(local, 'plans'):
+            local.plans = collections.OrderedDict()
+            local.sparse_indices = {}
+
+        return local
+
+    def get_plan(self, shape, dtype, direction):
+        """
+        Return the plan for arrays of 'shape' and 'dtype', creating it if needed
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the input array (at least 2 dimensions)
+        dtype : `~numpy.dtype`
+            Data type of the input array
+        direction : str
+            FFTWPlanPool.FORWARD or FFTWPlanPool.BACKWARD
+        """
+        state = self._thread_state()
+        key = (tuple(shape), np.dtype(dtype).str, direction, self.threads)
+        plan = state.plans.get(key)
+        if plan is not None:
+            state.plans.move_to_end(key)
+            return plan
+
+        ### Plans are private to the thread, so no pool lock is held while
+        ### planning.  pyfftw serializes the calls to the FFTW planner itself.
+        builder = pyfftw.builders.fftn if direction == self.FORWARD else pyfftw.builders.ifftn
+        buf = pyfftw.empty_aligned(shape, dtype=dtype)
+        plan = builder(buf, axes=(0, 1), threads=self.threads,
+                       planner_effort=self.planner_effort)
+        state.plans[key] = plan
+        self._wisdom_dirty = True
+
+        while len(state.plans) > self.max_plans:
+            _, evicted = state.plans.popitem(last=False)
+            state.sparse_indices.pop(id(evicted), None)
+
+        return plan
+
+    def fft2(self, array):
+        """
+        2D Fourier transform over the first two axes
+
+        Parameters
+        ----------
+        array : `~numpy.ndarray`
+            Input array
+
+        Returns
+        -------
+        ft_array : `~numpy.ndarray` (complex)
+            Fourier transform of the input array
+        """
+        plan = self.get_plan(array.shape, self._float_precision, self.FORWARD)
+        plan.input_array[:] = array
+        ### The plan output buffer is overwritten by the next transform
+        return plan().copy()
+
+    def ifft2(self, array):
+        """
+        Inverse 2D Fourier transform over the first two axes
+
+        Parameters
+        ----------
+        array : `~numpy.ndarray`
+            Input array
+
+        Returns
+        -------
+        ift_array : `~numpy.ndarray`
+            Inverse Fourier transform of input array
+        """
+        plan = self.get_plan(array.shape, self._complex_precision, self.BACKWARD)
+        plan.input_array[:] = array
+        self._thread_state().sparse_indices.pop(id(plan), None)
+        return plan().copy()
+
+    def _checkerboard(self, shape):
+        """
+        Return the (-1)^(row + column) array of the first two dimensions of
+        'shape', None if a dimension is odd.
+        """
+        shape = tuple(shape[:2])
+        if shape[0] % 2 or shape[1] % 2:
+            return None
+
+        checker = self._checkerboards.get(shape)
+        if checker is None:
+            rows, cols = np.indices(shape)
+            checker = (1 - 2 * ((rows + cols) % 2)).astype(self._float_precision)
+            self._checkerboards[shape] = checker
+
+        return checker
+
+    def _shift_output(self, plan, checker, scale, out):
+        """
+        Modulate the plan output by the checkerboard into 'out' and scale it.
+        The (-1)^((N+M)/2) sign of the modulation identity is folded into 'scale'.
+        """
+        output = plan.output_array
+        if checker.ndim < output.ndim:
+            checker = checker.reshape(checker.shape + (1,) * (output.ndim - checker.ndim))
+        if out is None:
+            out = np.empty_like(output)
+
+        np.multiply(output, checker, out=out)
+        scale = scale * (-1)**((output.shape[0] + output.shape[1])//2)
+        if scale != 1:
+            out *= scale
+
+        return out
+
+    def _centered(self, transform, array, scale, out):
+        """
+        Fallback for odd shapes using explicit (copying) fftshifts
+        """
+        result = fftshift(transform(fftshift(array, axes=(0, 1))), axes=(0, 1)) * scale
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+    def fft2_centered(self, array, scale=1.0, out=None):
+        """
+        Return fftshift(fft2(fftshift(array))) * scale over the first two axes
+
+        For even shapes both shifts are folded into the transform by
+        multiplying the input and output by (-1)^(row + column), which
+        is done while copying into the plan input buffer and out of the plan
+        output buffer.  No intermediate arrays are allocated.
+
+        Parameters
+        ----------
+        array : `~numpy.ndarray`
+            Input array
+        scale : float, optional
+            Factor applied to the result
+        out : `~numpy.ndarray` or None, optional
+            Array where the result is written.  Allocated if None.
+
+        Returns
+        -------
+        ft_array : `~numpy.ndarray` (complex)
+            Centered Fourier transform of the input array
+        """
+        checker = self._checkerboard(array.shape)
+        if checker is None:
+            return self._centered(self.fft2, array, scale, out)
+
+        plan = self.get_plan(array.shape, self._float_precision, self.FORWARD)
+        if array.ndim > 2:
+            checker_in = checker.reshape(checker.shape + (1,) * (array.ndim - 2))
+        else:
+            checker_in = checker
+        np.multiply(array, checker_in, out=plan.input_array)
+        plan()
+        return self._shift_output(plan, checker, scale, out)
+
+    def ifft2_centered(self, array, scale=1.0, out=None):
+        """
+        Return fftshift(ifft2(fftshift(array))) * scale over the first two axes
+
+        See 'fft2_centered'.
+
+        Parameters
+        ----------
+        array : `~numpy.ndarray`
+            Input array
+        scale : float, optional
+            Factor applied to the result
+        out : `~numpy.ndarray` or None, optional
+            Array where the result is written.  Allocated if None.
+
+        Returns
+        -------
+        ift_array : `~numpy.ndarray` (complex)
+            Centered inverse Fourier transform of the input array
+        """
+        checker = self._checkerboard(array.shape)
+        if checker is None:
+            return self._centered(self.ifft2, array, scale, out)
+
+        plan = self.get_plan(array.shape, self._complex_precision, self.BACKWARD)
+        if array.ndim > 2:
+            checker_in = checker.reshape(checker.shape + (1,) * (array.ndim - 2))
+        else:
+            checker_in = checker
+        np.multiply(array, checker_in, out=plan.input_array)
+        self._thread_state().sparse_indices.pop(id(plan), None)
+        plan()
+        return self._shift_output(plan, checker, scale, out)
+
+    def ifft2_masked_centered(self, spectrum, mask, shift, kernel, scale=1.0, out=None):
+        """
+        Return ifft2_centered(np.roll(spectrum * mask, shift, axis=(0, 1)) * kernel, scale)
+
+        The masked spectrum is written straight into its rolled position of
+        the aligned plan input buffer, block by block, and the kernel and
+        checkerboard multiplications are done in place in that buffer, so
+        no full size temporaries are allocated.
+
+        Parameters
+        ----------
+        spectrum : `~numpy.ndarray`
+            N x M spectrum
+        mask : `~numpy.ndarray` (bool)
+            N x M mask applied to the spectrum
+        shift : tuple of 2 int
+            Roll of the masked spectrum along the first two axes
+        kernel : `~numpy.ndarray`
+            N x M or N x M x D kernel multiplied after the roll
+        scale : float, optional
+            Factor applied to the result
+        out : `~numpy.ndarray` or None, optional
+            Array where the result is written.  Allocated if None.
+
+        Returns
+        -------
+        ift_array : `~numpy.ndarray`
+            Centered inverse Fourier transform, same shape as 'kernel'
+        """
+        checker = self._checkerboard(kernel.shape)
+        if checker is None:
+            rolled = np.roll(spectrum * mask, shift, axis=(0, 1))
+            rolled = rolled.reshape(rolled.shape + (1,) * (kernel.ndim - 2))
+            return self._centered(self.ifft2, rolled * kernel, scale, out)
+
+        plan = self.get_plan(kernel.shape, self._complex_precision, self.BACKWARD)
+        buf = plan.input_array
+        depth = (1,) * (kernel.ndim - 2)
+        for src_r, dst_r in _roll_slices(kernel.shape[0], shift[0]):
+            for src_c, dst_c in _roll_slices(kernel.shape[1], shift[1]):
+                dst = buf[dst_r, dst_c]
+                np.multiply(spectrum[src_r, src_c].reshape(dst.shape[:2] + depth),
+                            mask[src_r, src_c].reshape(dst.shape[:2] + depth),
+                            out=dst)
+
+        np.multiply(buf, kernel, out=buf)
+        np.multiply(buf, checker.reshape(checker.shape + depth), out=buf)
+        self._thread_state().sparse_indices.pop(id(plan), None)
+        plan()
+        return self._shift_output(plan, checker, scale, out)
+
+    def ifft2_sparse_centered(self, flat_indices, values, shape, scale=1.0, out=None):
+        """
+        Return fftshift(ifft2(fftshift(array))) * scale of an array of 2D
+        'shape' which is zero everywhere except at 'flat_indices'.
+
+        The values are modulated by the checkerboard (see 'fft2_centered') and
+        scattered directly into the aligned input buffer of the plan.  Only
+        the indices written by the previous sparse call are cleared, the
+        whole buffer is cleared if a dense transform was run in between.
+
+        Parameters
+        ----------
+        flat_indices : `~numpy.ndarray` (int)
+            Flat indices into the input array
+        values : `~numpy.ndarray`
+            Values at 'flat_indices'
+        shape : tuple
+            2D shape of the input array, both dimensions must be even
+        scale : float, optional
+            Factor applied to the result
+        out : `~numpy.ndarray` or None, optional
+            Array where the result is written.  Allocated if None.
+
+        Returns
+        -------
+        ift_array : `~numpy.ndarray`
+            Centered inverse Fourier transform of the sparse array
+        """
+        checker = self._checkerboard(shape)
+        if checker is None:
+            raise ValueError('Sparse centered transform requires even dimensions, got %s'%(str(shape)))
+
+        plan = self.get_plan(shape, self._complex_precision, self.BACKWARD)
+        buf = plan.input_array
+        prev_indices = self._thread_state().sparse_indices.get(id(plan))
+        if prev_indices is None:
+            buf[:] = 0
+        else:
+            buf.flat[prev_indices] = 0
+
+        buf.flat[flat_indices] = values * checker.flat[flat_indices]
+        self._thread_state().sparse_indices[id(plan)] = flat_indices
+        plan()
+        return self._shift_output(plan, checker, scale, out)
+
+
+def _save_pool_wisdom(pool_ref):
+    """
+    Save the wisdom of a plan pool at exit, if it still exists
+    """
+    pool = pool_ref()
+    if pool is not None:
+        pool.save_wisdom()
+
+
+def _roll_slices(n, shift):
+    """
+    Return (source, destination) slice pairs which implement np.roll by
+    'shift' along an axis of length 'n'
+    """
+    shift = shift % n
+    if shift == 0:
+        return [(slice(0, n), slice(0, n))]
+
+    return [(slice(0, n - shift), slice(shift, n)),
+            (slice(n - shift, n), slice(0, shift))]
+
+
 def fftshift(x, additional_shift=None, axes=None):
     """
     Shift the zero-frequency component to the center of the spectrum, or with
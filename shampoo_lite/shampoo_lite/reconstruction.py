@@ -22,15 +22,19 @@
 ###############################################################################
 """
 import time
+import threading
 import numpy as np
 import functools
 import multiprocessing
+import concurrent.futures
 import matplotlib.pyplot as plt #For saving to TIFF
 
 from .datatypes import (BOOLDTYPE, FLOATDTYPE, COMPLEXDTYPE, FRAMEDIMENSIONS, NUMFFTTHREADS)
 from .util import (circ_prop, crop_image)
 from .mask import (Circle, Mask)
-from .fftutils import (fftshift, fft2, ifft2, fft3, ifft3, FFT_3)
+from .fftutils import (fftshift, fft2, ifft2, fft2_centered, ifft2_centered, ifft2_masked_centered, ifft2_sparse_centered)
+from .sparse_kernel import SparseKernel
+from .g_factor import compute_propagation_kernel_batch
 
 # Used for spectral peak computation
 from scipy.ndimage import gaussian_filter, maximum_filter
@@ -47,6 +51,10 @@ class UpdateError(Exception):
 ###########################################################
 RANDOM_SEED = 42
 
+### Thread pools used to reconstruct wavelengths concurrently, keyed by number of workers
+_WAVELENGTH_EXECUTORS = {}
+_WAVELENGTH_EXECUTORS_LOCK = threading.Lock()
+
 def reshape_to_3d(array, dtype):
     """
     Gets input array and reshapes is to be an array of
@@ -142,8 +150,11 @@ class Hologram():
         self.propagation_kernel = None
         self.wavelength = None
         self.wavenumber = None
+        self._pix_dx = None
+        self._pix_dy = None
         self._pix_width_x = None
         self._pix_width_y = None
+        self.dk = None
         self._spectral_peak = None
         self._chromatic_shift = None
         self.apodization_window_function = None
@@ -154,6 +165,7 @@ class Hologram():
         self._f_mgrid = None
         self._propagation_array = None
         self.G = None
+        self.peak_tracker = None
         self.x_peak = None
         self.y_peak = None
 
@@ -198,68 +210,63 @@ class Hologram():
         """
         Update the object based on inputs
         This avoids creating a new hologram object
+
+        State derived from the image (fourier transforms, spectral peak) is
+        always recomputed.  The apodization window and pixel grid are kept
+        while hololen doesn't change, the frequency grid while the frequency
+        step dk doesn't change and the propagation array while neither the
+        frequency grid nor the wavelength change.  The propagation kernel
+        also depends on the distance and mask, so it is dropped and must be
+        set again with 'set_G_factor' (or is computed by 'reconstruct').
+        None for 'wavelength', 'pix_dx' or 'pix_dy' keeps the current value.
         """
+        prev_hololen = self.hololen
+        prev_dk = self.dk
+        prev_wavelength = self.wavelength
+
         self._rebin_factor = rebin_factor
         self._system_magnification = system_magnification
+        self._crop_fraction = crop_fraction
         #self._random_seed = RANDOM_SEED
 
-        #self.hologram = None
-        #self.hololen = None
-
-        #self.fourier_mask = None
-
-        #self.propagation_kernel = None
-        #self.wavelength = None
-        #self.wavenumber = None
-        #self._pix_width_x = None
-        #self._pix_width_y = None
-        #self._spectral_peak = None
-        #self._chromatic_shift = None
-        #self.apodization_window_function = None
         self._ft_hologram = None
         self._angular_spec_hologram = None
-        #self._apodize_mask = None
-        #self._mgrid = None
-        #self._f_mgrid = None
-        #self._propagation_array = None
-        #self.G = None
-        #self.x_peak = None
-        #self.y_peak = None
+        self._spectral_peak = None
+        self.propagation_kernel = None
 
         if fourier_mask:
             self.fourier_mask = fourier_mask
 
-        prev_hololen = self.hololen
         self.set_hologram(hologram, crop_fraction)
+        self.set_wavelength(self.wavelength if wavelength is None else wavelength)
+        self.set_pixel_width(self._pix_dx if pix_dx is None else pix_dx,
+                             self._pix_dy if pix_dy is None else pix_dy)
 
         if prev_hololen != self.hololen:
             self._apodize_mask = None
             self._mgrid = None
+
+        if self.peak_tracker is not None and \
+           (prev_hololen != self.hololen or not np.array_equal(prev_wavelength, self.wavelength)):
+            self.peak_tracker.reset()
+
+        if prev_hololen != self.hololen or prev_dk != self.dk:
             self._f_mgrid = None
+
+        if self._f_mgrid is None or not np.array_equal(prev_wavelength, self.wavelength):
             self._propagation_array = None
-        
-        self.set_wavelength(wavelength)
-        self.set_pixel_width(pix_dx, pix_dy)
-        self._apodized_hologram = self.hologram * self.apodize_mask()
-        #self.update_ft_hologram(apodize=apodize)
-        #self.update_angular_spectrum(apodize=apodize)
 
-#        if self.wavelength.size != FRAMEDIMENSIONS[2] or self.hololen != FRAMEDIMENSIONS[1]:
-#            #print("$$$$$$$$ Adjusted FFT $$$$$$$$$$$")
-#            datatypes.FRAMEDIMENSIONS = (self.hololen, self.hololen, self.wavelength.size)
-#            #print("Updating FFT shape", FRAMEDIMENSIONS)
-#            myFFT3 = FFT_3(FRAMEDIMENSIONS, FLOATDTYPE, COMPLEXDTYPE, threads=NUMFFTTHREADS)
-#            fftutils.fft3 = myFFT3.fft3
-#            fftutils.ifft3 = myFFT3.ifft3
-#            fftutils.fft2 = myFFT3.fft2
-#            fftutils.ifft2 = myFFT3.ifft2
+        self._apodized_hologram = self.hologram * self.apodize_mask()
 
     def set_G_factor(self, G_factor_array):
         self.propagation_kernel = G_factor_array
 
-    def update_G_factor(self, propagation_distance):
+    def update_G_factor(self, propagation_distance, sparse=False, depth_stack=False):
         #print("fourier_mask type: ", type(self.fourier_mask))
-        self.propagation_kernel = self.generate_propagation_kernel(propagation_distance, self.fourier_mask.mask_centered)
+        if depth_stack:
+            self.propagation_kernel = self.generate_propagation_kernel_stack(propagation_distance, self.fourier_mask.mask_centered, sparse=sparse)
+        else:
+            self.propagation_kernel = self.generate_propagation_kernel(propagation_distance, self.fourier_mask.mask_centered, sparse=sparse)
         return self.propagation_kernel
 
     def set_hologram(self, hologram, crop_fraction=None):
@@ -308,9 +315,9 @@ class Hologram():
 
     def update_angular_spectrum(self, apodize=False):
         if apodize:
-            self._angular_spec_hologram = fftshift(fft2(fftshift(self._apodized_hologram)) * self._pix_width_x * self._pix_width_y / (2 * np.pi))
+            self._angular_spec_hologram = fft2_centered(self._apodized_hologram, self._pix_width_x * self._pix_width_y / (2 * np.pi))
         else:
-            self._angular_spec_hologram = fftshift(fft2(fftshift(self.hologram)) * self._pix_width_x * self._pix_width_y / (2 * np.pi))
+            self._angular_spec_hologram = fft2_centered(self.hologram, self._pix_width_x * self._pix_width_y / (2 * np.pi))
     
         return self._angular_spec_hologram
 
@@ -349,9 +356,11 @@ class Hologram():
             Pixel size in Y dimension in image space
         """
         if pix_dx:
+            self._pix_dx = pix_dx
             effective_pixel_size = pix_dx / self._system_magnification # object space
             self._pix_width_x = effective_pixel_size * self._rebin_factor
         if pix_dy:
+            self._pix_dy = pix_dy
             effective_pixel_size = pix_dy / self._system_magnification # object space
             self._pix_width_y =  effective_pixel_size * self._rebin_factor
 
@@ -363,9 +372,10 @@ class Hologram():
         k0 = reshape_to_3d(self.wavenumber, FLOATDTYPE)
         self._propagation_array = np.zeros((self.hololen, self.hololen, self.wavenumber.size), dtype=FLOATDTYPE)
 
-        for i in range(k0.size):
-            k = k0[0, 0, i]
-            np.sqrt(k**2 - (self.f_mgrid[0]**2 + self.f_mgrid[1]**2) * circ_prop(self.f_mgrid[0], self.f_mgrid[1], k), out=self._propagation_array[:, :, i], dtype=FLOATDTYPE)
+        # Radius grid computed once and broadcast over the wavenumbers
+        kx = self.f_mgrid[0][:, :, np.newaxis]
+        ky = self.f_mgrid[1][:, :, np.newaxis]
+        np.sqrt(k0**2 - (kx**2 + ky**2) * circ_prop(kx, ky, k0), out=self._propagation_array, dtype=FLOATDTYPE)
 
         return self._propagation_array
 
@@ -404,9 +414,9 @@ class Hologram():
         """
         if self._angular_spec_hologram is None:
             if apodize:
-                self._angular_spec_hologram = fftshift(fft2(fftshift(self._apodized_hologram)) * self._pix_width_x * self._pix_width_y / (2 * np.pi))
+                self._angular_spec_hologram = fft2_centered(self._apodized_hologram, self._pix_width_x * self._pix_width_y / (2 * np.pi))
             else:
-                self._angular_spec_hologram = fftshift(fft2(fftshift(self.hologram)) * self._pix_width_x * self._pix_width_y / (2 * np.pi))
+                self._angular_spec_hologram = fft2_centered(self.hologram, self._pix_width_x * self._pix_width_y / (2 * np.pi))
     
         #print('ANGULAR_SPECTRUM type: ', self._angular_spec_hologram.dtype)
         return self._angular_spec_hologram
@@ -431,6 +441,10 @@ class Hologram():
             hologram near the real image.
         """
 
+        if self.peak_tracker is not None:
+            ### Search around the peaks of the previous frames
+            return self.peak_tracker.find(self.ft_hologram, self.wavelength)
+
         return _find_peak_centroid(np.abs(self.ft_hologram), self.wavelength, gaussian_width)
 
     def update_spectral_peak(self, spectral_peak):
@@ -499,7 +513,7 @@ class Hologram():
 
 
     #@profile
-    def generate_propagation_kernel(self, propagation_distance, spectral_mask_centered):
+    def generate_propagation_kernel(self, propagation_distance, spectral_mask_centered, sparse=False):
         """
         Compute and return propagation kernel
 
@@ -509,18 +523,62 @@ class Hologram():
             Propagation disance in units of um
         spectral_mask_centered : N x N x wavelength.size np.array
             Spectral mask(s) where the mask is in the center of the image
+        sparse : boolean
+            If TRUE only the coefficients inside the spectral mask are
+            computed and returned as a SparseKernel
 
-        Return : N x N x wavelength.size np.array
+        Return : N x N x wavelength.size np.array or SparseKernel
            Propagation kernel array
         """
         print("GENERATE PROPAGATION KERNEL")
+        if sparse:
+            indices = []
+            values = []
+            for i in range(self.wavelength.size):
+                mask = spectral_mask_centered[:, :, i]
+                indices.append(np.flatnonzero(mask))
+                values.append(np.exp(1j*propagation_distance*self.propagation_array[mask, i]).astype(COMPLEXDTYPE))
+
+            return SparseKernel(self.hololen, indices, values)
+
         propKernel = np.zeros((self.hololen, self.hololen, self.wavelength.size), dtype=COMPLEXDTYPE)
 
-        for i, _ in enumerate(self.wavelength):
+        for i in range(self.wavelength.size):
             propKernel[spectral_mask_centered[:,:,i], i] = np.exp(1j*propagation_distance*self.propagation_array[spectral_mask_centered[:,:,i], i])
 
         return propKernel
 
+    def generate_propagation_kernel_stack(self, propagation_distance, spectral_mask_centered, sparse=False):
+        """
+        Compute and return the propagation kernel for every propagation distance
+
+        Parameters
+        ----------
+        propagation_distance : float or np.array of floats
+            Propagation distances in units of um
+        spectral_mask_centered : N x N x wavelength.size np.array
+            Spectral mask(s) where the mask is in the center of the image
+        sparse : boolean
+            If TRUE only the coefficients inside the spectral mask are
+            computed and returned as a SparseKernel
+
+        Return : N x N x propagation_distance.size x wavelength.size np.array or SparseKernel
+           Stacked propagation kernel array
+        """
+        propagation_distance = np.atleast_1d(propagation_distance).reshape(-1).astype(FLOATDTYPE)
+        if sparse:
+            indices = []
+            values = []
+            for i in range(self.wavelength.size):
+                mask = spectral_mask_centered[:, :, i]
+                indices.append(np.flatnonzero(mask))
+                values.append(np.exp(1j*np.outer(self.propagation_array[mask, i], propagation_distance)).astype(COMPLEXDTYPE))
+
+            return SparseKernel(self.hololen, indices, values)
+
+        return compute_propagation_kernel_batch(propagation_distance, self.hololen, self._pix_width_x,
+                                                self.wavelength, spectral_mask_centered)
+
     def generate_spectral_mask(self, compute_spectral_peak=False, center_x=None, center_y=None, radius=250):
         """
         """
@@ -558,6 +616,16 @@ class Hologram():
 
         return self.fourier_mask
 
+    def cropped_spectrum_length(self):
+        """
+        Return the length of the smallest power of two box, centered in the
+        frequency grid, which holds the centered spectral mask of every wavelength
+        """
+        radius = max([circle.radius for circle in self.fourier_mask.circle_list])
+        crop_len = 2**int(np.ceil(np.log2(2 * np.ceil(radius) + 2)))
+
+        return min(crop_len, self.hololen)
+
     def update_chromatic_shift(self,chromatic_shift):
         """  
         Update chromatic shift values for changed depth of focus for different wavelengths.
@@ -583,7 +651,8 @@ class Hologram():
     #@profile
     def reconstruct(self, propagation_distance, compute_spectral_peak=False,
                     compute_digital_phase_mask=False, digital_phase_mask=None, fourier_mask=None,
-                    chromatic_shift=None, G_factor=None):
+                    chromatic_shift=None, G_factor=None, depth_stack=False, crop_spectrum=False,
+                    num_workers=1):
         """
         Parameters
         -----------
@@ -592,6 +661,22 @@ class Hologram():
         compute_spectral_peak : boolean
             If TRUE then mathematically find the peak of the fourier image for each wavelength and create spectral mask.
             If FALSE then input mask 'fourier_mask' must be used
+        depth_stack : boolean
+            If TRUE reconstruct every distance in 'propagation_distance' using one batched
+            inverse FFT per wavelength.  'G_factor', if given, must then be of shape
+            N x N x propagation_distance.size x wavelength.size (see 'generate_propagation_kernel_stack').
+            If FALSE only the first propagation distance is reconstructed.
+        G_factor : np.array or SparseKernel
+            Propagation kernel.  A SparseKernel only multiplies and scatters the
+            pixels inside the spectral mask into the inverse FFT input.
+        crop_spectrum : boolean
+            If TRUE only the power of two box around the centered spectral masks
+            (see 'cropped_spectrum_length') is inverse transformed.  The reconstructed
+            wave is then of lower resolution and its pixel width scaled accordingly.
+        num_workers : int
+            Number of threads reconstructing wavelengths concurrently.  1 reconstructs
+            them serially, 0 uses one thread per wavelength.  The time spent on each
+            wavelength is returned in 'ReconstructedWave.channel_times'.
         
         """
         propagation_distance = reshape_to_3d(propagation_distance, FLOATDTYPE)
@@ -626,10 +711,17 @@ class Hologram():
                 print("GENERATE SPECTRAL MASK")
                 self.generate_spectral_mask(compute_spectral_peak=True)
 
-        if self.propagation_kernel is None and G_factor is None:
+        if depth_stack:
+            if G_factor is None:
+                G_factor = self.generate_propagation_kernel_stack(propagation_distance, self.fourier_mask.mask_centered)
+            expected_shape = (self.hololen, self.hololen, propagation_distance.size, self.wavelength.size)
+            if not isinstance(G_factor, (np.ndarray, SparseKernel)) or G_factor.shape != expected_shape:
+                raise ValueError("G_factor propagation kernel stack must be shape (%d, %d, %d, %d)"%expected_shape)
+            self.propagation_kernel = G_factor
+        elif self.propagation_kernel is None and G_factor is None:
             self.update_G_factor(propagation_distance[0, 0, 0])
         else:
-            if not isinstance(G_factor, np.ndarray) or G_factor.shape[0] != self.hololen or G_factor.shape[0] != G_factor.shape[1] or G_factor.shape[2] != self.wavelength.size:
+            if not isinstance(G_factor, (np.ndarray, SparseKernel)) or G_factor.shape[0] != self.hololen or G_factor.shape[0] != G_factor.shape[1] or G_factor.shape[2] != self.wavelength.size:
                 raise ValueError("G_factor propgation distance must be shape (%d, %d, %d)"%(self.hololen, self.hololen, self.wavelength.size))
             self.propagation_kernel = G_factor
 
@@ -637,12 +729,43 @@ class Hologram():
         # Initialize the reconstructed wave array
 
         tup = []
+        kernels = []
+        sparse = isinstance(self.propagation_kernel, SparseKernel)
         for i in range(self.wavelength.size):
             tup.append((self.fourier_mask.mask_uncentered[:, :, i], self.fourier_mask.mask_coordinates[i][1], self.fourier_mask.mask_coordinates[i][0]))
+            if sparse:
+                kernels.append((self.propagation_kernel.indices[i], self.propagation_kernel.values[i]))
+            else:
+                kernels.append(self.propagation_kernel[..., i])
+
+        if crop_spectrum:
+            # Only the box holding the spectral mask is inverse transformed
+            comp_wave = functools.partial(compute_wave_cropped, self.angular_spectrum, self.hololen, self.dk,
+                                          crop_len=self.cropped_spectrum_length())
+        elif sparse:
+            # Only the pixels inside the spectral mask are multiplied
+            comp_wave = functools.partial(compute_wave_sparse, self.angular_spectrum, self.hololen, self.dk)
+        elif depth_stack:
+            # One batched inverse FFT over the depth axis per wavelength
+            comp_wave = functools.partial(compute_wave_stack, self.angular_spectrum, self.hololen, self.dk)
+        else:
+            comp_wave = functools.partial(compute_wave, self.angular_spectrum, self.hololen, self.dk)
+
+        timed_wave = functools.partial(_timed_call, comp_wave)
+        if num_workers != 1 and self.wavelength.size > 1:
+            # pyFFTW releases the GIL, so wavelengths are transformed in parallel
+            executor = _wavelength_executor(num_workers or self.wavelength.size)
+            timed_result = list(executor.map(timed_wave, kernels, tup))
+        else:
+            timed_result = list(map(timed_wave, kernels, tup))
+
+        result = [res for res, _ in timed_result]
+        if depth_stack:
+            wave = np.stack(result, axis=3).astype(self.angular_spectrum.dtype)
+        else:
+            wave = np.expand_dims(np.dstack(result), axis=2).astype(self.angular_spectrum.dtype)
 
-        comp_wave = functools.partial(compute_wave, self.angular_spectrum, self.hololen, self.dk, self.propagation_kernel[:, :, 0])
-        result = list(map(comp_wave, tup))
-        wave = np.expand_dims(np.dstack(result), axis=2).astype(self.angular_spectrum.dtype)
+        pix_scale = self.hololen / wave.shape[0]
 
 
 #        wave = np.zeros((self.hololen, self.hololen, propagation_distance.size, self.wavelength.size), dtype=self.angular_spectrum.dtype)
@@ -672,7 +795,34 @@ class Hologram():
                 #print('E_maskedFFT', E_maskedFFT)
                 #print('E_reconstruction', E_reconstruction)
 
-        return ReconstructedWave(reconstructed_wave=wave)
+        return ReconstructedWave(reconstructed_wave=wave,
+                                 pix_dx=self._pix_width_x * pix_scale,
+                                 pix_dy=self._pix_width_y * pix_scale,
+                                 channel_times=[elapsed for _, elapsed in timed_result])
+
+def _wavelength_executor(num_workers):
+    """
+    Return the thread pool of 'num_workers' threads, creating it on first use.
+    Pools are kept for the life of the process so their threads, and the FFT
+    plans owned by those threads, are reused across frames.
+    """
+    ### Reconstruction workers call this concurrently, only one creates the pool
+    with _WAVELENGTH_EXECUTORS_LOCK:
+        executor = _WAVELENGTH_EXECUTORS.get(num_workers)
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers,
+                                                             thread_name_prefix='reconst_wavelength')
+            _WAVELENGTH_EXECUTORS[num_workers] = executor
+
+    return executor
+
+def _timed_call(func, *args):
+    """
+    Call func(*args) and return (result, elapsed seconds)
+    """
+    start_time = time.time()
+    result = func(*args)
+    return result, time.time() - start_time
 
 def compute_wave(angular_spectrum,
                  hololen,
@@ -688,13 +838,166 @@ def compute_wave(angular_spectrum,
     center_x = arg[1]
     center_y = arg[2]
 
-    proppedWave = np.roll(angular_spectrum * mask_uncentered,
-                         (int(hololen/2 - center_x), int(hololen/2 - center_y)),
-                         axis=(0, 1)) * propagation_kernel
-
+    # Mask, roll and kernel multiply are done in the FFT input buffer
+    wave = ifft2_masked_centered(angular_spectrum, mask_uncentered,
+                                 (int(hololen/2 - center_x), int(hololen/2 - center_y)),
+                                 propagation_kernel,
+                                 (hololen * dk * hololen * dk)/(2 * np.pi))
 
     print("done")
-    return fftshift(ifft2(fftshift(proppedWave))) * (hololen * dk * hololen * dk)/(2 * np.pi)
+    return wave
+
+def compute_wave_stack(angular_spectrum,
+                       hololen,
+                       dk,
+                       propagation_kernel_stack,
+                       arg,
+                      ):
+    """
+    Batched version of 'compute_wave' for a stack of propagation distances
+
+    The masked and shifted angular spectrum is written into every plane of
+    the FFT input buffer and multiplied by the propagation kernel of each
+    distance.  The whole stack is then inverse transformed with a single
+    batched FFT over the depth axis.
+
+    Parameters
+    ----------
+    angular_spectrum : N x N np.array
+        Angular spectrum of the hologram
+    hololen : int
+        Length of the hologram in pixels
+    dk : float
+        Frequency resolution
+    propagation_kernel_stack : N x N x D np.array
+        Propagation kernel for each of the D propagation distances
+    arg : tuple
+        (mask_uncentered, center_x, center_y) of the wavelength
+
+    Return : N x N x D np.array
+        Reconstructed wave for each propagation distance
+    """
+    mask_uncentered = arg[0]
+    center_x = arg[1]
+    center_y = arg[2]
+
+    return ifft2_masked_centered(angular_spectrum, mask_uncentered,
+                                 (int(hololen/2 - center_x), int(hololen/2 - center_y)),
+                                 propagation_kernel_stack,
+                                 (hololen * dk * hololen * dk)/(2 * np.pi))
+
+def compute_wave_sparse(angular_spectrum,
+                        hololen,
+                        dk,
+                        sparse_kernel,
+                        arg,
+                       ):
+    """
+    Version of 'compute_wave' for a propagation kernel restricted to the
+    support of the centered spectral mask (see SparseKernel)
+
+    The angular spectrum is gathered at the source pixel of every kernel
+    coefficient, which replaces masking and rolling the full spectrum.  The
+    products are scattered directly into the inverse FFT input buffer.
+
+    Parameters
+    ----------
+    angular_spectrum : N x N np.array
+        Angular spectrum of the hologram
+    hololen : int
+        Length of the hologram in pixels
+    dk : float
+        Frequency resolution
+    sparse_kernel : tuple
+        (indices, values) of the wavelength.  Values of shape M or M x D
+    arg : tuple
+        (mask_uncentered, center_x, center_y) of the wavelength
+
+    Return : N x N or N x N x D np.array
+        Reconstructed wave
+    """
+    mask_uncentered = arg[0]
+    center_x = arg[1]
+    center_y = arg[2]
+    indices, values = sparse_kernel
+
+    rows, cols = np.divmod(indices, hololen)
+
+    ### Pixel of the angular spectrum which 'np.roll' moves onto each kernel coefficient
+    src_rows = (rows - int(hololen/2 - center_x)) % hololen
+    src_cols = (cols - int(hololen/2 - center_y)) % hololen
+    masked_spectrum = angular_spectrum[src_rows, src_cols] * mask_uncentered[src_rows, src_cols]
+
+    scale = (hololen * dk * hololen * dk)/(2 * np.pi)
+    if values.ndim == 1 and hololen % 2 == 0:
+        return ifft2_sparse_centered(indices, masked_spectrum * values, (hololen, hololen), scale)
+
+    masked_spectrum = masked_spectrum.reshape((-1,) + (1,) * (values.ndim - 1))
+    proppedWave = np.zeros((hololen * hololen,) + values.shape[1:], dtype=values.dtype)
+    proppedWave[indices] = masked_spectrum * values
+
+    return ifft2_centered(proppedWave.reshape((hololen, hololen) + values.shape[1:]), scale)
+
+def compute_wave_cropped(angular_spectrum,
+                         hololen,
+                         dk,
+                         propagation_kernel,
+                         arg,
+                         crop_len=None,
+                        ):
+    """
+    Version of 'compute_wave' which only inverse transforms the crop_len x crop_len
+    box centered in the frequency grid
+
+    The box must hold the centered spectral mask.  Since the frequency
+    resolution 'dk' is unchanged, the result samples the same field as the
+    full size reconstruction on a grid 'hololen/crop_len' times coarser.
+
+    Parameters
+    ----------
+    angular_spectrum : N x N np.array
+        Angular spectrum of the hologram
+    hololen : int
+        Length of the hologram in pixels
+    dk : float
+        Frequency resolution
+    propagation_kernel : N x N (x D) np.array or tuple
+        Dense propagation kernel of the wavelength or (indices, values) of a SparseKernel
+    arg : tuple
+        (mask_uncentered, center_x, center_y) of the wavelength
+    crop_len : int
+        Length of the cropped spectrum in pixels
+
+    Return : crop_len x crop_len (x D) np.array
+        Reconstructed wave
+    """
+    mask_uncentered = arg[0]
+    center_x = arg[1]
+    center_y = arg[2]
+
+    lo = hololen//2 - crop_len//2
+    box = np.arange(lo, lo + crop_len)
+
+    ### Pixels of the angular spectrum which 'np.roll' moves into the box
+    src = np.ix_((box - int(hololen/2 - center_x)) % hololen,
+                 (box - int(hololen/2 - center_y)) % hololen)
+    masked_spectrum = angular_spectrum[src] * mask_uncentered[src]
+
+    if isinstance(propagation_kernel, tuple):
+        indices, values = propagation_kernel
+        rows, cols = np.divmod(indices, hololen)
+        kernel = np.zeros((crop_len * crop_len,) + values.shape[1:], dtype=values.dtype)
+        kernel[(rows - lo) * crop_len + (cols - lo)] = values
+        kernel = kernel.reshape((crop_len, crop_len) + values.shape[1:])
+    else:
+        kernel = propagation_kernel[lo:lo + crop_len, lo:lo + crop_len]
+
+    if kernel.ndim == 3:
+        masked_spectrum = masked_spectrum[:, :, np.newaxis]
+
+    proppedWave = masked_spectrum * kernel
+
+    return ifft2_centered(proppedWave, (crop_len * dk * crop_len * dk)/(2 * np.pi))
 
 
 class ReconstructedWave():
@@ -703,12 +1006,18 @@ class ReconstructedWave():
     arrays.
     """
     #def __init__(self, reconstructed_wave, fourier_mask, wavelength, depths):
-    def __init__(self, reconstructed_wave):
+    def __init__(self, reconstructed_wave, pix_dx=None, pix_dy=None, channel_times=None):
         """
         Parameters
         ----------
         reconstructed_wave : array_like, complex
             Reconstructed wave. Last axis is wavelength channel.
+        pix_dx : float or None
+            Pixel width (object space) in X dimension of the reconstructed wave
+        pix_dy : float or None
+            Pixel width (object space) in Y dimension of the reconstructed wave
+        channel_times : list of float or None
+            Seconds spent reconstructing each wavelength channel
         fourier_mask : array_like
             Reconstruction Fourier mask, in 2- or 3- dimensions.
         wavelength : float or array_like
@@ -718,6 +1027,9 @@ class ReconstructedWave():
             axis 2.
         """
         self.reconstructed_wave = reconstructed_wave
+        self.pix_dx = pix_dx
+        self.pix_dy = pix_dy
+        self.channel_times = channel_times if channel_times is not None else []
         #self.depths = np.atleast_1d(depths)
         self._amplitude_image = None
         self._intensity_image = None
@@ -727,13 +1039,71 @@ class ReconstructedWave():
         #self.wavelength = np.atleast_1d(wavelength)
         #self._random_seed = RANDOM_SEED
 
+    ### Elements of the wave processed per block by 'compute'.  Keeps the
+    ### block and its outputs in cache between the passes of a block.
+    BLOCK_SIZE = 1 << 16
+
+    def compute(self, products=('amplitude', 'intensity', 'phase'), out=None):
+        """
+        Compute the products not computed yet in a single pass over the wave
+
+        The wave is processed in blocks of BLOCK_SIZE elements.  For each block
+        the amplitude is np.abs of the field, the intensity the square of the
+        amplitude and the phase np.arctan2 of the imaginary and real parts,
+        all written directly into the FLOATDTYPE output arrays.
+
+        Parameters
+        ----------
+        products : iterable of str
+            Any of 'amplitude', 'intensity' and 'phase'
+        out : dict or None
+            Preallocated C contiguous FLOATDTYPE arrays of the shape of the
+            wave, by product name, to write the products into.  Missing
+            products are allocated.
+        """
+        wave = self.reconstructed_wave
+        images = {}
+        for name in ['amplitude', 'intensity', 'phase']:
+            if name in products and getattr(self, '_%s_image'%(name)) is None:
+                if out is not None and name in out:
+                    if out[name].shape != wave.shape or not out[name].flags.c_contiguous:
+                        raise ValueError('Output array of [%s] must be C contiguous, shape %s'\
+                                         %(name, repr(wave.shape)))
+                    images[name] = out[name]
+                else:
+                    images[name] = np.empty(wave.shape, dtype=FLOATDTYPE)
+        if not images:
+            return
+
+        flat_wave = wave.reshape(-1)
+        flat = {name:img.reshape(-1) for name, img in images.items()}
+        ### Amplitude of a block when only the intensity is requested
+        scratch = None
+        if 'amplitude' not in flat and 'intensity' in flat:
+            scratch = np.empty(min(self.BLOCK_SIZE, flat_wave.size), dtype=FLOATDTYPE)
+
+        for start in range(0, flat_wave.size, self.BLOCK_SIZE):
+            block = flat_wave[start:start + self.BLOCK_SIZE]
+            stop = start + block.size
+            if 'amplitude' in flat:
+                amplitude = np.abs(block, out=flat['amplitude'][start:stop])
+            elif scratch is not None:
+                amplitude = np.abs(block, out=scratch[:block.size])
+            if 'intensity' in flat:
+                np.square(amplitude, out=flat['intensity'][start:stop])
+            if 'phase' in flat:
+                np.arctan2(block.imag, block.real, out=flat['phase'][start:stop])
+
+        for name, img in images.items():
+            setattr(self, '_%s_image'%(name), img)
+
     @property
     def intensity(self):
         """
         `~numpy.ndarray` of the reconstructed intensity
         """
         if self._intensity_image is None:
-            self._intensity_image = self.amplitude ** 2
+            self.compute(('intensity',))
 
         return self._intensity_image
 
@@ -743,23 +1113,18 @@ class ReconstructedWave():
         `~numpy.ndarray` of the reconstructed amplitude
         """
         if self._amplitude_image is None:
-            self._amplitude_image = (self.reconstructed_wave*np.conj(self.reconstructed_wave)).real
-            #self._amplitude_image = np.abs(self.reconstructed_wave)
+            self.compute(('amplitude',))
 
-            print("AMPLITUDE Type: ", self._amplitude_image.dtype)
-            print(time.time())
         return self._amplitude_image
 
     @property
     def phase(self):
         """
-        `~numpy.ndarray` of the reconstructed, unwrapped phase.
-
-        Returns the unwrapped phase using `~skimage.restoration.unwrap_phase`.
+        `~numpy.ndarray` of the reconstructed, wrapped phase
         """
         if self._phase_image is None:
-            self._phase_image = np.angle(self.reconstructed_wave)
-            print("PHASE Type: ", self._phase_image.dtype)
+            self.compute(('phase',))
+
         return self._phase_image
 
     def save_to_file(self, path):
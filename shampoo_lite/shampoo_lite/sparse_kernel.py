@@ -0,0 +1,129 @@
+"""
+###############################################################################
+#  Copyright 2019, by the California Institute of Technology. ALL RIGHTS RESERVED.
+#  United States Government Sponsorship acknowledged. Any commercial use must be
+#  negotiated with the Office of Technology Transfer at the
+#  California Institute of Technology.
+#
+#  This software may be subject to U.S. export control laws. By accepting this software,
+#  the user agrees to comply with all applicable U.S. export laws and regulations.
+#  User has the responsibility to obtain export licenses, or other export authority
+#  as may be required before exporting such information to foreign countries or providing
+#  access to foreign persons.
+#
+#  file:	shampoo_lite/sparse_kernel.py
+#  author:	S. Felipe Fregoso
+#  description:	Packed propagation kernel which only stores the coefficients
+#               inside the centered spectral mask of each wavelength
+#
+###############################################################################
+"""
+import numpy as np
+
+INDEXDTYPE = np.int32
+
+class SparseKernel(object):
+    """
+    Propagation kernel restricted to the support of the centered spectral mask.
+
+    For each wavelength the flat indices (into the N x N centered frequency
+    grid) of the pixels inside the mask are stored together with the kernel
+    values at those pixels.  Values are of shape (M,) for a single
+    propagation distance or (M, D) for a stack of D propagation distances.
+    """
+    def __init__(self, hololen, indices, values):
+        """
+        Parameters
+        ----------
+        hololen : int
+            Length of the hologram in pixels
+        indices : list of np.array
+            Flat indices of the masked pixels, one array per wavelength
+        values : list of np.array
+            Kernel values at 'indices', one array per wavelength
+        """
+        if len(indices) != len(values):
+            raise ValueError("Number of index arrays and value arrays must be the same")
+
+        self.hololen = hololen
+        self.indices = [np.asarray(idx, dtype=INDEXDTYPE) for idx in indices]
+        self.values = values
+
+    @classmethod
+    def from_dense(cls, kernel, spectral_mask_centered):
+        """
+        Pack a dense N x N x wavelength (or N x N x D x wavelength) kernel
+
+        Parameters
+        ----------
+        kernel : np.array
+            Dense propagation kernel, last axis is wavelength
+        spectral_mask_centered : N x N x wavelength.size np.array
+            Spectral mask(s) where the mask is in the center of the image
+        """
+        indices = []
+        values = []
+        for i in range(kernel.shape[-1]):
+            idx = np.flatnonzero(spectral_mask_centered[:, :, i])
+            indices.append(idx)
+            values.append(kernel[..., i].reshape((kernel.shape[0] * kernel.shape[1],) + kernel.shape[2:-1])[idx])
+
+        return cls(kernel.shape[0], indices, values)
+
+    def save(self, file):
+        """
+        Save the indices and values of the kernel to an '.npz' file
+
+        Parameters
+        ----------
+        file : str or file
+            File name or open file, as np.savez
+        """
+        arrays = {'hololen':np.array(self.hololen)}
+        for i, (idx, val) in enumerate(zip(self.indices, self.values)):
+            arrays['indices_%d'%(i)] = idx
+            arrays['values_%d'%(i)] = val
+
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        """
+        Load a kernel saved with 'save'
+        """
+        with np.load(file) as data:
+            num_wavelength = len([name for name in data.files if name.startswith('indices_')])
+            indices = [data['indices_%d'%(i)] for i in range(num_wavelength)]
+            values = [data['values_%d'%(i)] for i in range(num_wavelength)]
+            return cls(int(data['hololen']), indices, values)
+
+    @property
+    def num_wavelength(self):
+        """ Number of wavelengths """
+        return len(self.indices)
+
+    @property
+    def num_distance(self):
+        """ Number of propagation distances, 0 if the kernel is not a stack """
+        return 0 if self.values[0].ndim == 1 else self.values[0].shape[1]
+
+    @property
+    def shape(self):
+        """ Shape of the equivalent dense kernel """
+        return (self.hololen, self.hololen) + self.values[0].shape[1:] + (self.num_wavelength,)
+
+    @property
+    def nbytes(self):
+        """ Number of bytes used by the kernel """
+        return sum([idx.nbytes + val.nbytes for idx, val in zip(self.indices, self.values)])
+
+    def to_dense(self):
+        """
+        Return the kernel as a dense N x N x wavelength (or N x N x D x wavelength) array
+        """
+        depth = self.values[0].shape[1:]
+        dense = np.zeros((self.hololen * self.hololen,) + depth + (self.num_wavelength,), dtype=self.values[0].dtype)
+        for i in range(self.num_wavelength):
+            dense[self.indices[i], ..., i] = self.values[i]
+
+        return dense.reshape(self.shape)
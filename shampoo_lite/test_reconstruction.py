@@ -0,0 +1,308 @@
+import os
+import numpy as np
+import pytest
+
+from shampoo_lite.reconstruction import (Hologram, ReconstructedWave, _find_peak_centroid)
+from shampoo_lite.peak_tracking import (SpectralPeakTracker)
+from shampoo_lite.mask import (Circle, Mask)
+from shampoo_lite.pyfftw_utils import (FFTWPlanPool)
+from shampoo_lite.g_factor import (compute_propagation_kernel_batch)
+
+N = 2048
+WAVELENGTH = [405e-3] #um
+MAGNIFICATION = 10
+PIX = 3.45 #um
+CENTER_X = [1500]
+CENTER_Y = [600]
+RADIUS = [170]
+
+
+@pytest.fixture
+def hologram_image():
+    return np.random.RandomState(42).rand(N, N).astype(np.float32) * 255
+
+
+def make_hologram(image):
+    holo = Hologram(image, wavelength=WAVELENGTH, pix_dx=PIX, pix_dy=PIX,
+                    system_magnification=MAGNIFICATION)
+    fourier_mask = holo.generate_spectral_mask(center_x=CENTER_X, center_y=CENTER_Y, radius=RADIUS)
+    return holo, fourier_mask
+
+
+def test_depth_stack_matches_single_depth(hologram_image):
+    """ Every plane of a batched depth stack equals a single depth reconstruction """
+    distances = [100., 250.]
+
+    holo, fourier_mask = make_hologram(hologram_image)
+    w_stack = holo.reconstruct(distances, fourier_mask=fourier_mask, depth_stack=True)
+
+    assert w_stack.reconstructed_wave.shape == (N, N, len(distances), len(WAVELENGTH))
+
+    for idx, dist in enumerate(distances):
+        holo, fourier_mask = make_hologram(hologram_image)
+        G_factor = holo.generate_propagation_kernel(dist, fourier_mask.mask_centered)
+        w_single = holo.reconstruct(dist, fourier_mask=fourier_mask, G_factor=G_factor)
+
+        np.testing.assert_allclose(w_stack.reconstructed_wave[:, :, idx, :],
+                                   w_single.reconstructed_wave[:, :, 0, :],
+                                   rtol=1e-3, atol=1e-3 * np.abs(w_single.reconstructed_wave).max())
+
+
+def test_sparse_kernel_matches_dense(hologram_image):
+    """ Reconstruction with a kernel packed to the mask support equals the dense kernel """
+    dist = 100.
+
+    holo, fourier_mask = make_hologram(hologram_image)
+    G_dense = holo.generate_propagation_kernel(dist, fourier_mask.mask_centered)
+    w_dense = holo.reconstruct(dist, fourier_mask=fourier_mask, G_factor=G_dense)
+
+    holo, fourier_mask = make_hologram(hologram_image)
+    G_sparse = holo.generate_propagation_kernel(dist, fourier_mask.mask_centered, sparse=True)
+    w_sparse = holo.reconstruct(dist, fourier_mask=fourier_mask, G_factor=G_sparse)
+
+    assert G_sparse.nbytes < G_dense.nbytes / 10
+    np.testing.assert_array_equal(G_sparse.to_dense(), G_dense)
+    np.testing.assert_allclose(w_sparse.reconstructed_wave, w_dense.reconstructed_wave,
+                               rtol=1e-3, atol=1e-3 * np.abs(w_dense.reconstructed_wave).max())
+
+
+def test_sparse_kernel_stack_matches_dense(hologram_image):
+    """ Sparse depth stack equals the dense depth stack """
+    distances = [100., 250.]
+
+    holo, fourier_mask = make_hologram(hologram_image)
+    w_dense = holo.reconstruct(distances, fourier_mask=fourier_mask, depth_stack=True)
+
+    holo, fourier_mask = make_hologram(hologram_image)
+    G_sparse = holo.generate_propagation_kernel_stack(distances, fourier_mask.mask_centered, sparse=True)
+    w_sparse = holo.reconstruct(distances, fourier_mask=fourier_mask, G_factor=G_sparse, depth_stack=True)
+
+    np.testing.assert_allclose(w_sparse.reconstructed_wave, w_dense.reconstructed_wave,
+                               rtol=1e-3, atol=1e-3 * np.abs(w_dense.reconstructed_wave).max())
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_cropped_spectrum_subsamples_full(hologram_image, sparse):
+    """ Cropped spectrum reconstruction samples the full size reconstruction on a coarser grid """
+    dist = 100.
+
+    holo, fourier_mask = make_hologram(hologram_image)
+    G_factor = holo.generate_propagation_kernel(dist, fourier_mask.mask_centered, sparse=sparse)
+    w_full = holo.reconstruct(dist, fourier_mask=fourier_mask, G_factor=G_factor)
+    w_crop = holo.reconstruct(dist, fourier_mask=fourier_mask, G_factor=G_factor, crop_spectrum=True)
+
+    crop_len = holo.cropped_spectrum_length()
+    step = N // crop_len
+    assert crop_len == 512
+    assert w_crop.reconstructed_wave.shape == (crop_len, crop_len, 1, len(WAVELENGTH))
+    assert w_crop.pix_dx == pytest.approx(w_full.pix_dx * step)
+    np.testing.assert_allclose(w_crop.reconstructed_wave, w_full.reconstructed_wave[::step, ::step],
+                               rtol=1e-3, atol=1e-3 * np.abs(w_full.reconstructed_wave).max())
+
+
+def test_plan_pool_reuses_plans_and_persists_wisdom(tmp_path):
+    """ Plans are created per shape, reused, and FFTW wisdom is written to disk """
+    wisdom_file = str(tmp_path / 'wisdom.pkl')
+    pool = FFTWPlanPool(np.float32, np.complex64, planner_effort='FFTW_ESTIMATE', threads=1,
+                        wisdom_file=wisdom_file)
+
+    image = np.random.RandomState(0).rand(96, 64).astype(np.float32)
+    spectrum = pool.fft2(image)
+    np.testing.assert_allclose(spectrum, np.fft.fft2(image), rtol=1e-4, atol=1e-3)
+
+    ### Results are not overwritten by the next transform
+    pool.fft2(np.zeros_like(image))
+    np.testing.assert_allclose(spectrum, np.fft.fft2(image), rtol=1e-4, atol=1e-3)
+    np.testing.assert_allclose(pool.ifft2(spectrum), image, rtol=1e-4, atol=1e-4)
+
+    plan = pool.get_plan((96, 64), np.float32, FFTWPlanPool.FORWARD)
+    assert pool.get_plan((96, 64), np.float32, FFTWPlanPool.FORWARD) is plan
+
+    ### Wisdom is written once, not for every plan
+    assert not os.path.exists(wisdom_file)
+    pool.configure(threads=2)
+    assert os.path.exists(wisdom_file)
+    assert pool.get_plan((96, 64), np.float32, FFTWPlanPool.FORWARD) is not plan
+
+
+def test_plan_pool_bounds_thread_plans():
+    """ Each thread keeps its own plans, at most 'max_plans' of them """
+    import threading
+    pool = FFTWPlanPool(np.float32, np.complex64, planner_effort='FFTW_ESTIMATE', threads=1, max_plans=2)
+
+    plan = pool.get_plan((32, 32), np.float32, FFTWPlanPool.FORWARD)
+    other = []
+    thread = threading.Thread(target=lambda: other.append(pool.get_plan((32, 32), np.float32, FFTWPlanPool.FORWARD)))
+    thread.start()
+    thread.join()
+    assert other[0] is not plan
+
+    pool.get_plan((32, 16), np.float32, FFTWPlanPool.FORWARD)
+    pool.get_plan((16, 16), np.float32, FFTWPlanPool.FORWARD)
+    assert pool.get_plan((32, 32), np.float32, FFTWPlanPool.FORWARD) is not plan
+
+
+@pytest.mark.parametrize('shape', [(64, 48), (64, 48, 3), (63, 49)])
+def test_centered_transforms_match_fftshift(shape):
+    """ Checkerboard centered transforms equal the explicit fftshift path """
+    pool = FFTWPlanPool(np.float32, np.complex64, planner_effort='FFTW_ESTIMATE', threads=1)
+    rng = np.random.RandomState(1)
+    image = rng.rand(*shape)
+    spectrum = (rng.rand(*shape) + 1j * rng.rand(*shape)).astype(np.complex64)
+
+    def centered(transform, array):
+        return np.fft.fftshift(transform(np.fft.fftshift(array, axes=(0, 1)), axes=(0, 1)), axes=(0, 1))
+
+    np.testing.assert_allclose(pool.fft2_centered(image, 2.0), 2.0 * centered(np.fft.fft2, image),
+                               rtol=1e-4, atol=1e-3)
+    np.testing.assert_allclose(pool.ifft2_centered(spectrum), centered(np.fft.ifft2, spectrum),
+                               rtol=1e-4, atol=1e-5)
+
+    if len(shape) == 2 and shape[0] % 2 == 0:
+        ### Second call must clear the indices written by the first one
+        first, second = rng.choice(spectrum.size, 50, replace=False), rng.choice(spectrum.size, 10, replace=False)
+        sparse = np.zeros(shape, dtype=np.complex64)
+        sparse.flat[second] = spectrum.flat[second]
+        pool.ifft2_sparse_centered(first, spectrum.flat[first], shape)
+        np.testing.assert_allclose(pool.ifft2_sparse_centered(second, spectrum.flat[second], shape),
+                                   centered(np.fft.ifft2, sparse), rtol=1e-4, atol=1e-5)
+
+
+def test_parallel_wavelengths_match_serial(hologram_image):
+    """ Reconstructing wavelengths on a thread pool gives the serial result and per channel timing """
+    wavelength = [405e-3, 532e-3]
+
+    waves = []
+    for num_workers in [1, 0]:
+        holo = Hologram(hologram_image, wavelength=wavelength, pix_dx=PIX, pix_dy=PIX,
+                        system_magnification=MAGNIFICATION)
+        fourier_mask = holo.generate_spectral_mask(center_x=[1500, 600], center_y=[600, 1500], radius=[170, 150])
+        waves.append(holo.reconstruct(100., fourier_mask=fourier_mask, num_workers=num_workers))
+
+    assert len(waves[1].channel_times) == len(wavelength)
+    np.testing.assert_allclose(waves[1].reconstructed_wave, waves[0].reconstructed_wave,
+                               rtol=1e-5, atol=1e-5 * np.abs(waves[0].reconstructed_wave).max())
+
+
+def test_batched_kernel_matches_per_wavelength_kernel(hologram_image):
+    """ Chunked batch kernel generator equals the per wavelength, per distance kernels """
+    wavelength = [405e-3, 532e-3]
+    distances = [50., 100.]
+
+    holo = Hologram(hologram_image, wavelength=wavelength, pix_dx=PIX, pix_dy=PIX,
+                    system_magnification=MAGNIFICATION)
+    fourier_mask = holo.generate_spectral_mask(center_x=[1500, 600], center_y=[600, 1500], radius=[170, 150])
+    mask_centered = fourier_mask.mask_centered
+
+    G_batch = compute_propagation_kernel_batch(distances, N, holo._pix_width_x, wavelength,
+                                               mask_centered, max_chunk_bytes=64 * 1024**2)
+    assert G_batch.shape == (N, N, len(distances), len(wavelength))
+
+    for idx, dist in enumerate(distances):
+        G_single = holo.generate_propagation_kernel(dist, mask_centered)
+        np.testing.assert_allclose(G_batch[:, :, idx, :], G_single, atol=1e-3)
+
+
+@pytest.mark.parametrize('change', [{},
+                                    {'wavelength': [532e-3]},
+                                    {'pix_dx': 5.5, 'pix_dy': 5.5},
+                                    {'system_magnification': 20},
+                                    {'hololen': 1024}])
+def test_updated_hologram_matches_fresh(hologram_image, change):
+    """ A hologram reused for the next frame equals a new one, whatever changed """
+    params = {'wavelength': WAVELENGTH, 'pix_dx': PIX, 'pix_dy': PIX,
+              'system_magnification': MAGNIFICATION}
+    params.update(change)
+    hololen = params.pop('hololen', N)
+    scale = hololen / N
+    image = (hologram_image[::-1, :] * 0.5)[:hololen, :hololen]
+    dist = 100.
+
+    holo, _ = make_hologram(hologram_image)
+    holo.reconstruct(dist, fourier_mask=holo.fourier_mask)
+    holo.update_hologram(image, **params)
+    fourier_mask = holo.generate_spectral_mask(center_x=[CENTER_X[0] * scale], center_y=[CENTER_Y[0] * scale],
+                                               radius=[RADIUS[0] * scale])
+    w_updated = holo.reconstruct(dist, fourier_mask=fourier_mask)
+
+    fresh = Hologram(image, **params)
+    fresh_mask = fresh.generate_spectral_mask(center_x=[CENTER_X[0] * scale], center_y=[CENTER_Y[0] * scale],
+                                              radius=[RADIUS[0] * scale])
+    w_fresh = fresh.reconstruct(dist, fourier_mask=fresh_mask)
+
+    assert holo.dk == fresh.dk
+    np.testing.assert_array_equal(holo.apodize_mask(), fresh.apodize_mask())
+    np.testing.assert_array_equal(holo.propagation_array, fresh.propagation_array)
+    np.testing.assert_array_equal(holo.angular_spectrum, fresh.angular_spectrum)
+    np.testing.assert_array_equal(w_updated.reconstructed_wave, w_fresh.reconstructed_wave)
+
+
+def test_update_hologram_keeps_grids(hologram_image):
+    """ Grids are only recomputed when their parameters change """
+    holo, _ = make_hologram(hologram_image)
+    apodize_mask = holo.apodize_mask()
+    propagation_array = holo.propagation_array
+
+    holo.update_hologram(hologram_image * 0.5, wavelength=WAVELENGTH, pix_dx=PIX, pix_dy=PIX,
+                         system_magnification=MAGNIFICATION)
+    assert holo.apodize_mask() is apodize_mask
+    assert holo.propagation_array is propagation_array
+
+    holo.update_hologram(hologram_image, wavelength=[532e-3], pix_dx=PIX, pix_dy=PIX,
+                         system_magnification=MAGNIFICATION)
+    assert holo.apodize_mask() is apodize_mask
+    assert holo.propagation_array is not propagation_array
+
+
+def test_peak_tracker_matches_full_search():
+    """ Tracked spectral peak of drifting fringes equals the full search, a jump falls back to it """
+    hololen = 1024
+    y, x = np.mgrid[0:hololen, 0:hololen]
+    rng = np.random.RandomState(0)
+
+    holo = None
+    tracker = SpectralPeakTracker()
+    for fx, fy in [(0.2, 0.1), (0.201, 0.1), (0.203, 0.099), (0.3, 0.05)]:
+        image = 100 + 50 * np.cos(2 * np.pi * (fx * x + fy * y)) + 5 * rng.rand(hololen, hololen)
+        if holo is None:
+            holo = Hologram(image, wavelength=WAVELENGTH)
+            holo.peak_tracker = tracker
+        else:
+            holo.update_hologram(image, wavelength=WAVELENGTH)
+
+        np.testing.assert_array_equal(holo.fourier_peak_centroid(),
+                                      _find_peak_centroid(np.abs(holo.ft_hologram), holo.wavelength))
+
+    assert (tracker.full_searches, tracker.tracked) == (2, 2)
+
+
+def test_reconstructed_wave_products():
+    """ Single pass products match numpy and fill the preallocated outputs """
+    rng = np.random.RandomState(0)
+    wave = (rng.randn(300, 200, 1, 1) + 1j * rng.randn(300, 200, 1, 1)).astype(np.complex64)
+    intensity = np.empty(wave.shape, dtype=np.float32)
+
+    www = ReconstructedWave(wave)
+    www.compute(('intensity', 'phase'), out={'intensity':intensity})
+    assert www.intensity is intensity and www._amplitude_image is None
+    np.testing.assert_allclose(www.intensity, np.abs(wave)**2, rtol=1e-5)
+    np.testing.assert_allclose(www.phase, np.angle(wave), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(www.amplitude, np.abs(wave), rtol=1e-6)
+    assert www.amplitude.dtype == www.phase.dtype == np.float32
+
+
+def test_mask_disks_and_cache():
+    """ Bounding box disks equal the full grid definition and equal circles share the cached mask """
+    n = 256
+    circles = [(200, 40, 30), (5, 128, 20.5)]
+    mask = Mask(n, [Circle(*params) for params in circles], 0.01)
+    rows, cols = np.indices((n, n))
+    for i, (centerx, centery, radius) in enumerate(circles):
+        np.testing.assert_array_equal(mask.mask_uncentered[:, :, i],
+                                      (cols - centerx)**2 + (rows - centery)**2 < radius**2)
+        np.testing.assert_array_equal(mask.mask_centered[:, :, i],
+                                      (cols - n//2)**2 + (rows - n//2)**2 < radius**2)
+
+    assert mask.mask_coordinates == circles
+    assert Mask(n, [Circle(*params) for params in circles], 0.02).mask is mask.mask
+    assert not mask.mask.flags.writeable